@@ -0,0 +1,165 @@
+# In this program we build chunks from the texts in data/ and measure what each compression codec does to the size of
+# the chunk files, and how long compressing, decompressing and moving them takes.
+# So no openai calls are needed, the embeddings are random unit length gaussian vectors, which like real embeddings 
+# have small values that use only part of the int8 range. With --embeddings_dir, real embeddings are taken from the 
+# json chunk files that create_and_upload_chunks.py leaves in chunks/ instead.
+
+import argparse
+from xxxdumb_vector_s3 import write_chunks_to_s3, read_chunk_from_s3, flush_cache, vector_to_bytes, \
+    compress_bytes, decompress_bytes, C_VECTORTYPE_INT8, C_COMPRESSION_ZLIB, C_COMPRESSION_GZIP, C_COMPRESSION_LZMA
+import numpy as np
+import base64
+import json
+import boto3
+import time
+import os
+
+C_CODEC_LEVELS = [
+    (None, None),
+    (C_COMPRESSION_ZLIB, 1),
+    (C_COMPRESSION_ZLIB, 6),
+    (C_COMPRESSION_ZLIB, 9),
+    (C_COMPRESSION_GZIP, 6),
+    (C_COMPRESSION_LZMA, 0),
+    (C_COMPRESSION_LZMA, 6),
+]
+
+def read_credentials():
+    with open('credentials.json', 'r') as f:
+        return json.load(f)
+
+def get_paragraphs(filename):
+    # the same paragraph splitting as create_and_upload_chunks.py
+    with open(filename, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    paragraphs = []
+    for p in text.split('\n\n'):
+        while p:
+            paragraphs.append(p[:2000])
+            p = p[2000:]
+    return paragraphs
+
+def read_embeddings(embeddings_dir):
+    # the base64 int8 embeddings of every chunk in the json chunk files in embeddings_dir
+    embeddings = []
+    for filename in sorted(os.listdir(embeddings_dir)):
+        if filename.endswith('.json'):
+            with open(os.path.join(embeddings_dir, filename), 'r') as f:
+                embeddings += [chunk['embedding'] for chunk in json.load(f)]
+    if not embeddings:
+        raise Exception(f"No embeddings found in {embeddings_dir}")
+    return embeddings
+
+def create_chunks(paragraphs, num_dimensions, rng, embeddings=None):
+    # embeddings, if given, are real base64 embeddings to use in turn; otherwise they are random unit gaussian vectors
+    chunks = []
+    for p in paragraphs:
+        if embeddings:
+            embedding_base64 = embeddings[len(chunks) % len(embeddings)]
+        else:
+            embedding = rng.normal(0, 1, num_dimensions)
+            embedding /= np.linalg.norm(embedding)
+            embedding_base64 = base64.b64encode(vector_to_bytes(embedding, C_VECTORTYPE_INT8)).decode('utf-8')
+        chunks.append({
+            'text': p,
+            'embedding': embedding_base64,
+            'vector_type': C_VECTORTYPE_INT8,
+        })
+    return chunks
+
+def time_it(func, repeats):
+    # best of repeats, which is the least noisy
+    best = None
+    for _ in range(repeats):
+        ts = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - ts
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def benchmark_codecs(chunk_files, mbps, repeats):
+    print (f"{'codec':>8} {'level':>5} {'bytes':>12} {'ratio':>6} {'compress s':>11} {'decompress s':>13} {'est. e2e s':>11}")
+    for compression, compression_level in C_CODEC_LEVELS:
+        total_raw = total_compressed = total_compress = total_decompress = 0
+        for raw_bytes in chunk_files:
+            if compression is None:
+                compressed_bytes, compress_time = raw_bytes, 0.0
+                decompress_time = 0.0
+            else:
+                compressed_bytes, compress_time = time_it(lambda: compress_bytes(raw_bytes, compression, compression_level), repeats)
+                decompressed_bytes, decompress_time = time_it(lambda: decompress_bytes(compressed_bytes), repeats)
+                assert decompressed_bytes == raw_bytes
+            total_raw += len(raw_bytes)
+            total_compressed += len(compressed_bytes)
+            total_compress += compress_time
+            total_decompress += decompress_time
+
+        # estimated time to download and decode every file over a link of mbps megabits per second
+        transfer_time = total_compressed * 8 / (mbps * 1000 * 1000)
+        print (f"{compression or 'none':>8} {compression_level if compression_level is not None else '-':>5} {total_compressed:>12} "
+               f"{total_raw / total_compressed:>6.2f} {total_compress:>11.3f} {total_decompress:>13.3f} {transfer_time + total_decompress:>11.3f}")
+
+def benchmark_s3(s3_session, s3_bucket, s3_path, chunks_by_file):
+    # real write and read timings against s3, reading each file back whole through the chunk reader
+    print (f"{'codec':>8} {'level':>5} {'write s':>8} {'read s':>8}")
+    for compression, compression_level in C_CODEC_LEVELS:
+        write_time = read_time = 0.0
+        for filename, chunks in chunks_by_file.items():
+            s3_file = f"bench_{compression or 'none'}_{compression_level}_{filename}.json"
+
+            ts = time.perf_counter()
+            write_chunks_to_s3(s3_session, s3_bucket, s3_path, s3_file, chunks, compression=compression, compression_level=compression_level)
+            write_time += time.perf_counter() - ts
+
+            flush_cache()
+            ts = time.perf_counter()
+            chunk = read_chunk_from_s3(s3_session, s3_bucket, s3_path, s3_file, 0, read_through_cache=True)
+            read_time += time.perf_counter() - ts
+            assert chunk == chunks[0]
+
+        print (f"{compression or 'none':>8} {compression_level if compression_level is not None else '-':>5} {write_time:>8.3f} {read_time:>8.3f}")
+
+def main():
+    # usage: python benchmark_compression.py [<data_dir>] [--num_dimensions N] [--embeddings_dir <dir>] [--mbps N] [--repeats N] [--s3 <s3_path>]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', help='directory of text files to build chunks from', nargs='?', default='data')
+    parser.add_argument('--num_dimensions', help='number of dimensions in the synthetic embeddings', type=int, default=1536)
+    parser.add_argument('--embeddings_dir', help='use the real embeddings in the json chunk files in this directory (eg: chunks)')
+    parser.add_argument('--mbps', help='link speed in megabits per second for the estimated end to end time', type=float, default=100)
+    parser.add_argument('--repeats', help='number of times to repeat each timing (the best is reported)', type=int, default=3)
+    parser.add_argument('--s3', help='also time real uploads and downloads to this S3 path (uses credentials.json)')
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    embeddings = read_embeddings(args.embeddings_dir) if args.embeddings_dir else None
+
+    chunks_by_file = {}
+    for filename in sorted(os.listdir(args.data_dir)):
+        paragraphs = get_paragraphs(os.path.join(args.data_dir, filename))
+        chunks_by_file[filename] = create_chunks(paragraphs, args.num_dimensions, rng, embeddings)
+
+    chunk_files = [json.dumps(chunks).encode('utf-8') for chunks in chunks_by_file.values()]
+    print (f"{len(chunk_files)} chunk files, {sum(len(chunks) for chunks in chunks_by_file.values())} chunks, {sum(len(b) for b in chunk_files)} bytes")
+
+    benchmark_codecs(chunk_files, args.mbps, args.repeats)
+
+    if args.s3:
+        credentials = read_credentials()
+
+        s3_session = boto3.Session(
+            aws_access_key_id=credentials['aws_access_key_id'],
+            aws_secret_access_key=credentials['aws_secret_access_key'],
+            region_name=credentials['region_name'],
+        )
+        s3_bucket = credentials['s3_bucket']
+
+        benchmark_s3(s3_session, s3_bucket, args.s3, chunks_by_file)
+
+    print ("done")
+
+if __name__ == '__main__':
+    main()
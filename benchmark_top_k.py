@@ -0,0 +1,90 @@
+# In this program we build a random index and time top k searches over it: one query at a time with 
+# top_k_similar and a PreparedDumbIndex, and many queries at once with search_batch.
+
+import argparse
+from top_k import top_k_similar, PreparedDumbIndex, Int8DumbIndex
+import numpy as np
+import time
+import os
+
+def create_dumb_index(num_vectors, num_dimensions, rng):
+    # unit vectors, like ada embeddings
+    vectors = rng.standard_normal((num_vectors, num_dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+    return {
+        "triples": [(vector, ix, 0) for ix, vector in enumerate(vectors.tolist())],
+        "paths": [""],
+        "file_pairs": [(0, f"{ix}.json") for ix in range(num_vectors)]
+    }
+
+def report(name, num_queries, elapsed):
+    print (f"{name:>24}: {num_queries} queries in {elapsed:.3f}s, {num_queries / elapsed:.1f} queries/s")
+
+def main():
+    # usage: python benchmark_top_k.py [--num_vectors N] [--num_dimensions N] [--num_queries N] [--k N] [--metric dot|cosine|l2] [--max_workers N] [--rerank N]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_vectors', help='number of vectors in the index', type=int, default=50000)
+    parser.add_argument('--num_dimensions', help='number of dimensions of each vector', type=int, default=1536)
+    parser.add_argument('--num_queries', help='number of queries to run', type=int, default=200)
+    parser.add_argument('--k', help='number of results per query', type=int, default=20)
+    parser.add_argument('--metric', help='similarity metric', choices=['dot', 'cosine', 'l2'], default='dot')
+    parser.add_argument('--max_workers', help='number of threads for the sharded search (0 for the number of cpus)', type=int, default=0)
+    parser.add_argument('--rerank', help='number of candidates the int8 search re-ranks exactly', type=int, default=100)
+    parser.add_argument('--unprepared_queries', help='number of queries to time with the unprepared top_k_similar', type=int, default=3)
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    dumb_index = create_dumb_index(args.num_vectors, args.num_dimensions, rng)
+    queries = rng.standard_normal((args.num_queries, args.num_dimensions))
+
+    ts = time.perf_counter()
+    for query in queries[:args.unprepared_queries]:
+        top_k_similar(dumb_index, query, args.k)
+    report("top_k_similar", args.unprepared_queries, time.perf_counter() - ts)
+
+    ts = time.perf_counter()
+    prepared_dumb_index = PreparedDumbIndex(dumb_index)
+    print (f"{'prepare':>24}: {time.perf_counter() - ts:.3f}s")
+
+    ts = time.perf_counter()
+    single_ids = [prepared_dumb_index.search(query, args.k, args.metric)[0] for query in queries]
+    report("search (one at a time)", len(queries), time.perf_counter() - ts)
+
+    ts = time.perf_counter()
+    batch_ids, _ = prepared_dumb_index.search_batch(queries, args.k, args.metric)
+    report("search_batch", len(queries), time.perf_counter() - ts)
+
+    mismatches = sum(ids.tolist() != batch_ids[ix].tolist() for ix, ids in enumerate(single_ids))
+    print (f"queries where search_batch and search disagree: {mismatches}")
+
+    max_workers = args.max_workers or os.cpu_count()
+    sharded_dumb_index = PreparedDumbIndex(dumb_index, max_workers=max_workers)
+    ts = time.perf_counter()
+    sharded_ids = [sharded_dumb_index.search(query, args.k, args.metric)[0] for query in queries]
+    report(f"search ({max_workers} shards)", len(queries), time.perf_counter() - ts)
+    sharded_dumb_index.close()
+
+    mismatches = sum(ids.tolist() != sharded_ids[ix].tolist() for ix, ids in enumerate(single_ids))
+    print (f"queries where the sharded search and search disagree: {mismatches}")
+
+    int8_metric = args.metric if args.metric != 'l2' else 'dot'
+    exact_ids = [set(prepared_dumb_index.search(query, args.k, int8_metric)[0].tolist()) for query in queries]
+
+    ts = time.perf_counter()
+    int8_dumb_index = Int8DumbIndex(dumb_index)
+    print (f"{'prepare int8':>24}: {time.perf_counter() - ts:.3f}s, {int8_dumb_index.matrix.nbytes} bytes of vectors (float32: {prepared_dumb_index.matrix.nbytes})")
+
+    for rerank in (0, args.rerank):
+        ts = time.perf_counter()
+        int8_ids = [int8_dumb_index.search(query, args.k, int8_metric, rerank)[0] for query in queries]
+        report(f"int8 search (rerank {rerank})", len(queries), time.perf_counter() - ts)
+        recall = sum(len(exact_ids[ix] & set(ids.tolist())) for ix, ids in enumerate(int8_ids)) / (len(queries) * args.k)
+        print (f"{'recall@' + str(args.k):>24}: {recall:.3f}")
+
+    print ("done")
+
+if __name__ == '__main__':
+    main()
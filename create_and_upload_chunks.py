@@ -2,7 +2,7 @@
 # We then write the chunks to S3.  
 
 import argparse
-from dumbvector import write_chunks_to_s3, vector_to_bytes, C_VECTORTYPE_INT8
+from xxxdumb_vector_s3 import write_chunks_to_s3, vector_to_bytes, C_VECTORTYPE_INT8
 from openai.embeddings_utils import get_embedding
 import openai
 import base64
@@ -53,7 +53,7 @@ def read_credentials():
         return json.load(f)
 
 @time_function
-def create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket):
+def create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket, upload_kwargs=None, container=False):
     # remove any path info from the filename
     filename_no_path = os.path.basename(filename)
 
@@ -96,9 +96,10 @@ def create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket):
         with open(chunks_path, 'w') as f:
             json.dump(chunks, f)
 
-        # write the chunks to S3
+        # write the chunks to S3, as a chunk container if asked (so single chunks can be read with Range requests)
+        s3_chunks_filename = f'chunks_{filename_no_path}.chunks' if container else chunks_filename
         print (f'writing {len(chunks)} chunks to S3')
-        time_function(write_chunks_to_s3)(s3_session, s3_bucket, s3_path, chunks_filename, chunks)
+        time_function(write_chunks_to_s3)(s3_session, s3_bucket, s3_path, s3_chunks_filename, chunks, **(upload_kwargs or {}))
     else:
         with open(chunks_path, 'r') as f:
             chunks = json.load(f)
@@ -106,18 +107,35 @@ def create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket):
     return chunks
 
 def main():
-    # usage: python create_and_upload_chunks.py [<filename>] [<s3_path>]
+    # usage: python create_and_upload_chunks.py [<filename>] [<s3_path>] [--multipart] [--part_size_mb N] [--max_workers N] [--container] [--compression zlib|gzip|lzma] [--compression_level N]
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('filename', help='name of file to read')
     parser.add_argument('s3_path', help='path to write chunks to S3', nargs='?', default='')
+    parser.add_argument('--multipart', help='upload chunk files with a parallel multipart upload', action='store_true')
+    parser.add_argument('--part_size_mb', help='multipart part size in MB (at least 5)', type=int, default=8)
+    parser.add_argument('--max_workers', help='number of parts to upload concurrently', type=int, default=8)
+    parser.add_argument('--container', help='write chunks to S3 as a random access chunk container (.chunks) instead of json', action='store_true')
+    parser.add_argument('--compression', help='compress json chunk files in S3 (readers detect it automatically)', choices=['zlib', 'gzip', 'lzma'])
+    parser.add_argument('--compression_level', help='compression level (zlib/gzip 0-9, lzma preset 0-9)', type=int)
 
     args = parser.parse_args()
 
     filename = args.filename
     s3_path = args.s3_path or "vectorexp/chunks"
 
+    upload_kwargs = {}
+    if args.multipart:
+        upload_kwargs = {
+            'multipart': True,
+            'part_size': args.part_size_mb * 1024 * 1024,
+            'max_workers': args.max_workers,
+        }
+    if args.compression:
+        upload_kwargs['compression'] = args.compression
+        upload_kwargs['compression_level'] = args.compression_level
+
     # read the credentials
     credentials = read_credentials()
 
@@ -135,9 +153,9 @@ def main():
         # get all the files in the directory
         filenames = [os.path.join(filename, f) for f in os.listdir(filename)]
         for filename in filenames:
-            create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket)
+            create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket, upload_kwargs, args.container)
     else:
-        create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket)
+        create_and_upload_chunks(filename, s3_path, s3_session, s3_bucket, upload_kwargs, args.container)
 
     print ("done")
 
@@ -0,0 +1,51 @@
+# In this program we build an HNSW index for a dumb index file, write it next to the index file, then report how well
+# it does against the exact search at a few values of ef_search: recall@k and the time per query.
+# The queries are vectors from the index with some noise added, so no embeddings need to be fetched.
+# The index file can also be a .dumbindex file from the dumbvector package, for search_index.py --backend hnsw.
+#
+# Building takes about 2 ms per vector (pure Python, see hnsw_index.py), so expect hours for millions of vectors.
+
+import argparse
+from dumbvector.util import time_function
+from top_k import read_columnar_dumb_index_or_dumbvector_index_from_file, get_noisy_queries, print_recall_and_latency
+from hnsw_index import create_hnsw_index, write_hnsw_index_to_file, get_hnsw_index_filename, \
+    C_HNSW_M, C_HNSW_EF_CONSTRUCTION, C_HNSW_EF_SEARCH
+
+def print_progress(num_inserted, num_to_insert):
+    print (f"inserted {num_inserted} of {num_to_insert}")
+
+def main():
+    # usage: python create_hnsw_index.py index_filename [--M N] [--ef_construction N] [--ef_search N ...] [--k N] [--num_queries N] [--metric dot|cosine|l2]
+
+    parser = argparse.ArgumentParser(description='Builds an HNSW index for a dumb index. Building is pure Python, about 2 ms per vector, so hours for millions of vectors.')
+
+    parser.add_argument('index_filename', help='the dumb index file (or dumbvector .dumbindex file) to build an HNSW index for')
+    parser.add_argument('--M', help='number of links per node on the upper layers (twice this on layer 0)', type=int, default=C_HNSW_M)
+    parser.add_argument('--ef_construction', help='number of nodes kept while finding the links of a new node', type=int, default=C_HNSW_EF_CONSTRUCTION)
+    parser.add_argument('--ef_search', help='numbers of nodes kept while searching', type=int, nargs='+', default=[16, C_HNSW_EF_SEARCH, 256])
+    parser.add_argument('--k', help='number of results per query', type=int, default=10)
+    parser.add_argument('--num_queries', help='number of queries to measure recall with', type=int, default=100)
+    parser.add_argument('--metric', help='similarity metric', choices=['dot', 'cosine', 'l2'], default='dot')
+
+    args = parser.parse_args()
+
+    dumb_index = read_columnar_dumb_index_or_dumbvector_index_from_file(args.index_filename)
+    num_vectors, num_dimensions = dumb_index["vectors"].shape
+    print (f"{num_vectors} vectors of {num_dimensions} dimensions")
+
+    hnsw_index = time_function(create_hnsw_index)(dumb_index, args.metric, args.M, args.ef_construction, f_progress=print_progress)
+    print (f"{len(hnsw_index)} nodes, {hnsw_index.get_max_level() + 1} layers")
+
+    hnsw_index_filename = get_hnsw_index_filename(args.index_filename)
+    time_function(write_hnsw_index_to_file)(hnsw_index_filename, hnsw_index)
+    print (f"wrote {hnsw_index_filename}")
+
+    queries = get_noisy_queries(dumb_index, args.num_queries)
+
+    for ef_search in args.ef_search:
+        print_recall_and_latency(hnsw_index, dumb_index, queries, args.k, args.metric, f"ef_search {ef_search}", ef_search=ef_search)
+
+    print ("done")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# In this program we build an IVF index for a dumb index file, write it next to the index file, then report how well
+# it does against the exact search at a few values of nprobe: recall@k and the time per query.
+# The queries are vectors from the index with some noise added, so no embeddings need to be fetched.
+# The index file can also be a .dumbindex file from the dumbvector package, for search_index.py --backend ivf.
+
+import argparse
+from dumbvector.util import time_function
+from top_k import read_columnar_dumb_index_or_dumbvector_index_from_file, get_noisy_queries, print_recall_and_latency
+from ivf_index import create_ivf_index, write_ivf_index_to_file, get_ivf_index_filename, \
+    C_IVF_NUM_ITERATIONS, C_IVF_TRAIN_SIZE
+import numpy as np
+
+def main():
+    # usage: python create_ivf_index.py index_filename [--num_lists N] [--num_iterations N] [--train_size N] [--nprobe N ...] [--k N] [--num_queries N] [--metric dot|cosine|l2]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('index_filename', help='the dumb index file (or dumbvector .dumbindex file) to build an IVF index for')
+    parser.add_argument('--num_lists', help='number of lists (k-means centroids), default about sqrt of the number of vectors', type=int, default=None)
+    parser.add_argument('--num_iterations', help='number of k-means iterations', type=int, default=C_IVF_NUM_ITERATIONS)
+    parser.add_argument('--train_size', help='number of vectors to train the centroids on', type=int, default=C_IVF_TRAIN_SIZE)
+    parser.add_argument('--nprobe', help='numbers of lists to probe per query', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--k', help='number of results per query', type=int, default=10)
+    parser.add_argument('--num_queries', help='number of queries to measure recall with', type=int, default=100)
+    parser.add_argument('--metric', help='similarity metric', choices=['dot', 'cosine', 'l2'], default='dot')
+
+    args = parser.parse_args()
+
+    dumb_index = read_columnar_dumb_index_or_dumbvector_index_from_file(args.index_filename)
+    num_vectors, num_dimensions = dumb_index["vectors"].shape
+    print (f"{num_vectors} vectors of {num_dimensions} dimensions")
+
+    num_lists = args.num_lists or max(1, int(np.sqrt(num_vectors)))
+    ivf_index = time_function(create_ivf_index)(dumb_index, num_lists, args.num_iterations, args.train_size)
+    list_sizes = ivf_index.get_list_sizes()
+    print (f"{ivf_index.get_num_lists()} lists, {list_sizes.min()} to {list_sizes.max()} vectors each")
+
+    ivf_index_filename = get_ivf_index_filename(args.index_filename)
+    time_function(write_ivf_index_to_file)(ivf_index_filename, ivf_index)
+    print (f"wrote {ivf_index_filename}")
+
+    queries = get_noisy_queries(dumb_index, args.num_queries)
+
+    for nprobe in args.nprobe:
+        print_recall_and_latency(ivf_index, dumb_index, queries, args.k, args.metric, f"nprobe {nprobe}", nprobe=nprobe)
+
+    print ("done")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# In this program we build a PQ index for a dumb index file, write it next to the index file, then report how well
+# it does against the exact search: recall@k with and without re-ranking, and the time per query.
+# The queries are vectors from the index with some noise added, so no embeddings need to be fetched.
+
+import argparse
+from dumbvector.util import time_function
+from xxxdumb_vector_s3 import read_columnar_dumb_index_from_file
+from top_k import get_noisy_queries, print_recall_and_latency
+from pq_index import create_pq_index, write_pq_index_to_file, get_pq_index_filename, \
+    C_PQ_NUM_CENTROIDS, C_PQ_NUM_ITERATIONS, C_PQ_TRAIN_SIZE
+
+def main():
+    # usage: python create_pq_index.py index_filename [--num_subspaces N] [--num_centroids N] [--num_iterations N] [--train_size N] [--k N] [--rerank N] [--num_queries N] [--metric dot|cosine|l2]
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('index_filename', help='the dumb index file to build a PQ index for')
+    parser.add_argument('--num_subspaces', help='number of subspaces (bytes per vector)', type=int, default=96)
+    parser.add_argument('--num_centroids', help='number of centroids per subspace (at most 256)', type=int, default=C_PQ_NUM_CENTROIDS)
+    parser.add_argument('--num_iterations', help='number of k-means iterations', type=int, default=C_PQ_NUM_ITERATIONS)
+    parser.add_argument('--train_size', help='number of vectors to train the codebooks on', type=int, default=C_PQ_TRAIN_SIZE)
+    parser.add_argument('--k', help='number of results per query', type=int, default=10)
+    parser.add_argument('--rerank', help='number of candidates to re-rank exactly', type=int, default=100)
+    parser.add_argument('--num_queries', help='number of queries to measure recall with', type=int, default=100)
+    parser.add_argument('--metric', help='similarity metric', choices=['dot', 'cosine', 'l2'], default='dot')
+
+    args = parser.parse_args()
+
+    dumb_index = read_columnar_dumb_index_from_file(args.index_filename)
+    num_vectors, num_dimensions = dumb_index["vectors"].shape
+    print (f"{num_vectors} vectors of {num_dimensions} dimensions, {dumb_index['vectors'].nbytes // max(1, num_vectors)} bytes each")
+
+    pq_index = time_function(create_pq_index)(dumb_index, args.num_subspaces, args.num_centroids, args.num_iterations, args.train_size)
+    print (f"PQ codes are {pq_index.get_num_bytes_per_vector()} bytes per vector")
+
+    pq_index_filename = get_pq_index_filename(args.index_filename)
+    time_function(write_pq_index_to_file)(pq_index_filename, pq_index)
+    print (f"wrote {pq_index_filename}")
+
+    queries = get_noisy_queries(dumb_index, args.num_queries)
+
+    for rerank in (0, args.rerank):
+        print_recall_and_latency(pq_index, dumb_index, queries, args.k, args.metric, f"rerank {rerank}", rerank=rerank)
+
+    print ("done")
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,18 @@
 import numpy as np
 import cupy as cp
 import time
+from xxxdumb_vector_s3 import apply_dimension_mask, get_dumb_index_triples
+from top_k import merge_top_k, top_k_order, yield_vector_blocks_from_dumb_index
 
-def cupy_top_k_similar(dumb_index, vector, k):
+# vectors are copied to the gpu and scored this many at a time
+C_CUPY_BLOCK_SIZE = 65536
+
+def cupy_top_k_similar(dumb_index, vector, k, block_size=C_CUPY_BLOCK_SIZE):
+    # dumb_index can be a dict of triples or columnar; its vectors are converted and copied a block at a time
     start_time = time.time()
+
+    # an index built with a dimension mask needs the query masked the same way
+    vector = apply_dimension_mask(dumb_index, vector)
  
     def print_time(message):
         print(message + ": " + str(time.time() - start_time))
@@ -12,84 +21,43 @@ def cupy_top_k_similar(dumb_index, vector, k):
 
     D = len(vector)
 
-    triples = dumb_index["triples"]
-    vectors = [triple[0] for triple in triples]
+    triples = get_dumb_index_triples(dumb_index)
 
     print_time("prepped")
 
-    def cupy_top_k_similar_1024(vectors_1024):
-        # process the vectors in chunks of 1024
-
+    # the query is copied to the gpu once, not once per block
+    vector_cupy = cp.asarray(vector)
 
-        vector_cupy = cp.asarray(vector)
-
-        print_time("vector_cupy")
-
-        # vectors_np = np.array(vectors_1024)
-        # vectors_np_t = vectors_np.T
-        # vectors_cupy = cp.asarray(vectors_np_t)
+    def cupy_top_k_similar_1024(vectors_1024):
+        # scores one block of vectors. Nothing in here is timed, the whole scan is timed once below.
         vectors_cupy = cp.asarray(vectors_1024).T
 
-        print_time("vectors_cupy")
-
-        # get the x dim of vectors_np_t
-        # x_dim = vectors_np_t.shape[0]
         y_dim = vectors_cupy.shape[1]
 
         output_cupy = cp.zeros((y_dim, 1), dtype=np.float64)
 
-        print_time("output_cupy")
-
-        # with cp.cuda.Device() as dev:
-        ret = vector_cupy.dot(vectors_cupy, out=output_cupy)
-            # dev.synchronize()
-        
-        print_time("dot")
-        # print (ret)
-
-        # flattened_output_cupy = output_cupy.flatten()
-        # print_time("flattened_output_cupy")
-        # np_retval = flattened_output_cupy.get()
-        # print_time("np_retval")
-        # retval = np_retval.tolist()
-        
-        # # # convert output_cupy to a plain list and return
-        # # list_of_lists = output_cupy.get().tolist()
-        # # retval = [item[0] for item in list_of_lists]
-
-        # print_time("retval")
-        # print ("retval:" + retval)
+        vector_cupy.dot(vectors_cupy, out=output_cupy)
 
         return output_cupy.flatten().get()
 
-    # # break vectors in blocks of 1024
-    # vector_blocks = [vectors[i:i + 1024] for i in range(0, len(vectors), 1024)]
-
-    # # process each block
-    # cosine_similarities = []
-    # for vector_block in vector_blocks:
-    #     block_cosine_similarities = cupy_top_k_similar_1024(vector_block)
-    #     cosine_similarities.extend(block_cosine_similarities)
-
-    cosine_similarities = cupy_top_k_similar_1024(vectors)
-
-    # now we want the top k indices
-    ind = np.argpartition(cosine_similarities, -k)[-k:]
-    print_time("ind")
-
-    # get the top k (triple, similarity) pairs
-    top_k = [(triples[i], cosine_similarities[i]) for i in ind]
-    print_time("top_k")
+    # process the vectors a block at a time, keeping a running top k, so the gpu only ever holds one block
+    top_k_ids = np.zeros(0, dtype=np.intp)
+    top_k_similarities = np.zeros(0, dtype=np.float64)
+    for start, block_vectors in yield_vector_blocks_from_dumb_index(dumb_index, block_size):
+        block_cosine_similarities = cupy_top_k_similar_1024(block_vectors)
 
-    # sort the top k triples
-    sorted_top_k = sorted(top_k, key=lambda item: item[1], reverse=True)
-    print_time("sorted_top_k")
+        block_ids = top_k_order(block_cosine_similarities, k)
+        top_k_ids, top_k_similarities = merge_top_k(
+            top_k_ids, top_k_similarities, block_ids + start, block_cosine_similarities[block_ids], k
+        )
+    print_time("scored and top_k")
 
-    sorted_top_k_triples = [item[0] for item in sorted_top_k]
+    sorted_top_k_triples = [triples[i] for i in top_k_ids.tolist()]
     print_time("sorted_top_k_triples")
 
     return {
         "triples": sorted_top_k_triples,
         "paths": dumb_index["paths"],
-        "file_pairs": dumb_index["file_pairs"]
+        "file_pairs": dumb_index["file_pairs"],
+        "dimension_mask": dumb_index.get("dimension_mask")
     }
@@ -0,0 +1,416 @@
+# An HNSW (hierarchical navigable small world) graph index over a dumb index, for approximate search that visits a
+# few thousand vectors at most instead of all of them. Each vector is a node, on layer 0 and on a random number of
+# layers above it (fewer nodes the higher the layer). A query walks greedily down the upper layers from the entry
+# point, then does a best first search of layer 0 keeping the ef_search best nodes seen. Larger ef_search trades
+# speed for recall.
+#
+# Building is the slow part: each insert is a pure Python best first search plus link pruning, about 2 ms per node
+# for 64 dimensions with the defaults (more for larger M, ef_construction or dimensions), so minutes for 100,000
+# vectors and hours for millions. Searching is fast, and a built graph is saved so it only needs building once.
+#
+# The graph is built for one metric, and only holds the links: the vectors stay in the dumb index, and node ids are
+# the dumb index's triple indices. New triples appended to the dumb index can be inserted into an existing graph.
+#
+# The links are kept in flat arrays so the file can be memory mapped as is. Layer 0 has up to 2 * M links per node,
+# the upper layers up to M. Unused links are -1.
+#
+# File layout (little endian), next to the dumb index file with C_HNSW_EXTENSION on the end:
+#     header (C_HNSW_HEADER_SIZE bytes): magic number, version, metric (an index into C_HNSW_METRICS), num_nodes, M,
+#         ef_construction, ef_search, entry_point, num_upper_rows (all uint32), then zero padding
+#     upper offsets: num_nodes + 1 uint64. Node n is on layers 1 to (upper_offsets[n + 1] - upper_offsets[n]), and
+#         its links on layer l are upper row upper_offsets[n] + l - 1
+#     layer 0 links: num_nodes X 2 * M int32
+#     upper links: num_upper_rows X M int32
+#     each section starts on a C_HNSW_ALIGNMENT boundary
+
+import numpy as np
+import mmap
+import math
+import heapq
+from xxxdumb_vector_s3 import apply_dimension_mask, get_dumb_index_triples, get_dumb_index_matrix, align, \
+    dumb_vector_array_to_floats, C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2
+
+C_HNSW_MAGIC_NUMBER = 0xfeedcafe
+C_HNSW_VERSION = 0x00000001
+C_HNSW_HEADER_SIZE = 64
+C_HNSW_ALIGNMENT = 64
+C_HNSW_EXTENSION = ".hnsw"
+
+C_HNSW_METRICS = (C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2)
+
+C_HNSW_M = 16
+C_HNSW_EF_CONSTRUCTION = 100
+C_HNSW_EF_SEARCH = 64
+
+# norms of a columnar index are worked out this many vectors at a time
+C_HNSW_BLOCK_SIZE = 16384
+
+# the entry point of an empty graph
+C_HNSW_NO_NODE = 0xffffffff
+
+def get_hnsw_index_filename(dumb_index_filename):
+    return dumb_index_filename + C_HNSW_EXTENSION
+
+class HNSWIndex:
+    '''
+    An HNSW graph (see the top of this file) over dumb_index (a dict of triples or columnar), built for metric. Use
+    create_hnsw_index to build one, or read_hnsw_index_from_file.
+    '''
+    def __init__(self, dumb_index, metric=C_METRIC_DOT, M=C_HNSW_M, ef_construction=C_HNSW_EF_CONSTRUCTION, ef_search=C_HNSW_EF_SEARCH,
+                 upper_offsets=None, layer0_links=None, upper_links=None, entry_point=None, rng=None):
+        if metric not in C_HNSW_METRICS:
+            raise Exception(f"Unknown metric {metric}")
+        if M < 2:
+            raise Exception(f"M must be at least 2, got {M}")
+
+        self.metric = metric
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_multiplier = 1 / math.log(M)
+        self.rng = rng if rng is not None else np.random.default_rng(0)
+
+        if upper_offsets is None:
+            upper_offsets = np.zeros(1, dtype=np.uint64)
+            layer0_links = np.zeros((0, 2 * M), dtype=np.int32)
+            upper_links = np.zeros((0, M), dtype=np.int32)
+        self.num_nodes = len(upper_offsets) - 1
+        self.num_upper_rows = int(upper_offsets[-1])
+        self.upper_offsets = upper_offsets
+        self.layer0_links = layer0_links
+        self.upper_links = upper_links
+        self.entry_point = entry_point
+
+        self._set_dumb_index(dumb_index)
+
+    def _set_dumb_index(self, dumb_index):
+        self.dumb_index = dumb_index
+        self.triples = get_dumb_index_triples(dumb_index)
+        # a dict of triples is decoded (and for cosine, normalized) once; a columnar index (maybe memory mapped) a few
+        # rows at a time, with its inverse norms worked out up front for cosine
+        self.matrix = None
+        self.inverse_norms = None
+        if "triples" in dumb_index:
+            self.matrix = get_dumb_index_matrix(dumb_index).astype(np.float32)
+            if self.metric == C_METRIC_COSINE:
+                self.matrix *= self._get_inverse_norms(self.matrix)[:, None]
+        elif self.metric == C_METRIC_COSINE:
+            vectors = dumb_index["vectors"]
+            self.inverse_norms = np.empty(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), C_HNSW_BLOCK_SIZE):
+                block = dumb_vector_array_to_floats(vectors[start:start + C_HNSW_BLOCK_SIZE], dumb_index["vector_type"])
+                self.inverse_norms[start:start + len(block)] = self._get_inverse_norms(block)
+
+    def _get_inverse_norms(self, vectors):
+        # 0 for vectors with no magnitude, so their similarities are all 0
+        norms = np.linalg.norm(vectors, axis=1)
+        return np.divide(1, norms, out=np.zeros_like(norms), where=norms != 0).astype(np.float32)
+
+    def __len__(self):
+        return self.num_nodes
+
+    def get_level(self, node):
+        return int(self.upper_offsets[node + 1] - self.upper_offsets[node])
+
+    def get_max_level(self):
+        return -1 if self.entry_point is None else self.get_level(self.entry_point)
+
+    def _get_links(self, node, level):
+        links = self.layer0_links[node] if level == 0 else self.upper_links[int(self.upper_offsets[node]) + level - 1]
+        return links[links >= 0]
+
+    def _set_links(self, node, level, links):
+        row = self.layer0_links[node] if level == 0 else self.upper_links[int(self.upper_offsets[node]) + level - 1]
+        row[:] = -1
+        row[:len(links)] = links
+
+    def _get_vectors(self, ids):
+        # float32 vectors of some nodes, normalized for cosine so the graph works on dot products
+        if self.matrix is not None:
+            return self.matrix[ids]
+        vectors = dumb_vector_array_to_floats(self.dumb_index["vectors"][ids], self.dumb_index["vector_type"]).astype(np.float32)
+        if self.inverse_norms is not None:
+            vectors *= self.inverse_norms[ids][:, None]
+        return vectors
+
+    def _prepare_query(self, vector):
+        query = np.asarray(vector, dtype=np.float32)
+        if self.metric == C_METRIC_COSINE:
+            norm = np.linalg.norm(query)
+            if norm:
+                query = query / norm
+        return query
+
+    def _get_similarities(self, vectors, query):
+        # higher is more similar; for l2 this is minus the squared distance
+        if self.metric == C_METRIC_L2:
+            differences = vectors - query
+            return -np.einsum('...j,...j->...', differences, differences)
+        return vectors @ query
+
+    def _search_layer(self, query, entry_points, entry_scores, ef, level):
+        '''
+        Best first search of one layer from entry_points, returning the (up to) ef best nodes found as a list of
+        (score, node), most similar first.
+        '''
+        visited = set(entry_points)
+        candidates = [(-score, node) for score, node in zip(entry_scores, entry_points)]
+        heapq.heapify(candidates)
+        # a min heap of the best ef, so the worst of them is at the top
+        best = [(score, node) for score, node in zip(entry_scores, entry_points)]
+        heapq.heapify(best)
+        while len(best) > ef:
+            heapq.heappop(best)
+
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if -negative_score < best[0][0] and len(best) >= ef:
+                break
+
+            neighbours = [neighbour for neighbour in self._get_links(node, level).tolist() if neighbour not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+
+            # score all the new neighbours in one go
+            scores = self._get_similarities(self._get_vectors(neighbours), query).tolist()
+            for score, neighbour in zip(scores, neighbours):
+                if len(best) < ef or score > best[0][0]:
+                    heapq.heappush(candidates, (-score, neighbour))
+                    heapq.heappush(best, (score, neighbour))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+
+        return sorted(best, reverse=True)
+
+    def _select_neighbours(self, scored_nodes, num_neighbours):
+        '''
+        The heuristic neighbour selection from the HNSW paper: going from most similar, a node is kept only if it is
+        more similar to the base than to any node already kept, which spreads the links out across clusters. If
+        that keeps fewer than num_neighbours, the best of the rest fill the gaps. scored_nodes is a list of
+        (score, node) most similar first.
+        '''
+        if len(scored_nodes) <= num_neighbours:
+            return [node for _, node in scored_nodes]
+
+        nodes = [node for _, node in scored_nodes]
+        vectors = self._get_vectors(nodes)
+        if self.metric == C_METRIC_L2:
+            squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+            pair_similarities = 2 * (vectors @ vectors.T) - squared_norms[:, None] - squared_norms[None, :]
+        else:
+            pair_similarities = vectors @ vectors.T
+
+        # the similarity of each node to the most similar node kept so far
+        best_kept_similarities = np.full(len(nodes), -np.inf, dtype=pair_similarities.dtype)
+        selected = []
+        skipped = []
+        for i, (score, node) in enumerate(scored_nodes):
+            if len(selected) == num_neighbours:
+                break
+            if best_kept_similarities[i] < score:
+                selected.append(i)
+                np.maximum(best_kept_similarities, pair_similarities[:, i], out=best_kept_similarities)
+            else:
+                skipped.append(i)
+        selected += skipped[:num_neighbours - len(selected)]
+        return [nodes[i] for i in sorted(selected)]
+
+    def _reserve(self, num_nodes, num_upper_rows):
+        # grows the link arrays (doubling), which also copies them out of a read only memory map
+        if len(self.layer0_links) < num_nodes or not self.layer0_links.flags.writeable:
+            layer0_links = np.full((max(num_nodes, 2 * len(self.layer0_links)), 2 * self.M), -1, dtype=np.int32)
+            layer0_links[:self.num_nodes] = self.layer0_links[:self.num_nodes]
+            self.layer0_links = layer0_links
+        if len(self.upper_offsets) < num_nodes + 1 or not self.upper_offsets.flags.writeable:
+            upper_offsets = np.zeros(max(num_nodes + 1, 2 * len(self.upper_offsets)), dtype=np.uint64)
+            upper_offsets[:self.num_nodes + 1] = self.upper_offsets[:self.num_nodes + 1]
+            self.upper_offsets = upper_offsets
+        if len(self.upper_links) < num_upper_rows or not self.upper_links.flags.writeable:
+            upper_links = np.full((max(num_upper_rows, 2 * len(self.upper_links)), self.M), -1, dtype=np.int32)
+            upper_links[:self.num_upper_rows] = self.upper_links[:self.num_upper_rows]
+            self.upper_links = upper_links
+
+    def insert(self, node):
+        '''
+        Links the triple with index node into the graph. Nodes have to be inserted in order, so node must be
+        len(self), ie: the next triple in the dumb index.
+        '''
+        if node != self.num_nodes:
+            raise Exception(f"Nodes must be inserted in order (expected {self.num_nodes}, got {node})")
+
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_multiplier)
+        self._reserve(node + 1, self.num_upper_rows + level)
+        self.upper_offsets[node + 1] = self.upper_offsets[node] + level
+        self.num_upper_rows += level
+        self.num_nodes += 1
+
+        if self.entry_point is None:
+            self.entry_point = node
+            return
+
+        query = self._get_vectors([node])[0]
+        max_level = self.get_max_level()
+        entry_points = [self.entry_point]
+        entry_scores = self._get_similarities(self._get_vectors(entry_points), query).tolist()
+
+        # greedy descent through the layers above the new node's
+        for layer in range(max_level, level, -1):
+            scored_nodes = self._search_layer(query, entry_points, entry_scores, 1, layer)
+            entry_scores, entry_points = [scored_nodes[0][0]], [scored_nodes[0][1]]
+
+        for layer in range(min(level, max_level), -1, -1):
+            scored_nodes = self._search_layer(query, entry_points, entry_scores, self.ef_construction, layer)
+            self._set_links(node, layer, self._select_neighbours(scored_nodes, self.M))
+
+            # link back, pruning any neighbour that now has too many links
+            max_links = 2 * self.M if layer == 0 else self.M
+            for neighbour in self._get_links(node, layer).tolist():
+                links = self._get_links(neighbour, layer)
+                if len(links) < max_links:
+                    self._set_links(neighbour, layer, np.append(links, node))
+                else:
+                    candidates = np.append(links, node)
+                    scores = self._get_similarities(self._get_vectors(candidates), self._get_vectors([neighbour])[0])
+                    order = np.argsort(-scores, kind='stable')
+                    scored_candidates = [(float(scores[i]), int(candidates[i])) for i in order]
+                    self._set_links(neighbour, layer, self._select_neighbours(scored_candidates, max_links))
+
+            entry_scores = [score for score, _ in scored_nodes]
+            entry_points = [node for _, node in scored_nodes]
+
+        if level > max_level:
+            self.entry_point = node
+
+    def search(self, vector, k, metric=None, ef_search=None):
+        '''
+        Returns (ids, scores) of the (approximate) top k triples, most similar first. metric, if given, must be the
+        one the graph was built for. ef_search (default the index's) is the number of nodes kept while searching
+        layer 0, at least k.
+        '''
+        if metric is not None and metric != self.metric:
+            raise Exception(f"This HNSW index was built for metric {self.metric}, not {metric}")
+        if self.entry_point is None:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float32)
+
+        query = self._prepare_query(apply_dimension_mask(self.dumb_index, vector))
+        entry_points = [self.entry_point]
+        entry_scores = self._get_similarities(self._get_vectors(entry_points), query).tolist()
+
+        for layer in range(self.get_max_level(), 0, -1):
+            scored_nodes = self._search_layer(query, entry_points, entry_scores, 1, layer)
+            entry_scores, entry_points = [scored_nodes[0][0]], [scored_nodes[0][1]]
+
+        scored_nodes = self._search_layer(query, entry_points, entry_scores, max(k, ef_search or self.ef_search), 0)
+
+        # equal scores are ordered by id, as in the exact search
+        ids = np.asarray([node for _, node in scored_nodes], dtype=np.intp)
+        scores = np.asarray([score for score, _ in scored_nodes], dtype=np.float32)
+        order = np.lexsort((ids, -scores))[:k]
+        return ids[order], scores[order]
+
+    def top_k_similar(self, vector, k, ef_search=None):
+        # the same shape of result as top_k_similar
+        ids, _ = self.search(vector, k, ef_search=ef_search)
+        return {
+            "triples": [self.triples[i] for i in ids.tolist()],
+            "paths": self.dumb_index["paths"],
+            "file_pairs": self.dumb_index["file_pairs"],
+            "dimension_mask": self.dumb_index.get("dimension_mask")
+        }
+
+def create_hnsw_index(dumb_index, metric=C_METRIC_DOT, M=C_HNSW_M, ef_construction=C_HNSW_EF_CONSTRUCTION, ef_search=C_HNSW_EF_SEARCH, rng=None, f_progress=None):
+    # builds an HNSW index by inserting every triple of dumb_index in order
+    hnsw_index = HNSWIndex(dumb_index, metric, M, ef_construction, ef_search, rng=rng)
+    update_hnsw_index(hnsw_index, f_progress=f_progress)
+    return hnsw_index
+
+def update_hnsw_index(hnsw_index, dumb_index=None, f_progress=None):
+    '''
+    Inserts the triples of dumb_index (default the index's own) that the HNSW index doesn't have yet, ie: those after
+    the ones it was built with, as happens when triples are appended to a dumb index. The HNSW index then refers to
+    dumb_index. f_progress, if given, is called with (num inserted, num to insert) every 1000 nodes.
+    '''
+    if dumb_index is not None:
+        hnsw_index._set_dumb_index(dumb_index)
+
+    start = len(hnsw_index)
+    num_triples = len(hnsw_index.triples)
+    for node in range(start, num_triples):
+        hnsw_index.insert(node)
+        if f_progress and (node - start + 1) % 1000 == 0:
+            f_progress(node - start + 1, num_triples - start)
+
+def get_hnsw_index_bytes(hnsw_index):
+    num_nodes = len(hnsw_index)
+    entry_point = C_HNSW_NO_NODE if hnsw_index.entry_point is None else hnsw_index.entry_point
+
+    hnsw_index_bytes = bytearray()
+    hnsw_index_bytes += C_HNSW_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
+    hnsw_index_bytes += C_HNSW_VERSION.to_bytes(4, byteorder='little', signed=False)
+    for value in (
+        C_HNSW_METRICS.index(hnsw_index.metric), num_nodes, hnsw_index.M, hnsw_index.ef_construction,
+        hnsw_index.ef_search, entry_point, hnsw_index.num_upper_rows
+    ):
+        hnsw_index_bytes += value.to_bytes(4, byteorder='little', signed=False)
+    hnsw_index_bytes += bytes(C_HNSW_HEADER_SIZE - len(hnsw_index_bytes))
+
+    for section in (
+        np.asarray(hnsw_index.upper_offsets[:num_nodes + 1], dtype='<u8'),
+        np.asarray(hnsw_index.layer0_links[:num_nodes], dtype='<i4'),
+        np.asarray(hnsw_index.upper_links[:hnsw_index.num_upper_rows], dtype='<i4'),
+    ):
+        hnsw_index_bytes += bytes(align(len(hnsw_index_bytes), C_HNSW_ALIGNMENT) - len(hnsw_index_bytes))
+        hnsw_index_bytes += np.ascontiguousarray(section).tobytes()
+
+    return hnsw_index_bytes
+
+def get_hnsw_index_from_bytes(hnsw_index_bytes, dumb_index):
+    # reverse of get_hnsw_index_bytes. The arrays are views over hnsw_index_bytes (which can be an mmap).
+    hnsw_index_bytes = memoryview(hnsw_index_bytes)
+
+    magic_number = int.from_bytes(hnsw_index_bytes[0:4], byteorder='little', signed=False)
+    if magic_number != C_HNSW_MAGIC_NUMBER:
+        raise Exception("This is not an HNSW index file (magic number not found)")
+    version_number = int.from_bytes(hnsw_index_bytes[4:8], byteorder='little', signed=False)
+    if version_number != C_HNSW_VERSION:
+        raise Exception(f"Version number not supported in HNSW index file (expected {C_HNSW_VERSION}, got {version_number})")
+
+    metric_ix, num_nodes, M, ef_construction, ef_search, entry_point, num_upper_rows = (
+        int.from_bytes(hnsw_index_bytes[offset:offset + 4], byteorder='little', signed=False)
+        for offset in range(8, 36, 4)
+    )
+    if num_nodes > len(get_dumb_index_triples(dumb_index)):
+        raise Exception(f"HNSW index has {num_nodes} nodes but the dumb index only has {len(get_dumb_index_triples(dumb_index))} triples")
+
+    sections = []
+    offset = C_HNSW_HEADER_SIZE
+    for dtype, count in (
+        ('<u8', num_nodes + 1),
+        ('<i4', num_nodes * 2 * M),
+        ('<i4', num_upper_rows * M),
+    ):
+        offset = align(offset, C_HNSW_ALIGNMENT)
+        section = np.frombuffer(hnsw_index_bytes, dtype=dtype, count=count, offset=offset)
+        offset += section.nbytes
+        sections.append(section)
+    upper_offsets, layer0_links, upper_links = sections
+
+    return HNSWIndex(
+        dumb_index, C_HNSW_METRICS[metric_ix], M, ef_construction, ef_search,
+        upper_offsets, layer0_links.reshape(num_nodes, 2 * M), upper_links.reshape(num_upper_rows, M),
+        None if entry_point == C_HNSW_NO_NODE else entry_point
+    )
+
+def write_hnsw_index_to_file(filename, hnsw_index):
+    with open(filename, "wb") as f:
+        f.write(get_hnsw_index_bytes(hnsw_index))
+
+def read_hnsw_index_from_file(filename, dumb_index, use_mmap=True):
+    # with use_mmap only the links a search follows are paged in; inserting copies the links into memory first
+    with open(filename, "rb") as f:
+        if use_mmap:
+            hnsw_index_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            hnsw_index_bytes = f.read()
+    return get_hnsw_index_from_bytes(hnsw_index_bytes, dumb_index)
@@ -0,0 +1,311 @@
+# An inverted file (IVF) index over a dumb index. The vectors are clustered with k-means into num_lists lists, and
+# stored again in list order, so each list's vectors are one contiguous block. A query finds the nprobe centroids
+# most similar to it and only scores the vectors in those lists, so nprobe trades speed for recall: nprobe ==
+# num_lists is an exact (if slower) search.
+#
+# New vectors can be added to an existing index without retraining: they are assigned to the nearest existing
+# centroid and appended to a spare area for that list (which grows by doubling), so adding costs time in proportion
+# to the vectors added rather than the whole index. Searches read both; compact (done when writing) merges the spare
+# areas back into the contiguous blocks.
+#
+# The IVF file sits next to the dumb index file (the dumb index filename with C_IVF_EXTENSION on the end), and is
+# only useful with that dumb index: its ids are the dumb index's triple indices. The index holds a second copy of
+# every vector: for a columnar dumb index in its own vector type (so an int8 index stays int8), for a dict of
+# triples as float32, so memory (and the file) is the dumb index's size again, or more for a dict index of int8
+# looking vectors.
+#
+# File layout (little endian):
+#     header (C_IVF_HEADER_SIZE bytes): magic number, version, num_dimensions, vector_type, num_lists, num_vectors
+#         (all uint32), then zero padding
+#     centroids: num_lists X num_dimensions float32
+#     list offsets: num_lists + 1 uint64, where list i is vectors list_offsets[i] to list_offsets[i + 1]
+#     ids: num_vectors uint32, the triple index of each vector, in list order
+#     vectors: num_vectors X num_dimensions in the dtype for vector_type, in list order
+#     each section starts on a C_IVF_ALIGNMENT boundary
+
+import numpy as np
+import mmap
+from xxxdumb_vector_s3 import apply_dimension_mask, get_dumb_index_triples, dtype_for_vector_type, align, \
+    dumb_vector_array_to_floats, C_VECTORTYPE_FLOAT32, C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2
+from top_k import get_float_vectors
+from kmeans import kmeans, assign_to_centroids
+
+C_IVF_MAGIC_NUMBER = 0xfeedbeef
+C_IVF_VERSION = 0x00000001
+C_IVF_HEADER_SIZE = 64
+C_IVF_ALIGNMENT = 64
+C_IVF_EXTENSION = ".ivf"
+
+C_IVF_NUM_ITERATIONS = 20
+C_IVF_TRAIN_SIZE = 65536
+C_IVF_NPROBE = 8
+
+# vectors are assigned to lists this many at a time
+C_IVF_BLOCK_SIZE = 16384
+
+def get_ivf_index_filename(dumb_index_filename):
+    return dumb_index_filename + C_IVF_EXTENSION
+
+def _get_native_vectors(dumb_index, ids):
+    # the vectors of some triples in the dumb index's own vector type, and that vector type
+    if "triples" in dumb_index:
+        return get_float_vectors(dumb_index, ids).astype(np.float32), C_VECTORTYPE_FLOAT32
+    return dumb_index["vectors"][ids], dumb_index["vector_type"]
+
+def _get_similarities(vectors, query, metric):
+    # the similarities of the rows of vectors to query, higher being more similar (for l2, minus the squared distance)
+    dots = vectors @ query
+    if metric == C_METRIC_DOT:
+        return dots
+    squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+    if metric == C_METRIC_COSINE:
+        magnitudes = np.sqrt(squared_norms) * np.linalg.norm(query)
+        return np.divide(dots, magnitudes, out=np.zeros_like(dots), where=magnitudes != 0)
+    elif metric == C_METRIC_L2:
+        return 2 * dots - squared_norms - np.dot(query, query)
+    else:
+        raise Exception(f"Unknown metric {metric}")
+
+class IVFIndex:
+    '''
+    An IVF index (see the top of this file) over dumb_index (a dict of triples or columnar), which it needs for the
+    dimension mask and the triples.
+    '''
+    def __init__(self, dumb_index, centroids, list_offsets, ids, vectors, vector_type):
+        self.dumb_index = dumb_index
+        self.triples = get_dumb_index_triples(dumb_index)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.vector_type = vector_type
+        # list index -> (ids, vectors, count) of vectors added since the last compact, with spare capacity at the end
+        self.spares = {}
+        self.num_spare_vectors = 0
+
+    def __len__(self):
+        return len(self.ids) + self.num_spare_vectors
+
+    def get_num_lists(self):
+        return len(self.centroids)
+
+    def get_list_sizes(self):
+        list_sizes = np.diff(self.list_offsets).astype(np.intp)
+        for list_ix, (_, _, count) in self.spares.items():
+            list_sizes[list_ix] += count
+        return list_sizes
+
+    def get_list(self, list_ix):
+        # the (ids, vectors) blocks of a list: its contiguous block, then its spare area if it has one
+        start, end = int(self.list_offsets[list_ix]), int(self.list_offsets[list_ix + 1])
+        blocks = [(self.ids[start:end], self.vectors[start:end])]
+        if list_ix in self.spares:
+            spare_ids, spare_vectors, count = self.spares[list_ix]
+            blocks.append((spare_ids[:count], spare_vectors[:count]))
+        return blocks
+
+    def add(self, ids, vectors):
+        '''
+        Adds vectors (in the index's vector type, with the triple indices ids) to the spare areas of the lists of
+        their nearest centroids. The centroids aren't changed.
+        '''
+        ids = np.asarray(ids, dtype=np.uint32)
+        if not len(ids):
+            return
+        assignments, _ = assign_to_centroids(dumb_vector_array_to_floats(vectors, self.vector_type), self.centroids)
+
+        # group the new vectors by list, keeping their order within each list
+        order = np.argsort(assignments, kind='stable')
+        list_ixs, starts = np.unique(assignments[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for list_ix, start, end in zip(list_ixs.tolist(), starts.tolist(), ends.tolist()):
+            self._add_to_spare(list_ix, ids[order[start:end]], vectors[order[start:end]])
+
+    def _add_to_spare(self, list_ix, ids, vectors):
+        spare_ids, spare_vectors, count = self.spares.get(list_ix, (self.ids[:0], self.vectors[:0], 0))
+        if count + len(ids) > len(spare_ids):
+            capacity = max(count + len(ids), 2 * len(spare_ids))
+            new_spare_ids = np.empty(capacity, dtype=np.uint32)
+            new_spare_ids[:count] = spare_ids[:count]
+            new_spare_vectors = np.empty((capacity, self.vectors.shape[1]), dtype=self.vectors.dtype)
+            new_spare_vectors[:count] = spare_vectors[:count]
+            spare_ids, spare_vectors = new_spare_ids, new_spare_vectors
+
+        spare_ids[count:count + len(ids)] = ids
+        spare_vectors[count:count + len(ids)] = vectors
+        self.spares[list_ix] = (spare_ids, spare_vectors, count + len(ids))
+        self.num_spare_vectors += len(ids)
+
+    def compact(self):
+        # merges the spare areas into the contiguous lists (one copy of the whole index)
+        if not self.spares:
+            return
+        blocks = [self.get_list(list_ix) for list_ix in range(self.get_num_lists())]
+        self.list_offsets = np.concatenate([[0], np.cumsum(self.get_list_sizes())]).astype(np.uint64)
+        self.ids = np.concatenate([ids for list_blocks in blocks for ids, _ in list_blocks])
+        self.vectors = np.concatenate([vectors for list_blocks in blocks for _, vectors in list_blocks])
+        self.spares = {}
+        self.num_spare_vectors = 0
+
+    def search(self, vector, k, metric=C_METRIC_DOT, nprobe=C_IVF_NPROBE):
+        '''
+        Returns (ids, scores) of the top k triples found in the nprobe lists whose centroids are most similar to the
+        query (by metric), most similar first. For C_METRIC_L2 the score is the negative squared distance.
+        '''
+        query = np.asarray(apply_dimension_mask(self.dumb_index, vector), dtype=np.float32)
+
+        centroid_scores = _get_similarities(self.centroids, query, metric)
+        nprobe = min(nprobe, self.get_num_lists())
+        probe_lists = np.argsort(-centroid_scores, kind='stable')[:nprobe]
+
+        candidate_ids = []
+        candidate_scores = []
+        for list_ix in probe_lists.tolist():
+            for ids, vectors in self.get_list(list_ix):
+                if not len(ids):
+                    continue
+                vectors = dumb_vector_array_to_floats(vectors, self.vector_type).astype(np.float32)
+                candidate_ids.append(ids.astype(np.intp))
+                candidate_scores.append(_get_similarities(vectors, query, metric))
+
+        if not candidate_ids:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float32)
+
+        # equal scores are ordered by id, as in the exact search
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        order = np.lexsort((ids, -scores))[:k]
+        return ids[order], scores[order]
+
+    def top_k_similar(self, vector, k, metric=C_METRIC_DOT, nprobe=C_IVF_NPROBE):
+        # the same shape of result as top_k_similar
+        ids, _ = self.search(vector, k, metric, nprobe)
+        return {
+            "triples": [self.triples[i] for i in ids.tolist()],
+            "paths": self.dumb_index["paths"],
+            "file_pairs": self.dumb_index["file_pairs"],
+            "dimension_mask": self.dumb_index.get("dimension_mask")
+        }
+
+def create_ivf_index(dumb_index, num_lists, num_iterations=C_IVF_NUM_ITERATIONS, train_size=C_IVF_TRAIN_SIZE, rng=None):
+    '''
+    Builds an IVF index over dumb_index: the centroids are trained on up to train_size randomly chosen vectors, then
+    every vector is assigned to a list, a block at a time.
+    '''
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    triples = get_dumb_index_triples(dumb_index)
+    if not len(triples):
+        raise Exception("Can't build an IVF index over an empty dumb index")
+
+    train_ids = np.sort(rng.choice(len(triples), min(train_size, len(triples)), replace=False))
+    centroids, _ = kmeans(get_float_vectors(dumb_index, train_ids), num_lists, num_iterations, rng)
+
+    _, vector_type = _get_native_vectors(dumb_index, np.zeros(0, dtype=np.intp))
+    ivf_index = IVFIndex(
+        dumb_index, centroids, np.zeros(len(centroids) + 1, dtype=np.uint64), np.zeros(0, dtype=np.uint32),
+        np.zeros((0, centroids.shape[1]), dtype=dtype_for_vector_type(vector_type)), vector_type
+    )
+    update_ivf_index(ivf_index)
+    ivf_index.compact()
+    return ivf_index
+
+def update_ivf_index(ivf_index, dumb_index=None, block_size=C_IVF_BLOCK_SIZE):
+    '''
+    Adds the triples of dumb_index (default the index's own) that the IVF index doesn't have yet, ie: those after
+    the ones it was built with, as happens when triples are appended to a dumb index. They are assigned to the
+    existing centroids. The IVF index then refers to dumb_index.
+    '''
+    if dumb_index is not None:
+        ivf_index.dumb_index = dumb_index
+        ivf_index.triples = get_dumb_index_triples(dumb_index)
+
+    num_triples = len(ivf_index.triples)
+    new_ids = []
+    new_vectors = []
+    for start in range(len(ivf_index), num_triples, block_size):
+        ids = np.arange(start, min(start + block_size, num_triples))
+        vectors, _ = _get_native_vectors(ivf_index.dumb_index, ids)
+        new_ids.append(ids)
+        new_vectors.append(vectors)
+
+    if new_ids:
+        ivf_index.add(np.concatenate(new_ids), np.concatenate(new_vectors))
+
+def get_ivf_index_bytes(ivf_index):
+    # compacts the index first, as the file only has contiguous lists
+    ivf_index.compact()
+    num_dimensions = ivf_index.centroids.shape[1]
+
+    ivf_index_bytes = bytearray()
+    ivf_index_bytes += C_IVF_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += C_IVF_VERSION.to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += num_dimensions.to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += ivf_index.vector_type.to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += ivf_index.get_num_lists().to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += len(ivf_index).to_bytes(4, byteorder='little', signed=False)
+    ivf_index_bytes += bytes(C_IVF_HEADER_SIZE - len(ivf_index_bytes))
+
+    for section in (
+        np.asarray(ivf_index.centroids, dtype='<f4'),
+        np.asarray(ivf_index.list_offsets, dtype='<u8'),
+        np.asarray(ivf_index.ids, dtype='<u4'),
+        np.asarray(ivf_index.vectors, dtype=dtype_for_vector_type(ivf_index.vector_type)),
+    ):
+        ivf_index_bytes += bytes(align(len(ivf_index_bytes), C_IVF_ALIGNMENT) - len(ivf_index_bytes))
+        ivf_index_bytes += np.ascontiguousarray(section).tobytes()
+
+    return ivf_index_bytes
+
+def get_ivf_index_from_bytes(ivf_index_bytes, dumb_index):
+    # reverse of get_ivf_index_bytes. The arrays are views over ivf_index_bytes (which can be an mmap).
+    ivf_index_bytes = memoryview(ivf_index_bytes)
+
+    magic_number = int.from_bytes(ivf_index_bytes[0:4], byteorder='little', signed=False)
+    if magic_number != C_IVF_MAGIC_NUMBER:
+        raise Exception("This is not an IVF index file (magic number not found)")
+    version_number = int.from_bytes(ivf_index_bytes[4:8], byteorder='little', signed=False)
+    if version_number != C_IVF_VERSION:
+        raise Exception(f"Version number not supported in IVF index file (expected {C_IVF_VERSION}, got {version_number})")
+
+    num_dimensions, vector_type, num_lists, num_vectors = (
+        int.from_bytes(ivf_index_bytes[offset:offset + 4], byteorder='little', signed=False)
+        for offset in range(8, 24, 4)
+    )
+
+    sections = []
+    offset = C_IVF_HEADER_SIZE
+    for dtype, count in (
+        ('<f4', num_lists * num_dimensions),
+        ('<u8', num_lists + 1),
+        ('<u4', num_vectors),
+        (dtype_for_vector_type(vector_type), num_vectors * num_dimensions),
+    ):
+        offset = align(offset, C_IVF_ALIGNMENT)
+        section = np.frombuffer(ivf_index_bytes, dtype=dtype, count=count, offset=offset)
+        offset += section.nbytes
+        sections.append(section)
+    centroids, list_offsets, ids, vectors = sections
+
+    if num_vectors > len(get_dumb_index_triples(dumb_index)):
+        raise Exception(f"IVF index has {num_vectors} vectors but the dumb index only has {len(get_dumb_index_triples(dumb_index))} triples")
+
+    return IVFIndex(
+        dumb_index, centroids.reshape(num_lists, num_dimensions), list_offsets, ids,
+        vectors.reshape(num_vectors, num_dimensions), vector_type
+    )
+
+def write_ivf_index_to_file(filename, ivf_index):
+    with open(filename, "wb") as f:
+        f.write(get_ivf_index_bytes(ivf_index))
+
+def read_ivf_index_from_file(filename, dumb_index, use_mmap=True):
+    # with use_mmap only the lists that are probed are paged in from the file. If triples have been appended to the
+    # dumb index since the IVF index was written, update_ivf_index adds them.
+    with open(filename, "rb") as f:
+        if use_mmap:
+            ivf_index_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            ivf_index_bytes = f.read()
+    return get_ivf_index_from_bytes(ivf_index_bytes, dumb_index)
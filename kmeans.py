@@ -0,0 +1,64 @@
+import numpy as np
+
+# distances from vectors to centroids are worked out this many vectors at a time
+C_KMEANS_BLOCK_SIZE = 8192
+
+def assign_to_centroids(vectors, centroids, block_size=C_KMEANS_BLOCK_SIZE):
+    '''
+    Returns (assignments, squared distances): the index of the nearest centroid (by euclidean distance) to each
+    vector, and the squared distance to it. vectors is N X D and centroids is K X D.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = np.asarray(centroids, dtype=np.float32)
+    centroid_squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+    assignments = np.empty(len(vectors), dtype=np.intp)
+    squared_distances = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 doesn't change which c is nearest
+        block_distances = centroid_squared_norms - 2 * (block @ centroids.T)
+        block_assignments = np.argmin(block_distances, axis=1)
+        assignments[start:start + len(block)] = block_assignments
+        squared_distances[start:start + len(block)] = np.maximum(
+            np.take_along_axis(block_distances, block_assignments[:, None], axis=1)[:, 0] + np.einsum('ij,ij->i', block, block), 0
+        )
+
+    return assignments, squared_distances
+
+def kmeans(vectors, num_centroids, num_iterations=20, rng=None, block_size=C_KMEANS_BLOCK_SIZE):
+    '''
+    Lloyd's k-means over the rows of vectors (N X D). Starts from num_centroids distinct random rows, and any
+    centroid that ends up with no vectors is moved to the vector furthest from its centroid. Stops early if no
+    assignment changes. Returns (centroids, assignments), the centroids being a num_centroids X D float32 array.
+    num_centroids is cut down to N if there are fewer vectors than that.
+    '''
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    num_centroids = min(num_centroids, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)].copy()
+
+    assignments = None
+    for _ in range(num_iterations):
+        new_assignments, squared_distances = assign_to_centroids(vectors, centroids, block_size)
+        if assignments is not None and (new_assignments == assignments).all():
+            break
+        assignments = new_assignments
+
+        # sum the vectors of each centroid in one pass, by sorting them by centroid
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=num_centroids)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        non_empty = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[non_empty], axis=0)
+        centroids[non_empty] = sums / counts[non_empty][:, None]
+
+        # reseed empty centroids with the worst fitting vectors
+        num_empty = num_centroids - int(non_empty.sum())
+        if num_empty:
+            furthest = np.argsort(-squared_distances, kind='stable')[:num_empty]
+            centroids[~non_empty] = vectors[furthest]
+
+    return centroids, assign_to_centroids(vectors, centroids, block_size)[0]
@@ -0,0 +1,246 @@
+# A product quantization (PQ) index over a dumb index. Each vector is split into num_subspaces sub-vectors, and each
+# sub-vector is replaced by the index (one byte) of the nearest of num_centroids centroids trained for that subspace
+# with k-means. A 1536 dimension vector with 96 subspaces takes 96 bytes.
+#
+# A query is answered by working out, for each subspace, the similarity of the query's sub-vector to every centroid
+# (a num_subspaces X num_centroids table), after which the similarity to any vector is the sum of num_subspaces table
+# lookups. The top candidates can then be re-ranked exactly against the dumb index's own vectors.
+#
+# The PQ file sits next to the dumb index file (the dumb index filename with C_PQ_EXTENSION on the end), and is only
+# useful with that dumb index: its ids are the dumb index's triple indices.
+#
+# File layout (little endian):
+#     header (C_PQ_HEADER_SIZE bytes): magic number, version, num_dimensions, num_subspaces, num_centroids,
+#         subspace_dims, num_vectors (all uint32), then zero padding
+#     codebooks: num_subspaces X num_centroids X subspace_dims float32
+#     codes: num_subspaces X num_vectors uint8 (a row of codes per subspace, so each lookup pass reads contiguously),
+#         starting on a C_PQ_ALIGNMENT boundary
+
+import numpy as np
+import mmap
+from xxxdumb_vector_s3 import apply_dimension_mask, get_dumb_index_triples, align, \
+    C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2
+from top_k import get_float_vectors, top_k_order, yield_vector_blocks_from_columnar_dumb_index
+from kmeans import kmeans, assign_to_centroids
+
+C_PQ_MAGIC_NUMBER = 0xfeedf00d
+C_PQ_VERSION = 0x00000001
+C_PQ_HEADER_SIZE = 64
+C_PQ_ALIGNMENT = 64
+C_PQ_EXTENSION = ".pq"
+
+C_PQ_NUM_CENTROIDS = 256
+C_PQ_NUM_ITERATIONS = 20
+C_PQ_TRAIN_SIZE = 65536
+
+# vectors are encoded this many at a time
+C_PQ_BLOCK_SIZE = 16384
+
+def get_pq_index_filename(dumb_index_filename):
+    return dumb_index_filename + C_PQ_EXTENSION
+
+def _split_subspaces(vectors, num_subspaces, subspace_dims):
+    # N X D vectors as N X num_subspaces X subspace_dims, zero padding the dimensions if D doesn't divide evenly
+    vectors = np.asarray(vectors, dtype=np.float32)
+    padding = num_subspaces * subspace_dims - vectors.shape[1]
+    if padding:
+        vectors = np.pad(vectors, ((0, 0), (0, padding)))
+    return vectors.reshape(len(vectors), num_subspaces, subspace_dims)
+
+def _yield_float_blocks(dumb_index, block_size=C_PQ_BLOCK_SIZE):
+    # (start, float vectors) for a dumb index a block at a time, so a memory mapped index isn't read in all at once
+    if "triples" not in dumb_index:
+        yield from yield_vector_blocks_from_columnar_dumb_index(dumb_index, block_size)
+        return
+    triples = dumb_index["triples"]
+    for start in range(0, len(triples), block_size):
+        yield start, np.asarray([triple[0] for triple in triples[start:start + block_size]], dtype=np.float32)
+
+def train_pq_codebooks(vectors, num_subspaces, num_centroids=C_PQ_NUM_CENTROIDS, num_iterations=C_PQ_NUM_ITERATIONS, rng=None):
+    # k-means in each subspace of some (training) vectors. Returns num_subspaces X num_centroids X subspace_dims.
+    if rng is None:
+        rng = np.random.default_rng(0)
+    num_centroids = min(num_centroids, len(vectors))
+    subspace_dims = -(-vectors.shape[1] // num_subspaces)
+    subvectors = _split_subspaces(vectors, num_subspaces, subspace_dims)
+
+    codebooks = np.empty((num_subspaces, num_centroids, subspace_dims), dtype=np.float32)
+    for subspace in range(num_subspaces):
+        codebooks[subspace], _ = kmeans(subvectors[:, subspace, :], num_centroids, num_iterations, rng)
+    return codebooks
+
+def encode_pq(vectors, codebooks):
+    # the codes (num_subspaces X N uint8) of some vectors: the nearest centroid in each subspace
+    num_subspaces, _, subspace_dims = codebooks.shape
+    subvectors = _split_subspaces(vectors, num_subspaces, subspace_dims)
+    codes = np.empty((num_subspaces, len(subvectors)), dtype=np.uint8)
+    for subspace in range(num_subspaces):
+        codes[subspace], _ = assign_to_centroids(subvectors[:, subspace, :], codebooks[subspace])
+    return codes
+
+class PQIndex:
+    '''
+    A PQ index (see the top of this file) over dumb_index (a dict of triples or columnar), which it needs for the
+    dimension mask, exact re-ranking and the triples.
+    '''
+    def __init__(self, dumb_index, num_dimensions, codebooks, codes):
+        self.dumb_index = dumb_index
+        self.triples = get_dumb_index_triples(dumb_index)
+        self.num_dimensions = num_dimensions
+        self.codebooks = codebooks
+        self.codes = codes
+        self.num_subspaces, self.num_centroids, self.subspace_dims = codebooks.shape
+
+        # squared magnitudes of each centroid, and of each vector as the codes have it, for cosine and l2
+        self.centroid_squared_norms = np.einsum('mkd,mkd->mk', codebooks, codebooks)
+        self.squared_norms = self._sum_lookups(self.centroid_squared_norms)
+
+    def __len__(self):
+        return self.codes.shape[1]
+
+    def get_num_bytes_per_vector(self):
+        return self.num_subspaces
+
+    def _sum_lookups(self, tables):
+        # sum over the subspaces of each vector's entry in tables (num_subspaces X num_centroids)
+        sums = np.zeros(len(self), dtype=np.float32)
+        lookups = np.empty(len(self), dtype=np.float32)
+        for subspace in range(self.num_subspaces):
+            np.take(tables[subspace], self.codes[subspace], out=lookups)
+            sums += lookups
+        return sums
+
+    def get_distance_tables(self, query, metric=C_METRIC_DOT):
+        # the num_subspaces X num_centroids table of similarities between each query sub-vector and each centroid
+        subqueries = _split_subspaces(query[None, :], self.num_subspaces, self.subspace_dims)[0]
+        dots = np.einsum('mkd,md->mk', self.codebooks, subqueries)
+        if metric == C_METRIC_L2:
+            # -|q - c|^2, split by subspace
+            return 2 * dots - self.centroid_squared_norms - np.einsum('md,md->m', subqueries, subqueries)[:, None]
+        return dots
+
+    def search(self, vector, k, metric=C_METRIC_DOT, rerank=0):
+        '''
+        Returns (ids, scores) of the top k triples, most similar first (for C_METRIC_L2, the score is the negative
+        squared distance). With rerank, the top max(rerank, k) by PQ score are re-scored against the dumb index's
+        vectors, and the best k of those returned with their exact scores.
+        '''
+        if metric not in (C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2):
+            raise Exception(f"Unknown metric {metric}")
+
+        query = np.asarray(apply_dimension_mask(self.dumb_index, vector), dtype=np.float32)
+        scores = self._sum_lookups(self.get_distance_tables(query, metric))
+        if metric == C_METRIC_COSINE:
+            magnitudes = np.sqrt(self.squared_norms) * np.linalg.norm(query)
+            scores = np.divide(scores, magnitudes, out=np.zeros_like(scores), where=magnitudes != 0)
+
+        ids = top_k_order(scores, max(rerank, k))
+        if not rerank:
+            return ids, scores[ids]
+
+        # in id order, so ties stay in id order
+        ids = np.sort(ids)
+        vectors = get_float_vectors(self.dumb_index, ids)
+        query = query.astype(np.float64)
+        exact_scores = vectors @ query
+        if metric == C_METRIC_COSINE:
+            magnitudes = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            exact_scores = np.divide(exact_scores, magnitudes, out=np.zeros_like(exact_scores), where=magnitudes != 0)
+        elif metric == C_METRIC_L2:
+            exact_scores = 2 * exact_scores - np.einsum('ij,ij->i', vectors, vectors) - np.dot(query, query)
+
+        order = top_k_order(exact_scores, k)
+        return ids[order], exact_scores[order]
+
+    def top_k_similar(self, vector, k, metric=C_METRIC_DOT, rerank=0):
+        # the same shape of result as top_k_similar
+        ids, _ = self.search(vector, k, metric, rerank)
+        return {
+            "triples": [self.triples[i] for i in ids.tolist()],
+            "paths": self.dumb_index["paths"],
+            "file_pairs": self.dumb_index["file_pairs"],
+            "dimension_mask": self.dumb_index.get("dimension_mask")
+        }
+
+def create_pq_index(dumb_index, num_subspaces, num_centroids=C_PQ_NUM_CENTROIDS, num_iterations=C_PQ_NUM_ITERATIONS, train_size=C_PQ_TRAIN_SIZE, rng=None):
+    '''
+    Builds a PQ index over dumb_index: the codebooks are trained on up to train_size randomly chosen vectors, then
+    every vector is encoded, a block at a time. num_centroids can be at most 256, as codes are one byte.
+    '''
+    if num_centroids > 256:
+        raise Exception("num_centroids must be at most 256")
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    triples = get_dumb_index_triples(dumb_index)
+    if not len(triples):
+        raise Exception("Can't build a PQ index over an empty dumb index")
+
+    train_ids = np.sort(rng.choice(len(triples), min(train_size, len(triples)), replace=False))
+    train_vectors = get_float_vectors(dumb_index, train_ids).astype(np.float32)
+    num_dimensions = train_vectors.shape[1]
+    codebooks = train_pq_codebooks(train_vectors, num_subspaces, num_centroids, num_iterations, rng)
+
+    codes = np.empty((num_subspaces, len(triples)), dtype=np.uint8)
+    for start, vectors in _yield_float_blocks(dumb_index):
+        codes[:, start:start + len(vectors)] = encode_pq(vectors, codebooks)
+
+    return PQIndex(dumb_index, num_dimensions, codebooks, codes)
+
+def get_pq_index_bytes(pq_index):
+    pq_index_bytes = bytearray()
+    pq_index_bytes += C_PQ_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += C_PQ_VERSION.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += pq_index.num_dimensions.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += pq_index.num_subspaces.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += pq_index.num_centroids.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += pq_index.subspace_dims.to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += len(pq_index).to_bytes(4, byteorder='little', signed=False)
+    pq_index_bytes += bytes(C_PQ_HEADER_SIZE - len(pq_index_bytes))
+
+    pq_index_bytes += np.ascontiguousarray(pq_index.codebooks, dtype='<f4').tobytes()
+    pq_index_bytes += bytes(align(len(pq_index_bytes), C_PQ_ALIGNMENT) - len(pq_index_bytes))
+    pq_index_bytes += np.ascontiguousarray(pq_index.codes).tobytes()
+
+    return pq_index_bytes
+
+def get_pq_index_from_bytes(pq_index_bytes, dumb_index):
+    # reverse of get_pq_index_bytes. The codebooks and codes are views over pq_index_bytes (which can be an mmap).
+    pq_index_bytes = memoryview(pq_index_bytes)
+
+    magic_number = int.from_bytes(pq_index_bytes[0:4], byteorder='little', signed=False)
+    if magic_number != C_PQ_MAGIC_NUMBER:
+        raise Exception("This is not a PQ index file (magic number not found)")
+    version_number = int.from_bytes(pq_index_bytes[4:8], byteorder='little', signed=False)
+    if version_number != C_PQ_VERSION:
+        raise Exception(f"Version number not supported in PQ index file (expected {C_PQ_VERSION}, got {version_number})")
+
+    num_dimensions, num_subspaces, num_centroids, subspace_dims, num_vectors = (
+        int.from_bytes(pq_index_bytes[offset:offset + 4], byteorder='little', signed=False)
+        for offset in range(8, 28, 4)
+    )
+
+    offset = C_PQ_HEADER_SIZE
+    codebooks = np.frombuffer(pq_index_bytes, dtype='<f4', count=num_subspaces * num_centroids * subspace_dims, offset=offset)
+    codebooks = codebooks.reshape(num_subspaces, num_centroids, subspace_dims)
+    offset = align(offset + codebooks.nbytes, C_PQ_ALIGNMENT)
+    codes = np.frombuffer(pq_index_bytes, dtype=np.uint8, count=num_subspaces * num_vectors, offset=offset)
+    codes = codes.reshape(num_subspaces, num_vectors)
+
+    if num_vectors != len(get_dumb_index_triples(dumb_index)):
+        raise Exception(f"PQ index has {num_vectors} vectors but the dumb index has {len(get_dumb_index_triples(dumb_index))}")
+
+    return PQIndex(dumb_index, num_dimensions, codebooks, codes)
+
+def write_pq_index_to_file(filename, pq_index):
+    with open(filename, "wb") as f:
+        f.write(get_pq_index_bytes(pq_index))
+
+def read_pq_index_from_file(filename, dumb_index, use_mmap=True):
+    # with use_mmap the codes are paged in from the file as they are used
+    with open(filename, "rb") as f:
+        if use_mmap:
+            pq_index_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            pq_index_bytes = f.read()
+    return get_pq_index_from_bytes(pq_index_bytes, dumb_index)
@@ -6,6 +6,9 @@ from dumbvector.util import time_function
 from dumbvector.dumb_index import file_to_dumb_index, docs_from_dumb_index
 from dumbvector.docs import get_docs_file_and_cache_reader
 from dumbvector.search import top_k_similar
+import top_k
+from hnsw_index import read_hnsw_index_from_file, get_hnsw_index_filename
+from ivf_index import read_ivf_index_from_file, get_ivf_index_filename, C_IVF_NPROBE
 
 # from top_k import top_k_similar
 # from cupy_top_k import cupy_top_k_similar
@@ -20,7 +23,7 @@ def read_credentials():
         return json.load(f)
 
 def main():
-    # usage: python search_index.py index_filename docs_path query [num_results]
+    # usage: python search_index.py index_filename docs_path query [num_results] [--backend exact|hnsw|ivf] [--hnsw_filename F] [--ef_search N] [--ivf_filename F] [--nprobe N]
 
     parser = argparse.ArgumentParser()
 
@@ -29,6 +32,11 @@ def main():
     parser.add_argument('query', help='the query to search for')
     # default to 20 results
     parser.add_argument('num_results', help='the number of results to return', nargs='?', default=20)
+    parser.add_argument('--backend', help='exact searches every vector; hnsw searches an HNSW graph built with create_hnsw_index.py; ivf searches the nearest lists of an IVF index built with create_ivf_index.py', choices=['exact', 'hnsw', 'ivf'], default='exact')
+    parser.add_argument('--hnsw_filename', help='the HNSW index file (default the index filename with .hnsw on the end)')
+    parser.add_argument('--ef_search', help='number of nodes the HNSW search keeps (more is slower but finds more)', type=int)
+    parser.add_argument('--ivf_filename', help='the IVF index file (default the index filename with .ivf on the end)')
+    parser.add_argument('--nprobe', help='number of IVF lists to search (more is slower but finds more)', type=int, default=C_IVF_NPROBE)
 
     args = parser.parse_args()
 
@@ -67,8 +75,26 @@ def main():
 
     docs_reader = get_docs_file_and_cache_reader(docs_path)
 
+    search = top_k_similar
+    if args.backend == 'hnsw':
+        hnsw_filename = args.hnsw_filename or get_hnsw_index_filename(index_filename)
+        dumb_index = top_k.get_columnar_dumb_index_from_dumbvector_index(index)
+        hnsw_index = time_function(read_hnsw_index_from_file, f"load the HNSW index '{hnsw_filename}' from filesystem")(hnsw_filename, dumb_index)
+        if args.ef_search:
+            hnsw_index.ef_search = args.ef_search
+
+        def search(index, embedding, k):
+            return top_k.get_dumbvector_index_from_top_k(index, top_k.top_k_similar(hnsw_index, embedding, k))
+    elif args.backend == 'ivf':
+        ivf_filename = args.ivf_filename or get_ivf_index_filename(index_filename)
+        dumb_index = top_k.get_columnar_dumb_index_from_dumbvector_index(index)
+        ivf_index = time_function(read_ivf_index_from_file, f"load the IVF index '{ivf_filename}' from filesystem")(ivf_filename, dumb_index)
+
+        def search(index, embedding, k):
+            return top_k.get_dumbvector_index_from_top_k(index, ivf_index.top_k_similar(embedding, k, nprobe=args.nprobe))
+
     # do the basic search
-    sorted_index = time_function(top_k_similar, f"Find the top {num_results} results using cosine similarity")(index, embedding, num_results)
+    sorted_index = time_function(search, f"Find the top {num_results} results using cosine similarity ({args.backend})")(index, embedding, num_results)
 
     # now get the Docs of results
     docs = time_function(docs_from_dumb_index, f"load the original docs from filesystem")(sorted_index, docs_reader, 0, num_results)
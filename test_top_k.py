@@ -0,0 +1,44 @@
+# run with: python -m pytest test_top_k.py
+
+import numpy as np
+from top_k import PreparedDumbIndex, top_k_order
+from xxxdumb_vector_s3 import C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2
+
+def create_dumb_index_with_duplicates(num_vectors=3000, num_dimensions=96, num_distinct=40, seed=0):
+    # lots of exact duplicate vectors, so the kth place is almost always a tie
+    rng = np.random.default_rng(seed)
+    distinct_vectors = rng.normal(size=(num_distinct, num_dimensions))
+    vectors = distinct_vectors[rng.integers(0, num_distinct, num_vectors)]
+    return {
+        "triples": [(vector.tolist(), 0, chunkix) for chunkix, vector in enumerate(vectors)],
+        "paths": [""],
+        "file_pairs": [(0, "test.json")],
+    }, rng
+
+def test_top_k_order_breaks_ties_by_index():
+    scores = np.array([1.0, 3.0, 2.0, 3.0, 2.0, 2.0, 3.0])
+    assert top_k_order(scores, 4).tolist() == [1, 3, 6, 2]
+    assert top_k_order(scores, 5).tolist() == [1, 3, 6, 2, 4]
+
+def test_search_batch_matches_search_with_duplicates():
+    dumb_index, rng = create_dumb_index_with_duplicates()
+    queries = rng.normal(size=(25, 96))
+    for dtype in (np.float32, np.float64):
+        prepared_dumb_index = PreparedDumbIndex(dumb_index, dtype=dtype)
+        for metric in (C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2):
+            batch_ids, batch_scores = prepared_dumb_index.search_batch(queries, 37, metric)
+            for query, ids, scores in zip(queries, batch_ids, batch_scores):
+                single_ids, single_scores = prepared_dumb_index.search(query, 37, metric)
+                assert ids.tolist() == single_ids.tolist()
+                assert scores.tolist() == single_scores.tolist()
+
+def test_sharded_search_matches_search_with_duplicates():
+    dumb_index, rng = create_dumb_index_with_duplicates()
+    prepared_dumb_index = PreparedDumbIndex(dumb_index)
+    with PreparedDumbIndex(dumb_index, max_workers=3) as sharded_dumb_index:
+        # the threads aren't started until they're needed
+        assert sharded_dumb_index.executor is None
+        for query in rng.normal(size=(10, 96)):
+            for metric in (C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2):
+                assert sharded_dumb_index.search(query, 37, metric)[0].tolist() == prepared_dumb_index.search(query, 37, metric)[0].tolist()
+    assert sharded_dumb_index.executor is None
@@ -0,0 +1,189 @@
+# run with: python -m pytest test_xxxdumb_vector_s3.py
+# S3 is moto's in memory stand-in, so no AWS account is needed.
+
+import boto3
+import botocore
+import numpy as np
+import os
+import pytest
+import threading
+from moto import mock_aws
+import xxxdumb_vector_s3
+from xxxdumb_vector_s3 import get_s3_client, _write_pieces_to_s3, write_dumb_index_to_s3, read_dumb_index_from_s3, read_dumb_index_from_s3_by_ranges, \
+    read_dumb_index_header_from_s3, read_chunk_from_s3, close_s3_clients, ChunkCache, DiskChunkCache, C_VERSION_1, C_VERSION_2, C_VECTORTYPE_FLOAT32
+
+C_TEST_BUCKET = "test-bucket"
+
+@pytest.fixture
+def boto3_session():
+    with mock_aws():
+        boto3_session = boto3.Session(region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+        boto3_session.client("s3").create_bucket(Bucket=C_TEST_BUCKET)
+        yield boto3_session
+        close_s3_clients(boto3_session)
+
+def create_dumb_index(num_vectors=500, num_dimensions=16, dimension_mask=None, seed=0):
+    # vectors are from -1 to 1, so they survive any vector type. With a mask the vectors only have the kept dimensions.
+    rng = np.random.default_rng(seed)
+    num_kept_dimensions = sum(dimension_mask) if dimension_mask is not None else num_dimensions
+    vectors = rng.uniform(-1, 1, (num_vectors, num_kept_dimensions))
+    return {
+        "triples": [(vector.tolist(), chunkix % 3, chunkix) for chunkix, vector in enumerate(vectors)],
+        "paths": ["a", "b/c"],
+        "file_pairs": [(0, "one.json"), (1, "two.json"), (1, "three.chunks")],
+        "dimension_mask": dimension_mask
+    }
+
+@pytest.mark.parametrize("version_number", [C_VERSION_1, C_VERSION_2])
+@pytest.mark.parametrize("dimension_mask", [None, [1, 0] * 8])
+def test_read_dumb_index_by_ranges_matches_read_dumb_index(boto3_session, version_number, dimension_mask):
+    dumb_index = create_dumb_index(dimension_mask=dimension_mask)
+    num_dimensions = len(dumb_index["triples"][0][0])
+    write_dumb_index_to_s3(boto3_session, C_TEST_BUCKET, "indexes", "test.index", dumb_index, C_VECTORTYPE_FLOAT32, num_dimensions, version_number)
+
+    dumb_index_header = read_dumb_index_header_from_s3(boto3_session, C_TEST_BUCKET, "indexes", "test.index")
+    assert dumb_index_header["num_triples"] == len(dumb_index["triples"])
+
+    whole_dumb_index = read_dumb_index_from_s3(boto3_session, C_TEST_BUCKET, "indexes", "test.index")
+    # a small range size, so the triples come back in many concurrent pieces
+    ranged_dumb_index = read_dumb_index_from_s3_by_ranges(boto3_session, C_TEST_BUCKET, "indexes", "test.index", range_size=1000, max_workers=4)
+
+    assert ranged_dumb_index["paths"] == whole_dumb_index["paths"] == dumb_index["paths"]
+    assert [tuple(file_pair) for file_pair in ranged_dumb_index["file_pairs"]] == [tuple(file_pair) for file_pair in whole_dumb_index["file_pairs"]]
+    assert ranged_dumb_index["dimension_mask"] == whole_dumb_index["dimension_mask"]
+    assert len(ranged_dumb_index["triples"]) == len(whole_dumb_index["triples"])
+    for ranged_triple, whole_triple in zip(ranged_dumb_index["triples"], whole_dumb_index["triples"]):
+        assert list(ranged_triple[0]) == list(whole_triple[0])
+        assert tuple(ranged_triple[1:]) == tuple(whole_triple[1:])
+
+def test_read_dumb_index_by_ranges_missing(boto3_session):
+    assert read_dumb_index_header_from_s3(boto3_session, C_TEST_BUCKET, "indexes", "missing.index") is None
+    assert read_dumb_index_from_s3_by_ranges(boto3_session, C_TEST_BUCKET, "indexes", "missing.index") is None
+
+def fail_upload_parts(monkeypatch, s3_client, num_failures_by_part_number):
+    # makes upload_part fail the given number of times for each part number, then behave. Returns the attempts made.
+    upload_part = s3_client.upload_part
+    attempts = {}
+    lock = threading.Lock()
+
+    def failing_upload_part(**kwargs):
+        part_number = kwargs["PartNumber"]
+        with lock:
+            attempts[part_number] = attempts.get(part_number, 0) + 1
+            failing = attempts[part_number] <= num_failures_by_part_number.get(part_number, 0)
+        if failing:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "InternalError", "Message": "injected"}}, "UploadPart")
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3_client, "upload_part", failing_upload_part)
+    monkeypatch.setattr(xxxdumb_vector_s3, "C_S3_RETRY_BACKOFF", 0)
+    return attempts
+
+def create_pieces(num_bytes, piece_size=1024 * 1024, seed=0):
+    data = np.random.default_rng(seed).integers(0, 256, num_bytes, dtype=np.uint8).tobytes()
+    return data, [data[start:start + piece_size] for start in range(0, len(data), piece_size)]
+
+def test_write_pieces_retries_a_failed_part(boto3_session, monkeypatch):
+    s3_client = get_s3_client(boto3_session)
+    attempts = fail_upload_parts(monkeypatch, s3_client, {2: 1})
+    # three parts of the smallest size S3 allows
+    data, pieces = create_pieces(11 * 1024 * 1024)
+
+    _write_pieces_to_s3(s3_client, C_TEST_BUCKET, "big.bin", pieces, part_size=5 * 1024 * 1024, max_workers=2)
+
+    assert attempts == {1: 1, 2: 2, 3: 1}
+    assert s3_client.get_object(Bucket=C_TEST_BUCKET, Key="big.bin")["Body"].read() == data
+
+def test_write_pieces_aborts_when_a_part_keeps_failing(boto3_session, monkeypatch):
+    s3_client = get_s3_client(boto3_session)
+    attempts = fail_upload_parts(monkeypatch, s3_client, {2: 100})
+    _, pieces = create_pieces(11 * 1024 * 1024)
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        _write_pieces_to_s3(s3_client, C_TEST_BUCKET, "big.bin", pieces, part_size=5 * 1024 * 1024, max_workers=2, max_retries=2)
+
+    assert attempts[2] == 3
+    assert not s3_client.list_multipart_uploads(Bucket=C_TEST_BUCKET).get("Uploads")
+    assert not s3_client.list_objects_v2(Bucket=C_TEST_BUCKET).get("Contents")
+
+def count_get_objects(monkeypatch, s3_client):
+    # counts get_object calls, conditional or not. Returns the list of calls' keyword arguments.
+    get_object = s3_client.get_object
+    calls = []
+
+    def counting_get_object(**kwargs):
+        calls.append(kwargs)
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(s3_client, "get_object", counting_get_object)
+    return calls
+
+def age_disk_cache_entry(disk_cache, path, num_seconds):
+    # moves an entry's validation time back, as if it had been fetched num_seconds earlier
+    filename = disk_cache._entry_filename(C_TEST_BUCKET, path)
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime - num_seconds))
+
+def test_disk_chunk_cache_hit_revalidate_and_refetch(boto3_session, monkeypatch, tmp_path):
+    s3_client = get_s3_client(boto3_session)
+    s3_client.put_object(Bucket=C_TEST_BUCKET, Key="a/one.json", Body=b"[1, 2, 3]")
+    calls = count_get_objects(monkeypatch, s3_client)
+    disk_cache = DiskChunkCache(str(tmp_path), ttl=60)
+
+    assert disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, "a/one.json") == b"[1, 2, 3]"
+    assert len(calls) == 1
+
+    # within the ttl the second read comes from disk, with no GET at all
+    assert disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, "a/one.json") == b"[1, 2, 3]"
+    assert len(calls) == 1
+
+    # after the ttl an unchanged object is revalidated with If-None-Match, and S3 answers 304
+    age_disk_cache_entry(disk_cache, "a/one.json", 120)
+    assert disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, "a/one.json") == b"[1, 2, 3]"
+    assert len(calls) == 2 and "IfNoneMatch" in calls[1]
+    # and the revalidation restarts the ttl
+    assert disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, "a/one.json") == b"[1, 2, 3]"
+    assert len(calls) == 2
+
+    # a changed object fails the If-None-Match, so it is downloaded again
+    s3_client.put_object(Bucket=C_TEST_BUCKET, Key="a/one.json", Body=b"[4, 5]")
+    age_disk_cache_entry(disk_cache, "a/one.json", 120)
+    assert disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, "a/one.json") == b"[4, 5]"
+    assert len(calls) == 3
+
+    assert disk_cache.get_stats() == {"hits": 2, "revalidations": 1, "misses": 2, "evictions": 0}
+
+def test_disk_chunk_cache_evicts_past_max_bytes(boto3_session, tmp_path):
+    s3_client = get_s3_client(boto3_session)
+    paths = [f"a/{ix}.json" for ix in range(4)]
+    for path in paths:
+        s3_client.put_object(Bucket=C_TEST_BUCKET, Key=path, Body=b"x" * 1000)
+    # room for two entries (each is the object plus a line of metadata), not three
+    disk_cache = DiskChunkCache(str(tmp_path), max_bytes=2500)
+
+    for ix, path in enumerate(paths[:2]):
+        disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, path)
+        # access times are what eviction goes by, so keep them apart
+        filename = disk_cache._entry_filename(C_TEST_BUCKET, path)
+        os.utime(filename, (1000 + ix, os.stat(filename).st_mtime))
+    # reading the oldest makes it the most recently used, so the next one in is what gets evicted
+    disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, paths[0])
+    disk_cache.get_object_bytes(s3_client, C_TEST_BUCKET, paths[2])
+
+    assert disk_cache.evictions == 1
+    assert not os.path.exists(disk_cache._entry_filename(C_TEST_BUCKET, paths[1]))
+    for path in (paths[0], paths[2]):
+        assert os.path.exists(disk_cache._entry_filename(C_TEST_BUCKET, path))
+    assert sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path)) <= 2500
+
+def test_read_chunk_through_disk_chunk_cache(boto3_session, monkeypatch, tmp_path):
+    # a second run, with an empty in memory cache, reads the chunk file from disk rather than s3
+    s3_client = get_s3_client(boto3_session)
+    s3_client.put_object(Bucket=C_TEST_BUCKET, Key="a/one.json", Body=b'[{"text": "zero"}, {"text": "one"}]')
+    calls = count_get_objects(monkeypatch, s3_client)
+    disk_cache = DiskChunkCache(str(tmp_path))
+
+    for _ in range(2):
+        chunk = read_chunk_from_s3(boto3_session, C_TEST_BUCKET, "a", "one.json", 1, chunk_cache=ChunkCache(), disk_cache=disk_cache)
+        assert chunk == {"text": "one"}
+    assert len(calls) == 1
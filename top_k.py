@@ -1,6 +1,23 @@
 import numpy as np
+import threading
+import time
+import os
+import concurrent.futures
+from xxxdumb_vector_s3 import apply_dimension_mask, get_dumb_index_matrix, get_dumb_index_triples, \
+    dumb_vector_array_to_floats, floats_to_dumb_vector_array, read_columnar_dumb_index_from_file, get_dumb_index_layout_from_header_bytes, \
+    get_vectors_section, get_vectors_from_section_bytes, read_dumb_index_dimension_mask_from_fileobj, \
+    read_dumb_index_header_from_s3, read_dumb_index_vectors_from_s3, read_dumb_index_dimension_mask_from_s3, \
+    C_HEADER_SIZE_V2, C_VECTORTYPE_FLOAT32, C_VECTORTYPE_FLOAT64, C_VECTORTYPE_INT8, C_VECTORTYPE_INT_SCALING, C_METRIC_DOT, C_METRIC_COSINE, C_METRIC_L2
 
 def top_k_similar(dumb_index, vector, k):
+    # anything that isn't a dumb index dict is a search backend with its own top_k_similar (eg: PreparedDumbIndex, 
+    # Int8DumbIndex, PQIndex, IVFIndex, HNSWIndex)
+    if not isinstance(dumb_index, dict):
+        return dumb_index.top_k_similar(vector, k)
+
+    # an index built with a dimension mask needs the query masked the same way
+    vector = apply_dimension_mask(dumb_index, vector)
+
     D = len(vector)
 
     #1: Change datatypes to match numpy.
@@ -28,5 +45,611 @@ def top_k_similar(dumb_index, vector, k):
     return {
         "triples": sorted_top_k_triples,
         "paths": dumb_index["paths"],
-        "file_pairs": dumb_index["file_pairs"]
+        "file_pairs": dumb_index["file_pairs"],
+        "dimension_mask": dumb_index.get("dimension_mask")
+    }
+
+def get_columnar_dumb_index_from_dumbvector_index(dumbvector_index):
+    '''
+    A columnar dumb index over an index from the dumbvector package (its file_to_dumb_index), so the search backends
+    here can search it. That index's "vectors" is an N X D float array and its "docrefs" a (docsnameix, docix) pair
+    per vector: they become each triple's fileix and chunkix, and its docsnames the file pairs. The vectors aren't 
+    copied.
+    '''
+    vectors = dumbvector_index["vectors"]
+    if vectors.dtype.kind != 'f':
+        raise Exception(f"Only float vectors are supported, not {vectors.dtype}")
+    docrefs = np.asarray(dumbvector_index["docrefs"], dtype=np.uint32).reshape(len(vectors), 2)
+    return {
+        "paths": [""],
+        "file_pairs": [(0, docsname) for docsname in dumbvector_index["docsnames"]],
+        "vectors": vectors,
+        "fileixs": docrefs[:, 0],
+        "chunkixs": docrefs[:, 1],
+        "norms": None,
+        "vector_type": C_VECTORTYPE_FLOAT64 if vectors.dtype == np.float64 else C_VECTORTYPE_FLOAT32,
+        "dimension_mask": None
+    }
+
+def read_columnar_dumb_index_or_dumbvector_index_from_file(filename):
+    # a .dumbindex file (from the dumbvector package) or one of our dumb index files, as a columnar dumb index
+    if not filename.endswith(".dumbindex"):
+        return read_columnar_dumb_index_from_file(filename)
+
+    from dumbvector.dumb_index import file_to_dumb_index
+
+    index_name = os.path.splitext(os.path.basename(filename))[0]
+    dumbvector_index = file_to_dumb_index(index_name, os.path.dirname(filename))
+    return get_columnar_dumb_index_from_dumbvector_index(dumbvector_index)
+
+def get_dumbvector_index_from_top_k(dumbvector_index, top_k):
+    # the reverse of get_columnar_dumb_index_from_dumbvector_index for a top_k_similar result: a dumbvector index of 
+    # just those triples in order, like dumbvector's own top_k_similar returns
+    triples = top_k["triples"]
+    return {
+        "name": f"top_{len(triples)}_similar_{dumbvector_index['name']}",
+        "version": dumbvector_index["version"],
+        "docsnames": dumbvector_index["docsnames"],
+        "vectors": np.asarray([triple[0] for triple in triples], dtype=dumbvector_index["vectors"].dtype),
+        "docrefs": [(fileix, chunkix) for _, fileix, chunkix in triples]
+    }
+
+def top_k_order(scores, k):
+    # indices of the k highest scores, highest first, equal scores in index order (including at the kth place)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < len(scores):
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > threshold)
+        top_k = np.concatenate([above, np.flatnonzero(scores == threshold)[:k - len(above)]])
+    else:
+        top_k = np.arange(len(scores))
+    return top_k[np.lexsort((top_k, -scores[top_k]))]
+
+def top_k_orders(scores, k):
+    # row by row version of top_k_order for a Q X N array of scores, giving a Q X k array
+    k = max(0, min(k, scores.shape[1]))
+    top_k = np.empty((len(scores), k), dtype=np.intp)
+    for row, row_scores in enumerate(scores):
+        top_k[row] = top_k_order(row_scores, k)
+    return top_k
+
+# batches of queries are scored this many bytes of scores at a time
+C_BATCH_TILE_BYTES = 64 * 1024 * 1024
+
+class PreparedDumbIndex:
+    '''
+    A dumb index (a dict of triples, or columnar) made ready for repeated searching. Build one when the index is 
+    loaded and keep it: the vectors are converted once into a C contiguous matrix of dtype (float32 by default, which 
+    halves the memory traffic of float64), the norms are worked out once (or taken from the index if it stores them),
+    and the score buffer is allocated once. Each search is then just the matrix-vector product and a top k selection.
+
+    Searches share the score buffer, so they are serialised with a lock; use one PreparedDumbIndex per thread to 
+    search in parallel.
+
+    BLAS can round the same score differently depending on how the product is split up (a matrix-vector product, a
+    shard of one, or a matrix-matrix product for a batch). So every row whose score is within the possible rounding
+    of the kth best is re-scored in float64 the same way whichever path found it, and the top k are taken from those
+    with equal scores in id order. search, sharded search and search_batch give identical ids and scores.
+
+    With max_workers > 1, search splits the matrix into that many row shards and scores them on a pool of threads 
+    (numpy releases the GIL in the dot products), then merges each shard's top k. The ranking is the same as with one
+    worker. The threads are started by the first search; call close (or use the index in a with block) to stop them.
+    '''
+    def __init__(self, dumb_index, dtype=np.float32, max_workers=1):
+        self.dumb_index = dumb_index
+        self.dtype = np.dtype(dtype)
+        self.triples = get_dumb_index_triples(dumb_index)
+
+        if "triples" not in dumb_index and dumb_index["vector_type"] == C_VECTORTYPE_FLOAT32 and self.dtype == np.float32:
+            # a columnar float32 index is already what we want, don't decode it
+            self.matrix = np.ascontiguousarray(dumb_index["vectors"])
+        else:
+            self.matrix = np.ascontiguousarray(get_dumb_index_matrix(dumb_index), dtype=self.dtype)
+
+        norms = dumb_index.get("norms")
+        if norms is None:
+            norms = np.linalg.norm(self.matrix, axis=1)
+        self.norms = np.ascontiguousarray(norms, dtype=self.dtype)
+        self.squared_norms = self.norms * self.norms
+        self.max_norm = float(self.norms.max()) if len(self.norms) else 0.0
+        # 0 for rows with no magnitude, so their cosine similarity is 0
+        self.inverse_norms = np.divide(1, self.norms, out=np.zeros_like(self.norms), where=self.norms != 0)
+
+        self.scores = np.empty(len(self.matrix), dtype=self.dtype)
+        self.lock = threading.Lock()
+
+        # (start, end) of each row shard
+        self.max_workers = max_workers
+        shard_bounds = np.linspace(0, len(self.matrix), max(1, min(max_workers, len(self.matrix))) + 1).astype(int).tolist()
+        self.shards = list(zip(shard_bounds[:-1], shard_bounds[1:]))
+        self.executor = None
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # stops the search threads, if any were started. A later sharded search starts them again.
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def prepare_query(self, vector):
+        # the query masked like the index and in the index's dtype
+        return np.ascontiguousarray(apply_dimension_mask(self.dumb_index, vector), dtype=self.dtype)
+
+    def score_into(self, query, scores, metric=C_METRIC_DOT, matrix=None, norms=None, squared_norms=None, inverse_norms=None):
+        '''
+        Scores the rows of matrix (default the whole index) against a prepared query into scores, in place, higher 
+        being more similar. For C_METRIC_L2 the score is the negative squared euclidean distance. The norm arguments
+        default to the index's, and must match matrix if it is given.
+        '''
+        if matrix is None:
+            matrix, norms, squared_norms, inverse_norms = self.matrix, self.norms, self.squared_norms, self.inverse_norms
+
+        np.dot(matrix, query, out=scores)
+
+        if metric == C_METRIC_DOT:
+            pass
+        elif metric == C_METRIC_COSINE:
+            query_norm = np.linalg.norm(query)
+            scores *= inverse_norms
+            if query_norm:
+                scores /= query_norm
+        elif metric == C_METRIC_L2:
+            # -|x - q|^2 = 2 x.q - |x|^2 - |q|^2
+            scores *= 2
+            scores -= squared_norms
+            scores -= np.dot(query, query)
+        else:
+            raise Exception(f"Unknown metric {metric}")
+        return scores
+
+    def get_rounding_tolerance(self, query, metric=C_METRIC_DOT):
+        # a bound on how far rounding in the BLAS products can move any score against query
+        rounding = 4 * len(query) * np.finfo(self.dtype).eps
+        if metric == C_METRIC_COSINE:
+            return rounding
+        query_norm = float(np.linalg.norm(query))
+        if metric == C_METRIC_DOT:
+            return rounding * self.max_norm * query_norm
+        return rounding * (self.max_norm + query_norm) ** 2
+
+    def rescore(self, query, ids, metric=C_METRIC_DOT):
+        # scores of some rows against a prepared query, worked out in float64 the same way every time
+        float_query = query.astype(np.float64)
+        scores = np.einsum('ij,j->i', self.matrix[ids].astype(np.float64), float_query)
+        if metric == C_METRIC_DOT:
+            pass
+        elif metric == C_METRIC_COSINE:
+            query_norm = np.sqrt(np.einsum('j,j->', float_query, float_query))
+            scores *= self.inverse_norms[ids]
+            if query_norm:
+                scores /= query_norm
+        elif metric == C_METRIC_L2:
+            scores = 2 * scores - self.squared_norms[ids] - np.einsum('j,j->', float_query, float_query)
+        else:
+            raise Exception(f"Unknown metric {metric}")
+        return scores.astype(self.dtype)
+
+    def select_top_k(self, query, scores, k, metric=C_METRIC_DOT, offset=0):
+        '''
+        (ids, scores) of the top k of scores (from score_into, for rows offset onwards), re-scoring every row within 
+        the rounding tolerance of the kth best with rescore so the result doesn't depend on how scores were worked out.
+        '''
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=self.dtype)
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= threshold - self.get_rounding_tolerance(query, metric)) + offset
+        candidate_scores = self.rescore(query, candidates, metric)
+        order = top_k_order(candidate_scores, k)
+        return candidates[order], candidate_scores[order]
+
+    def _search_shard(self, query, k, metric, start, end):
+        # top k of rows start to end, into that part of the score buffer
+        scores = self.score_into(
+            query, self.scores[start:end], metric, self.matrix[start:end], 
+            self.norms[start:end], self.squared_norms[start:end], self.inverse_norms[start:end]
+        )
+        return self.select_top_k(query, scores, k, metric, start)
+
+    def search(self, vector, k, metric=C_METRIC_DOT):
+        # returns (ids, scores) of the top k triples, most similar first. ids index the index's triples.
+        query = self.prepare_query(vector)
+        with self.lock:
+            if len(self.shards) == 1:
+                scores = self.score_into(query, self.scores, metric)
+                return self.select_top_k(query, scores, k, metric)
+
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+            futures = [self.executor.submit(self._search_shard, query, k, metric, start, end) for start, end in self.shards]
+            ids = np.zeros(0, dtype=np.intp)
+            scores = np.zeros(0, dtype=self.dtype)
+            for future in futures:
+                shard_ids, shard_scores = future.result()
+                ids, scores = merge_top_k(ids, scores, shard_ids, shard_scores, k)
+            return ids, scores
+
+    def score_batch_into(self, queries, scores, metric=C_METRIC_DOT):
+        # batch version of score_into: scores (Q X N) for prepared queries (Q X D), with one matrix-matrix multiply
+        np.dot(queries, self.matrix.T, out=scores)
+
+        if metric == C_METRIC_DOT:
+            pass
+        elif metric == C_METRIC_COSINE:
+            query_norms = np.linalg.norm(queries, axis=1)
+            scores *= self.inverse_norms
+            scores /= np.where(query_norms != 0, query_norms, 1)[:, None]
+        elif metric == C_METRIC_L2:
+            scores *= 2
+            scores -= self.squared_norms
+            scores -= np.einsum('ij,ij->i', queries, queries)[:, None]
+        else:
+            raise Exception(f"Unknown metric {metric}")
+        return scores
+
+    def search_batch(self, vectors, k, metric=C_METRIC_DOT, tile_bytes=C_BATCH_TILE_BYTES):
+        '''
+        Searches for many queries (a Q X D matrix, or a list of vectors) at once. Returns (ids, scores), each Q X k, 
+        row q being exactly what search would return for query q. The queries are scored a tile of rows at a time 
+        with one matrix-matrix multiply per tile; tiles are sized so their scores take at most about tile_bytes.
+        '''
+        queries = np.stack([self.prepare_query(vector) for vector in vectors]) if len(vectors) else np.zeros((0, self.matrix.shape[1]), dtype=self.dtype)
+        k = min(k, len(self.matrix))
+
+        all_ids = np.empty((len(queries), k), dtype=np.intp)
+        all_scores = np.empty((len(queries), k), dtype=self.dtype)
+
+        tile_size = max(1, tile_bytes // max(1, len(self.matrix) * self.dtype.itemsize))
+        tile_scores = np.empty((min(tile_size, len(queries)), len(self.matrix)), dtype=self.dtype)
+        for start in range(0, len(queries), tile_size):
+            tile_queries = queries[start:start + tile_size]
+            scores = self.score_batch_into(tile_queries, tile_scores[:len(tile_queries)], metric)
+            for row, query in enumerate(tile_queries):
+                all_ids[start + row], all_scores[start + row] = self.select_top_k(query, scores[row], k, metric)
+
+        return all_ids, all_scores
+
+    def top_k_similar(self, vector, k, metric=C_METRIC_DOT):
+        # the same shape of result as top_k_similar
+        ids, _ = self.search(vector, k, metric)
+        return {
+            "triples": [self.triples[i] for i in ids.tolist()],
+            "paths": self.dumb_index["paths"],
+            "file_pairs": self.dumb_index["file_pairs"],
+            "dimension_mask": self.dumb_index.get("dimension_mask")
+        }
+
+def batch_top_k_similar(dumb_index, vectors, k, metric=C_METRIC_DOT):
+    # top_k_similar for each of many query vectors, as a list of results. Prepare the index first if you can.
+    if not isinstance(dumb_index, PreparedDumbIndex):
+        dumb_index = PreparedDumbIndex(dumb_index)
+
+    all_ids, _ = dumb_index.search_batch(vectors, k, metric)
+    return [
+        {
+            "triples": [dumb_index.triples[i] for i in ids.tolist()],
+            "paths": dumb_index.dumb_index["paths"],
+            "file_pairs": dumb_index.dumb_index["file_pairs"],
+            "dimension_mask": dumb_index.dumb_index.get("dimension_mask")
+        }
+        for ids in all_ids
+    ]
+
+def get_recall_at_k(index, reference_dumb_index, queries, k, metric=C_METRIC_DOT, **search_kwargs):
+    '''
+    The mean recall@k of an approximate index (anything with search(vector, k, metric, ...)) over some queries: the
+    fraction of the exact top k of reference_dumb_index (as top_k_similar ranks them, in float64) that it finds.
+    reference_dumb_index should hold the full precision vectors: an index's own dumb_index may not (an
+    Int8DumbIndex's is quantized), and measuring against that overstates its recall.
+    '''
+    exact_index = PreparedDumbIndex(reference_dumb_index, dtype=np.float64)
+    found = 0
+    for query in queries:
+        exact_ids, _ = exact_index.search(query, k, metric)
+        ids, _ = index.search(query, k, metric, **search_kwargs)
+        found += len(set(exact_ids.tolist()) & set(ids.tolist()))
+    return found / (len(queries) * min(k, len(exact_index))) if len(queries) else 0.0
+
+def get_noisy_queries(dumb_index, num_queries, rng=None):
+    # test queries for an approximate index: up to num_queries randomly chosen vectors of dumb_index with noise added
+    if rng is None:
+        rng = np.random.default_rng(0)
+    num_vectors = len(get_dumb_index_triples(dumb_index))
+    query_ids = np.sort(rng.choice(num_vectors, min(num_queries, num_vectors), replace=False))
+    queries = get_float_vectors(dumb_index, query_ids)
+    queries += rng.normal(0, np.abs(queries).mean(), queries.shape)
+    return queries
+
+def print_recall_and_latency(index, reference_dumb_index, queries, k, metric, label, **search_kwargs):
+    # prints the recall@k of an approximate index over queries (see get_recall_at_k), and its time per query
+    recall = get_recall_at_k(index, reference_dumb_index, queries, k, metric, **search_kwargs)
+
+    ts = time.time()
+    for query in queries:
+        index.search(query, k, metric, **search_kwargs)
+    time_per_query = (time.time() - ts) / max(1, len(queries))
+
+    print (f"{label}: recall@{k} {recall:.3f}, {time_per_query * 1000:.2f} ms per query")
+
+# blocked scans read and score this many vectors at a time
+C_SCAN_BLOCK_SIZE = 16384
+
+def merge_top_k(ids, scores, block_ids, block_scores, k):
+    '''
+    Merges two top k lists (ids and scores, each most similar first) into one, keeping the k best. Equal scores are 
+    ordered by id, as in a single scan of the whole index.
+    '''
+    ids = np.concatenate([ids, block_ids])
+    scores = np.concatenate([scores, block_scores])
+    order = np.lexsort((ids, -scores))[:k]
+    return ids[order], scores[order]
+
+def blocked_top_k(blocks, vector, k, metric=C_METRIC_DOT, dimension_mask=None, dtype=np.float32):
+    '''
+    Top k search over an index that comes a block at a time. blocks yields (start, vectors): the index of the first
+    vector in the block, and an array of the block's vectors as floats. Only one block's scores and the running top k 
+    are held at once, so memory doesn't grow with the size of the index. Returns (ids, scores), most similar first.
+    '''
+    query = np.ascontiguousarray(apply_dimension_mask({"dimension_mask": dimension_mask}, vector), dtype=dtype)
+    query_norm = np.linalg.norm(query)
+
+    ids = np.zeros(0, dtype=np.intp)
+    scores = np.zeros(0, dtype=dtype)
+    for start, vectors in blocks:
+        block = np.ascontiguousarray(vectors, dtype=dtype)
+        block_scores = block @ query
+        if metric == C_METRIC_COSINE:
+            magnitudes = np.linalg.norm(block, axis=1) * query_norm
+            block_scores = np.divide(block_scores, magnitudes, out=np.zeros_like(block_scores), where=magnitudes != 0)
+        elif metric == C_METRIC_L2:
+            block_scores = 2 * block_scores - np.einsum('ij,ij->i', block, block) - query_norm * query_norm
+        elif metric != C_METRIC_DOT:
+            raise Exception(f"Unknown metric {metric}")
+
+        block_ids = top_k_order(block_scores, k)
+        ids, scores = merge_top_k(ids, scores, block_ids + start, block_scores[block_ids], k)
+
+    return ids, scores
+
+def yield_vector_blocks_from_columnar_dumb_index(columnar_dumb_index, block_size=C_SCAN_BLOCK_SIZE):
+    # blocks for blocked_top_k from a columnar dumb index. Over an mmap, only the block being scored is paged in.
+    vectors = columnar_dumb_index["vectors"]
+    for start in range(0, len(vectors), block_size):
+        yield start, dumb_vector_array_to_floats(vectors[start:start + block_size], columnar_dumb_index["vector_type"])
+
+def yield_vector_blocks_from_dumb_index(dumb_index, block_size=C_SCAN_BLOCK_SIZE):
+    # blocks for blocked_top_k from a dumb index (a dict of triples or columnar), only ever converting one block
+    if "triples" not in dumb_index:
+        yield from yield_vector_blocks_from_columnar_dumb_index(dumb_index, block_size)
+        return
+    triples = dumb_index["triples"]
+    for start in range(0, len(triples), block_size):
+        yield start, np.asarray([triple[0] for triple in triples[start:start + block_size]], dtype=np.float64)
+
+def yield_vector_blocks_from_fileobj(f, dumb_index_header, block_size=C_SCAN_BLOCK_SIZE):
+    # blocks for blocked_top_k read from a dumb index file with plain reads, into one reused buffer
+    num_triples = dumb_index_header["num_triples"]
+    buffer = None
+    for start in range(0, num_triples, block_size):
+        end = min(start + block_size, num_triples)
+        section_start, section_end = get_vectors_section(dumb_index_header, start, end)
+        if buffer is None:
+            buffer = bytearray(section_end - section_start)
+        block_buffer = memoryview(buffer)[:section_end - section_start]
+        f.seek(section_start)
+        # readinto can return less than asked for, so keep reading until the block is full
+        num_read = 0
+        while num_read < len(block_buffer):
+            num_read_now = f.readinto(block_buffer[num_read:])
+            if not num_read_now:
+                raise Exception(f"Dumb index file ended {len(block_buffer) - num_read} bytes short reading triples {start} to {end}")
+            num_read += num_read_now
+        yield start, dumb_vector_array_to_floats(get_vectors_from_section_bytes(dumb_index_header, block_buffer), dumb_index_header["vector_type"])
+
+def yield_vector_blocks_from_s3(boto3_session, s3_bucket, dumb_index_header, block_size=C_SCAN_BLOCK_SIZE):
+    # blocks for blocked_top_k fetched from a dumb index on S3 with Range requests, one block at a time
+    for start in range(0, dumb_index_header["num_triples"], block_size):
+        vectors = read_dumb_index_vectors_from_s3(boto3_session, s3_bucket, dumb_index_header, start, start + block_size)
+        yield start, dumb_vector_array_to_floats(vectors, dumb_index_header["vector_type"])
+
+def blocked_top_k_from_file(filename, vector, k, metric=C_METRIC_DOT, block_size=C_SCAN_BLOCK_SIZE, use_mmap=True):
+    '''
+    Top k search over a dumb index file (version 1 or 2) without loading it, see blocked_top_k. With use_mmap the 
+    file is memory mapped, otherwise it is read a block at a time. Returns (ids, scores); ids are triple indices.
+    '''
+    if use_mmap:
+        columnar_dumb_index = read_columnar_dumb_index_from_file(filename, use_mmap=True)
+        blocks = yield_vector_blocks_from_columnar_dumb_index(columnar_dumb_index, block_size)
+        return blocked_top_k(blocks, vector, k, metric, columnar_dumb_index["dimension_mask"])
+
+    with open(filename, "rb") as f:
+        dumb_index_header = get_dumb_index_layout_from_header_bytes(f.read(C_HEADER_SIZE_V2))
+        dimension_mask = read_dumb_index_dimension_mask_from_fileobj(f, dumb_index_header)
+
+        blocks = yield_vector_blocks_from_fileobj(f, dumb_index_header, block_size)
+        return blocked_top_k(blocks, vector, k, metric, dimension_mask)
+
+def blocked_top_k_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name, vector, k, metric=C_METRIC_DOT, block_size=C_SCAN_BLOCK_SIZE):
+    # top k search over a dumb index on S3, fetched a block at a time, see blocked_top_k. Returns None if it doesn't exist.
+    dumb_index_header = read_dumb_index_header_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name)
+    if dumb_index_header is None:
+        return None
+
+    dimension_mask = read_dumb_index_dimension_mask_from_s3(boto3_session, s3_bucket, dumb_index_header)
+    blocks = yield_vector_blocks_from_s3(boto3_session, s3_bucket, dumb_index_header, block_size)
+    return blocked_top_k(blocks, vector, k, metric, dimension_mask)
+
+# int8 rows are widened to float32 for scoring this many bytes (of float32) at a time, which keeps the widened block
+# in cache while BLAS scores it
+C_INT8_SCORE_BLOCK_BYTES = 1024 * 1024
+# triples are quantized this many at a time
+C_INT8_BLOCK_SIZE = 8192
+
+def get_float_vectors(dumb_index, ids):
+    # the vectors of some triples of a dumb index (a dict of triples or columnar) as floats, touching only those rows
+    if "triples" in dumb_index:
+        return np.asarray([dumb_index["triples"][i][0] for i in ids], dtype=np.float64)
+    return dumb_vector_array_to_floats(dumb_index["vectors"][ids], dumb_index["vector_type"])
+
+def get_int8_columnar_dumb_index(dumb_index, block_size=C_INT8_BLOCK_SIZE):
+    '''
+    A columnar dumb index with the vectors of dumb_index (a dict of triples or columnar) as int8 (C_VECTORTYPE_INT8),
+    quantized block_size triples at a time so no full precision copy of them is ever made. A columnar index that is
+    already int8 is returned as it is. Like any int8 index, this raises if a value is outside -1 to 1.
+    '''
+    if "triples" not in dumb_index and dumb_index["vector_type"] == C_VECTORTYPE_INT8:
+        return dumb_index
+
+    triples = get_dumb_index_triples(dumb_index)
+    num_dimensions = len(triples[0][0]) if len(triples) else 0
+    vectors = np.empty((len(triples), num_dimensions), dtype=np.int8)
+    for start in range(0, len(triples), block_size):
+        if "triples" in dumb_index:
+            block = [triple[0] for triple in triples[start:start + block_size]]
+        else:
+            block = dumb_vector_array_to_floats(dumb_index["vectors"][start:start + block_size], dumb_index["vector_type"])
+        vectors[start:start + len(block)] = floats_to_dumb_vector_array(block, C_VECTORTYPE_INT8)
+
+    if "triples" in dumb_index:
+        fileixs = np.fromiter((triple[1] for triple in triples), dtype=np.uint32, count=len(triples))
+        chunkixs = np.fromiter((triple[2] for triple in triples), dtype=np.uint32, count=len(triples))
+    else:
+        fileixs, chunkixs = dumb_index["fileixs"], dumb_index["chunkixs"]
+
+    return {
+        "paths": dumb_index["paths"],
+        "file_pairs": dumb_index["file_pairs"],
+        "vectors": vectors,
+        "fileixs": fileixs,
+        "chunkixs": chunkixs,
+        "norms": None,
+        "vector_type": C_VECTORTYPE_INT8,
+        "dimension_mask": dumb_index.get("dimension_mask")
     }
+
+class Int8DumbIndex:
+    '''
+    A dumb index searched with its vectors kept as int8 (C_VECTORTYPE_INT8): a quarter of the memory of float32, an
+    eighth of float64. A columnar index that is already int8 (eg: memory mapped from a file) is used as is; anything
+    else is quantized a block at a time with the same codec the index files use (see get_int8_columnar_dumb_index), 
+    and no reference to its full precision vectors is kept. So the triples this returns have the dequantized int8 
+    vectors in them. The codec only takes values from -1 to 1, so building one raises on an index with any other 
+    values.
+
+    The query is quantized the same way, after scaling it so its largest value is 1 (which doesn't change the ranking
+    for dot or cosine similarity, and keeps more of its precision). To score, rows are widened to floats a cache 
+    sized block at a time and multiplied with BLAS, which is much faster than numpy's integer matmul and gives the 
+    same exact integer sums: float32 when 127 * 127 * D fits in its 24 bit mantissa (up to 1040 dimensions), 
+    otherwise float64 (eg: 1536 dimension ada embeddings). The widening makes this slower than PreparedDumbIndex; 
+    what it buys is the memory. Only C_METRIC_DOT and C_METRIC_COSINE are supported.
+
+    Quantizing loses some recall. search can re-rank the top candidates exactly: with rerank_dumb_index (the same 
+    triples at full precision, best memory mapped) they are scored against its float vectors, otherwise against the
+    dequantized int8 vectors with the unquantized query.
+    '''
+    def __init__(self, dumb_index, rerank_dumb_index=None, block_size=None):
+        self.dumb_index = get_int8_columnar_dumb_index(dumb_index)
+        self.rerank_dumb_index = rerank_dumb_index
+        self.triples = get_dumb_index_triples(self.dumb_index)
+        self.matrix = self.dumb_index["vectors"]
+        # the narrowest float that holds every possible int8 dot product exactly
+        self.dtype = np.dtype(np.float32 if 127 * 127 * self.matrix.shape[1] <= 2 ** 24 else np.float64)
+        if block_size is None:
+            block_size = max(1, C_INT8_SCORE_BLOCK_BYTES // (self.dtype.itemsize * max(1, self.matrix.shape[1])))
+        self.block_size = block_size
+
+        # norms of the int8 vectors, in int8 units
+        self.norms = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), block_size):
+            block = self.matrix[start:start + block_size].astype(np.float32)
+            self.norms[start:start + block_size] = np.sqrt(np.einsum('ij,ij->i', block, block))
+
+        self.scores = np.empty(len(self.matrix), dtype=self.dtype)
+        self.block_buffer = np.empty((min(block_size, len(self.matrix)), self.matrix.shape[1]), dtype=self.dtype)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def quantize_query(self, vector):
+        # returns (the query as int8, the factor to turn int8 dot products back into float ones)
+        query = np.asarray(apply_dimension_mask(self.dumb_index, vector), dtype=np.float64)
+        query_scale = np.abs(query).max() if len(query) else 0.0
+        if not query_scale:
+            return np.zeros(len(query), dtype=np.int8), 0.0
+        scale, _ = C_VECTORTYPE_INT_SCALING[C_VECTORTYPE_INT8]
+        return floats_to_dumb_vector_array(query / query_scale, C_VECTORTYPE_INT8), query_scale / (scale * scale)
+
+    def score_into(self, query, scores):
+        # exact dot products (in int8 units) of every row with an int8 query, into scores. Uses self.block_buffer, so
+        # hold self.lock.
+        float_query = query.astype(self.dtype)
+        for start in range(0, len(self.matrix), self.block_size):
+            block = self.matrix[start:start + self.block_size]
+            widened_block = self.block_buffer[:len(block)]
+            np.copyto(widened_block, block)
+            np.matmul(widened_block, float_query, out=scores[start:start + len(block)])
+        return scores
+
+    def search(self, vector, k, metric=C_METRIC_DOT, rerank=0):
+        '''
+        Returns (ids, scores) of the top k triples, most similar first. With rerank, the top max(rerank, k) candidates
+        by int8 score are re-scored exactly and the best k of them returned with their exact scores.
+        '''
+        if metric not in (C_METRIC_DOT, C_METRIC_COSINE):
+            raise Exception(f"Metric {metric} isn't supported for int8 search")
+
+        query, dot_scale = self.quantize_query(vector)
+        num_candidates = max(rerank, k) if rerank else k
+
+        with self.lock:
+            scores = self.score_into(query, self.scores)
+            if metric == C_METRIC_COSINE:
+                magnitudes = self.norms * np.linalg.norm(query.astype(np.float32))
+                float_scores = np.divide(scores, magnitudes, out=np.zeros(len(scores), dtype=self.dtype), where=magnitudes != 0)
+            else:
+                float_scores = scores
+            ids = top_k_order(float_scores, num_candidates)
+            if metric == C_METRIC_COSINE:
+                candidate_scores = float_scores[ids]
+            else:
+                candidate_scores = scores[ids] * self.dtype.type(dot_scale)
+
+        if not rerank:
+            return ids, candidate_scores
+
+        # re-score the candidates against float vectors, in id order so ties stay in id order
+        ids = np.sort(ids)
+        if self.rerank_dumb_index is not None:
+            vectors = get_float_vectors(self.rerank_dumb_index, ids)
+        else:
+            vectors = dumb_vector_array_to_floats(self.matrix[ids], C_VECTORTYPE_INT8)
+        float_query = np.asarray(apply_dimension_mask(self.dumb_index, vector), dtype=np.float64)
+        exact_scores = vectors @ float_query
+        if metric == C_METRIC_COSINE:
+            magnitudes = np.linalg.norm(vectors, axis=1) * np.linalg.norm(float_query)
+            exact_scores = np.divide(exact_scores, magnitudes, out=np.zeros_like(exact_scores), where=magnitudes != 0)
+
+        order = top_k_order(exact_scores, k)
+        return ids[order], exact_scores[order]
+
+    def top_k_similar(self, vector, k, metric=C_METRIC_DOT, rerank=0):
+        # the same shape of result as top_k_similar
+        ids, _ = self.search(vector, k, metric, rerank)
+        return {
+            "triples": [self.triples[i] for i in ids.tolist()],
+            "paths": self.dumb_index["paths"],
+            "file_pairs": self.dumb_index["file_pairs"],
+            "dimension_mask": self.dumb_index.get("dimension_mask")
+        }
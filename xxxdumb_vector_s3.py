@@ -68,17 +68,91 @@ The triple table will be structured as follows:
     - 4 bytes: the fileix
     - 4 bytes: the chunkix
 
+--
+
+Version 2 of the file format is columnar. The vectors are stored as one contiguous N X D block, so that readers can
+view them as a matrix without decoding each record. The header is the same as version 1 (with version number 
+0x00000002), followed by:
+- 1 byte: flags
+    bit 0 set = the norms array is present
+- zero padding up to 64 bytes
+
+Then come the path table and the file table, exactly as in version 1.
+
+Then the triple table, which starts at the next 64 byte boundary in the file (the gap is zero padded), and is 
+structured as follows:
+- the vector block: for each triple, for each dimension, k bytes: the value of the dimension (as in version 1)
+- the fileix array: for each triple, 4 bytes: the fileix
+- the chunkix array: for each triple, 4 bytes: the chunkix
+- the norms array (if present): for each triple, 4 bytes: float32 magnitude of the vector (after decoding to float)
+
+The number of bytes in the triple table (in the header) doesn't include the padding before it.
+
+--
+
+Chunk files can also be written as a binary "chunk container" (file extension .chunks) instead of a json list, so
+that a single chunk can be read with a seek or an S3 Range request, without downloading the whole file. Binary 
+fields (eg: the base64 embedding) are stored as raw bytes rather than base64 text. The format is:
+- 4 bytes: magic number, 0xfeedc0de
+- 4 bytes: version number, 0x00000001
+- 4 bytes: number of chunks
+- the offset table: for each chunk, 8 bytes: offset of the chunk's record from the start of the file, then 
+  8 more bytes: the offset of the end of the last record
+- for each chunk, its record:
+    - 4 bytes: number of bytes of json
+    - n bytes: the chunk as json (utf-8 encoded), without the binary fields
+    - 4 bytes: number of binary fields
+    - for each binary field:
+        - 4 bytes: number of bytes in the field name
+        - n bytes: the field name (utf-8 encoded)
+        - 4 bytes: number of bytes in the value
+        - n bytes: the value (the base64 decoded bytes)
+
+Readers recognise a chunk container by its magic number, and give back the same chunks (binary fields are base64
+encoded again).
+
 '''
 
 import json
 import os
+import mmap
 import boto3
 import botocore
+import botocore.config
 import uuid
+import zlib
+import lzma
+import base64
+import binascii
+import hashlib
+import tempfile
 import struct
+import time
+import concurrent.futures
+import itertools
+import collections
+import collections.abc
+import threading
+import weakref
+import numpy as np
 
 C_MAGIC_NUMBER = 0xfeedface
 
+C_VERSION_1 = 0x00000001
+C_VERSION_2 = 0x00000002
+
+C_HEADER_SIZE_V1 = 37
+C_HEADER_SIZE_V2 = 64
+C_ALIGNMENT_V2 = 64
+
+C_FLAG_NORMS = 0x01
+
+# The dimension mask section, when there is one, comes after everything else in the file (for either version), so
+# readers that don't know about it never see it. It is the magic number, the number of dimensions before masking 
+# (uint32), then one byte (0 or 1) per dimension.
+C_DIMENSION_MASK_MAGIC_NUMBER = 0xfeed0a5c
+C_DIMENSION_MASK_HEADER_SIZE = 8
+
 C_VECTORTYPE_FLOAT32 = 0
 C_VECTORTYPE_FLOAT64 = 1
 C_VECTORTYPE_INT8 = 8
@@ -179,33 +253,113 @@ def number_of_bytes_for_vector_type(vector_type):
     else:
         raise Exception(f"Unknown vector type {vector_type}")
 
-# dumb_vector_bytes = bytearray()
+# numpy dtypes for each vector type, as laid out in the file (little endian)
+C_VECTORTYPE_DTYPES = {
+    C_VECTORTYPE_FLOAT32: np.dtype('<f4'),
+    C_VECTORTYPE_FLOAT64: np.dtype('<f8'),
+    C_VECTORTYPE_INT8: np.dtype('<i1'),
+    C_VECTORTYPE_INT16: np.dtype('<i2'),
+    C_VECTORTYPE_INT32: np.dtype('<i4'),
+    C_VECTORTYPE_UINT8: np.dtype('<u1'),
+    C_VECTORTYPE_UINT16: np.dtype('<u2'),
+    C_VECTORTYPE_UINT32: np.dtype('<u4'),
+}
+
+# (scale, offset) for the integer vector types. A float value in [-1, 1] is stored as int((value + offset) * scale),
+# exactly as convert_dimension_value_float_to_dumb_vector_bytes does it, and read back as stored / scale - offset.
+C_VECTORTYPE_INT_SCALING = {
+    C_VECTORTYPE_INT8: (127.0, 0.0),
+    C_VECTORTYPE_INT16: (32767.0, 0.0),
+    C_VECTORTYPE_INT32: (2147483647.0, 0.0),
+    C_VECTORTYPE_UINT8: (127.0, 1.0),
+    C_VECTORTYPE_UINT16: (32767.0, 1.0),
+    C_VECTORTYPE_UINT32: (2147483647.0, 1.0),
+}
+
+def dtype_for_vector_type(vector_type):
+    if vector_type not in C_VECTORTYPE_DTYPES:
+        raise Exception(f"Unknown vector type {vector_type}")
+    return C_VECTORTYPE_DTYPES[vector_type]
+
+def floats_to_dumb_vector_array(values, vector_type):
+    '''
+    Bulk version of convert_dimension_value_float_to_dumb_vector_bytes. Takes an array-like of floats of any shape 
+    (one vector, or a list of vectors) and returns a numpy array of the same shape in the dtype for vector_type.
+    Calling .tobytes() on the result gives exactly the bytes the per-value function would have produced.
+    '''
+    dtype = dtype_for_vector_type(vector_type)
+    float_values = np.asarray(values, dtype=np.float64)
+
+    # we are expecting values between -1 and 1
+    out_of_range = (float_values < -1.0) | (float_values > 1.0)
+    if out_of_range.any():
+        raise Exception(f"Value {float(float_values[out_of_range][0])} must be between -1 and 1 inclusive")
+
+    if vector_type in C_VECTORTYPE_INT_SCALING:
+        scale, offset = C_VECTORTYPE_INT_SCALING[vector_type]
+        if offset:
+            float_values = float_values + offset
+        # int() truncates towards zero, so we do the same
+        scaled_values = np.trunc(float_values * scale)
+        if not np.isfinite(scaled_values).all():
+            raise Exception(f"Value {float(scaled_values[~np.isfinite(scaled_values)][0])} must be between -1 and 1 inclusive")
+        return scaled_values.astype(dtype)
+    else:
+        return float_values.astype(dtype)
+
+def dumb_vector_array_to_floats(dumb_vector_array, vector_type):
+    '''
+    Bulk version of convert_dumb_vector_bytes_to_dimension_value_float. Takes a numpy array in the dtype for 
+    vector_type (any shape) and returns a float64 array of the same shape.
+    '''
+    dtype_for_vector_type(vector_type)
+    float_values = np.asarray(dumb_vector_array).astype(np.float64)
+
+    if vector_type in C_VECTORTYPE_INT_SCALING:
+        scale, offset = C_VECTORTYPE_INT_SCALING[vector_type]
+        float_values /= scale
+        if offset:
+            float_values -= offset
+
+    return float_values
+
+def vectors_to_bytes(vectors, vector_type):
+    # vectors is a list of vectors (or an N X D array), all with the same number of dimensions
+    return bytearray(floats_to_dumb_vector_array(vectors, vector_type).tobytes())
+
+def bytes_to_vectors(dumb_vector_bytes, vector_type, num_dimensions):
+    # reverse of vectors_to_bytes, returns an N X D float64 array
+    dumb_vector_array = np.frombuffer(dumb_vector_bytes, dtype=dtype_for_vector_type(vector_type))
+    return dumb_vector_array_to_floats(dumb_vector_array.reshape(-1, num_dimensions), vector_type)
 
 def vector_to_bytes(vector, vector_type):
-    dumb_vector_bytes = bytearray()
-    for vector_value in vector:
-        vector_value_bytes = convert_dimension_value_float_to_dumb_vector_bytes(vector_value, vector_type)
-        dumb_vector_bytes += vector_value_bytes
-    return dumb_vector_bytes
+    return bytearray(floats_to_dumb_vector_array(vector, vector_type).tobytes())
 
 def bytes_to_vector(dumb_vector_bytes, vector_type):
-    vector = []
-    num_dimensions = len(dumb_vector_bytes) // number_of_bytes_for_vector_type(vector_type)
-    for i in range(num_dimensions):
-        vector_value_bytes = dumb_vector_bytes[i * number_of_bytes_for_vector_type(vector_type): (i + 1) * number_of_bytes_for_vector_type(vector_type)]
-        vector_value = convert_dumb_vector_bytes_to_dimension_value_float(vector_value_bytes, vector_type)
-        vector.append(vector_value)
-    return vector
+    dumb_vector_array = np.frombuffer(dumb_vector_bytes, dtype=dtype_for_vector_type(vector_type))
+    return dumb_vector_array_to_floats(dumb_vector_array, vector_type).tolist()
+
+def _triple_table_dtype(vector_type, num_dimensions):
+    # one record of the triple table: the vector, then the fileix, then the chunkix. No padding.
+    return np.dtype([
+        ('vector', dtype_for_vector_type(vector_type), (num_dimensions,)),
+        ('fileix', '<u4'),
+        ('chunkix', '<u4'),
+    ])
 
 def add_triple_table_bytes(dumb_vector_bytes, triples, vector_type):
-    # each pair is (vector, fileix)
-    for triple in triples:
-        vector, fileix, chunkix = triple
-        for vector_value in vector:
-            vector_value_bytes = convert_dimension_value_float_to_dumb_vector_bytes(vector_value, vector_type)
-            dumb_vector_bytes += vector_value_bytes
-        dumb_vector_bytes += fileix.to_bytes(4, byteorder='little', signed=False) # pathix is a positive int or zero
-        dumb_vector_bytes += chunkix.to_bytes(4, byteorder='little', signed=False) # chunkix is a positive int or zero
+    # each triple is (vector, fileix, chunkix)
+    if not triples:
+        return dumb_vector_bytes
+
+    vectors = np.asarray([triple[0] for triple in triples], dtype=np.float64)
+
+    triple_table = np.empty(len(triples), dtype=_triple_table_dtype(vector_type, vectors.shape[1]))
+    triple_table['vector'] = floats_to_dumb_vector_array(vectors, vector_type)
+    triple_table['fileix'] = [triple[1] for triple in triples] # fileix is a positive int or zero
+    triple_table['chunkix'] = [triple[2] for triple in triples] # chunkix is a positive int or zero
+
+    dumb_vector_bytes += triple_table.tobytes()
 
     return dumb_vector_bytes
 
@@ -227,9 +381,8 @@ def add_file_table_bytes(dumb_vector_bytes, file_pairs):
 
     return dumb_vector_bytes
 
-def add_header_bytes(dumb_vector_bytes, vector_type, num_dimensions, num_triples, num_files, num_paths, num_triple_table_bytes, num_file_table_bytes, num_path_table_bytes):
+def add_header_bytes(dumb_vector_bytes, vector_type, num_dimensions, num_triples, num_files, num_paths, num_triple_table_bytes, num_file_table_bytes, num_path_table_bytes, version_number=C_VERSION_1):
     dumb_vector_bytes += C_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
-    version_number = 0x00000001
     dumb_vector_bytes += version_number.to_bytes(4, byteorder='little', signed=False)
     dumb_vector_bytes += num_dimensions.to_bytes(4, byteorder='little', signed=False)
     dumb_vector_bytes += vector_type.to_bytes(1, byteorder='little', signed=False)
@@ -241,7 +394,12 @@ def add_header_bytes(dumb_vector_bytes, vector_type, num_dimensions, num_triples
     dumb_vector_bytes += num_triple_table_bytes.to_bytes(4, byteorder='little', signed=False)
     return dumb_vector_bytes
 
-def get_dumb_index_bytes(dumb_index, vector_type, num_dimensions):
+def get_dumb_index_bytes(dumb_index, vector_type, num_dimensions, version_number=C_VERSION_1, include_norms=True):
+    if version_number == C_VERSION_2:
+        return get_dumb_index_bytes_v2(dumb_index, vector_type, num_dimensions, include_norms)
+    elif version_number != C_VERSION_1:
+        raise Exception(f"Unknown dumb index version {version_number}")
+
     triples = dumb_index["triples"]
     paths = dumb_index["paths"]
     file_pairs = dumb_index["file_pairs"]
@@ -265,42 +423,242 @@ def get_dumb_index_bytes(dumb_index, vector_type, num_dimensions):
     dumb_index_bytes += path_table_bytes
     dumb_index_bytes += file_table_bytes
     dumb_index_bytes += triple_table_bytes
+    dumb_index_bytes += _get_dimension_mask_section_bytes(dumb_index.get("dimension_mask"))
 
     return dumb_index_bytes
 
-def get_triples_from_triple_table_bytes(triple_table_bytes, vector_type, num_dimensions, num_triples):
-    # reverse of add_triple_table_bytes
-    triples = []
-    vector_value_bytes_length = number_of_bytes_for_vector_type(vector_type)
+def align(num_bytes, alignment):
+    return (num_bytes + alignment - 1) // alignment * alignment
+
+def _get_dimension_mask_section_bytes(dimension_mask):
+    # empty if there's no mask, or it keeps every dimension
+    if dimension_mask is None:
+        return b""
+    dimension_mask = np.asarray(dimension_mask, dtype=np.uint8)
+    if dimension_mask.all():
+        return b""
+
+    dimension_mask_bytes = bytearray()
+    dimension_mask_bytes += C_DIMENSION_MASK_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
+    dimension_mask_bytes += len(dimension_mask).to_bytes(4, byteorder='little', signed=False)
+    dimension_mask_bytes += dimension_mask.tobytes()
+    return dimension_mask_bytes
+
+def _get_dimension_mask_from_section_bytes(dimension_mask_section_bytes):
+    # reverse of _get_dimension_mask_section_bytes. None if there's no section.
+    if len(dimension_mask_section_bytes) < C_DIMENSION_MASK_HEADER_SIZE:
+        return None
+    magic_number = int.from_bytes(dimension_mask_section_bytes[0:4], byteorder='little', signed=False)
+    if magic_number != C_DIMENSION_MASK_MAGIC_NUMBER:
+        return None
+    num_dimensions = int.from_bytes(dimension_mask_section_bytes[4:8], byteorder='little', signed=False)
+    mask_bytes = dimension_mask_section_bytes[C_DIMENSION_MASK_HEADER_SIZE:C_DIMENSION_MASK_HEADER_SIZE + num_dimensions]
+    return np.frombuffer(mask_bytes, dtype=np.uint8).tolist()
 
-    pos = 0
+def _get_dumb_index_prefix_bytes_v2(vector_type, num_dimensions, num_triples, num_paths, num_files, path_table_bytes, file_table_bytes, include_norms):
+    # everything in a version 2 file before the vector block: the header, the path and file tables, and padding
+    triple_table_bytes_count = num_triples * num_dimensions * number_of_bytes_for_vector_type(vector_type) + 4 * num_triples + 4 * num_triples
+    if include_norms:
+        triple_table_bytes_count += 4 * num_triples
 
-    for i in range(num_triples):
-        # read one pair
-        vector = []
+    dumb_index_bytes = bytearray()
+    dumb_index_bytes = add_header_bytes(
+        dumb_index_bytes, vector_type, num_dimensions,
+        num_triples, num_files, num_paths,
+        triple_table_bytes_count, len(file_table_bytes), len(path_table_bytes),
+        C_VERSION_2
+    )
+    flags = C_FLAG_NORMS if include_norms else 0
+    dumb_index_bytes += flags.to_bytes(1, byteorder='little', signed=False)
+    dumb_index_bytes += bytes(C_HEADER_SIZE_V2 - len(dumb_index_bytes))
 
-        for j in range(num_dimensions):
-            offset = pos + j * vector_value_bytes_length
-            vector_value_bytes = triple_table_bytes[offset:offset+vector_value_bytes_length]
-            vector_value = convert_dumb_vector_bytes_to_dimension_value_float(vector_value_bytes, vector_type)
-            vector.append(vector_value)
-        
-        pos += num_dimensions * vector_value_bytes_length
+    dumb_index_bytes += path_table_bytes
+    dumb_index_bytes += file_table_bytes
+    dumb_index_bytes += bytes(align(len(dumb_index_bytes), C_ALIGNMENT_V2) - len(dumb_index_bytes))
 
-        fileix_bytes = triple_table_bytes[pos:pos+4]
-        fileix = int.from_bytes(fileix_bytes, byteorder='little', signed=False)
+    return dumb_index_bytes
 
-        pos += 4
+def _get_dumb_index_bytes_v2_from_columns(vector_type, num_dimensions, num_paths, num_files, path_table_bytes, file_table_bytes, vectors, fileixs, chunkixs, norms, dimension_mask=None):
+    # vectors must already be in the dtype for vector_type
+    dumb_index_bytes = _get_dumb_index_prefix_bytes_v2(
+        vector_type, num_dimensions, len(vectors), num_paths, num_files,
+        path_table_bytes, file_table_bytes, norms is not None
+    )
 
-        chunkix_bytes = triple_table_bytes[pos:pos+4]
-        chunkix = int.from_bytes(chunkix_bytes, byteorder='little', signed=False)
+    dumb_index_bytes += np.ascontiguousarray(vectors).tobytes()
+    dumb_index_bytes += np.asarray(fileixs, dtype='<u4').tobytes()
+    dumb_index_bytes += np.asarray(chunkixs, dtype='<u4').tobytes()
+    if norms is not None:
+        dumb_index_bytes += np.asarray(norms, dtype='<f4').tobytes()
+    dumb_index_bytes += _get_dimension_mask_section_bytes(dimension_mask)
 
-        pos += 4
+    return dumb_index_bytes
 
-        triple = (vector, fileix, chunkix)
-        triples.append(triple)
-    
-    return triples
+def _calc_norms(vectors, vector_type):
+    # magnitudes of the vectors as the reader will see them, ie: after encoding and decoding
+    return np.linalg.norm(dumb_vector_array_to_floats(vectors, vector_type), axis=1).astype('<f4')
+
+def get_dumb_index_bytes_v2(dumb_index, vector_type, num_dimensions, include_norms=True):
+    triples = dumb_index["triples"]
+    paths = dumb_index["paths"]
+    file_pairs = dumb_index["file_pairs"]
+
+    path_table_bytes = bytearray()
+    path_table_bytes = add_path_table_bytes(path_table_bytes, paths)
+
+    file_table_bytes = bytearray()
+    file_table_bytes = add_file_table_bytes(file_table_bytes, file_pairs)
+
+    float_vectors = np.asarray([triple[0] for triple in triples], dtype=np.float64).reshape(len(triples), num_dimensions)
+    vectors = floats_to_dumb_vector_array(float_vectors, vector_type)
+    fileixs = np.asarray([triple[1] for triple in triples], dtype='<u4')
+    chunkixs = np.asarray([triple[2] for triple in triples], dtype='<u4')
+    norms = _calc_norms(vectors, vector_type) if include_norms else None
+
+    return _get_dumb_index_bytes_v2_from_columns(
+        vector_type, num_dimensions, len(paths), len(file_pairs),
+        path_table_bytes, file_table_bytes, vectors, fileixs, chunkixs, norms, dumb_index.get("dimension_mask")
+    )
+
+def convert_dumb_index_bytes_v1_to_v2(dumb_index_bytes, include_norms=True):
+    '''
+    Rewrites a version 1 dumb index as version 2. The stored vector values are copied as is (not decoded and 
+    re-encoded), so nothing is lost for the integer vector types. Version 2 input is returned unchanged.
+    '''
+    magic_number, version_number, num_dimensions, vector_type, \
+        num_paths, num_files, num_triples, \
+        num_path_table_bytes, num_file_table_bytes, num_triple_table_bytes, \
+        remainder_bytes = get_header_from_dumb_index_bytes(dumb_index_bytes)
+
+    if version_number == C_VERSION_2:
+        return dumb_index_bytes
+
+    path_table_bytes = remainder_bytes[0:num_path_table_bytes]
+    file_table_bytes_offset = num_path_table_bytes
+    file_table_bytes = remainder_bytes[file_table_bytes_offset:file_table_bytes_offset+num_file_table_bytes]
+    triple_table_bytes_offset = num_path_table_bytes+num_file_table_bytes
+    triple_table_bytes = remainder_bytes[triple_table_bytes_offset:triple_table_bytes_offset+num_triple_table_bytes]
+
+    dimension_mask = _get_dimension_mask_from_section_bytes(remainder_bytes[triple_table_bytes_offset+num_triple_table_bytes:])
+
+    triple_table = _get_triple_table_array(triple_table_bytes, vector_type, num_dimensions, num_triples)
+    vectors = triple_table['vector'].reshape(num_triples, num_dimensions)
+    norms = _calc_norms(vectors, vector_type) if include_norms else None
+
+    return _get_dumb_index_bytes_v2_from_columns(
+        vector_type, num_dimensions, num_paths, num_files,
+        path_table_bytes, file_table_bytes, vectors, triple_table['fileix'], triple_table['chunkix'], norms, dimension_mask
+    )
+
+def convert_dumb_index_file_v1_to_v2(filename, new_filename, include_norms=True):
+    with open(filename, "rb") as f:
+        dumb_index_bytes = f.read()
+    new_dumb_index_bytes = convert_dumb_index_bytes_v1_to_v2(dumb_index_bytes, include_norms)
+    with open(new_filename, "wb") as f:
+        f.write(new_dumb_index_bytes)
+
+def _get_triple_table_array(triple_table_bytes, vector_type, num_dimensions, num_triples):
+    # a version 1 triple table as a numpy record array (a view, no copying)
+    return np.frombuffer(triple_table_bytes, dtype=_triple_table_dtype(vector_type, num_dimensions), count=num_triples)
+
+# the streaming writer produces pieces of about this size
+C_STREAM_BUFFER_SIZE = 1024 * 1024
+
+def yield_dumb_index_bytes(dumb_index, vector_type, num_dimensions, version_number=C_VERSION_1, include_norms=True, buffer_size=C_STREAM_BUFFER_SIZE):
+    '''
+    Streaming version of get_dumb_index_bytes. Yields the file in pieces: the header (the table sizes are 
+    calculated ahead of time), the path and file tables, then the triple table encoded a block of triples at a time,
+    each piece about buffer_size bytes. Joining the pieces gives exactly the bytes get_dumb_index_bytes returns.
+    '''
+    triples = dumb_index["triples"]
+    paths = dumb_index["paths"]
+    file_pairs = dumb_index["file_pairs"]
+    num_triples = len(triples)
+
+    path_table_bytes = bytearray()
+    path_table_bytes = add_path_table_bytes(path_table_bytes, paths)
+
+    file_table_bytes = bytearray()
+    file_table_bytes = add_file_table_bytes(file_table_bytes, file_pairs)
+
+    vector_bytes_count = num_dimensions * number_of_bytes_for_vector_type(vector_type)
+
+    if version_number == C_VERSION_1:
+        record_bytes_count = vector_bytes_count + 8
+        header_bytes = bytearray()
+        header_bytes = add_header_bytes(
+            header_bytes, vector_type, num_dimensions,
+            num_triples, len(file_pairs), len(paths),
+            num_triples * record_bytes_count, len(file_table_bytes), len(path_table_bytes)
+        )
+        yield header_bytes
+        yield path_table_bytes
+        yield file_table_bytes
+
+        triples_per_block = max(1, buffer_size // record_bytes_count)
+        for start in range(0, num_triples, triples_per_block):
+            yield add_triple_table_bytes(bytearray(), triples[start:start+triples_per_block], vector_type)
+
+    elif version_number == C_VERSION_2:
+        yield _get_dumb_index_prefix_bytes_v2(
+            vector_type, num_dimensions, num_triples, len(paths), len(file_pairs),
+            path_table_bytes, file_table_bytes, include_norms
+        )
+
+        def yield_vector_blocks():
+            triples_per_block = max(1, buffer_size // max(1, vector_bytes_count))
+            for start in range(0, num_triples, triples_per_block):
+                block = triples[start:start+triples_per_block]
+                float_vectors = np.asarray([triple[0] for triple in block], dtype=np.float64).reshape(len(block), num_dimensions)
+                yield floats_to_dumb_vector_array(float_vectors, vector_type)
+
+        for vectors in yield_vector_blocks():
+            yield vectors.tobytes()
+
+        ixs_per_block = max(1, buffer_size // 4)
+        for triple_position in (1, 2):
+            for start in range(0, num_triples, ixs_per_block):
+                block = triples[start:start+ixs_per_block]
+                yield np.asarray([triple[triple_position] for triple in block], dtype='<u4').tobytes()
+
+        if include_norms:
+            # second pass over the vectors, so we don't have to hold them all
+            for vectors in yield_vector_blocks():
+                yield _calc_norms(vectors, vector_type).tobytes()
+
+    else:
+        raise Exception(f"Unknown dumb index version {version_number}")
+
+    dimension_mask_section_bytes = _get_dimension_mask_section_bytes(dumb_index.get("dimension_mask"))
+    if dimension_mask_section_bytes:
+        yield dimension_mask_section_bytes
+
+def write_dumb_index_to_fileobj(f, dumb_index, vector_type, num_dimensions, version_number=C_VERSION_1, include_norms=True, buffer_size=C_STREAM_BUFFER_SIZE):
+    # f is any binary file like object with a write method. include_norms only applies to version 2.
+    for dumb_index_bytes in yield_dumb_index_bytes(dumb_index, vector_type, num_dimensions, version_number, include_norms, buffer_size=buffer_size):
+        f.write(dumb_index_bytes)
+
+def get_arrays_from_triple_table_bytes(triple_table_bytes, vector_type, num_dimensions, num_triples):
+    '''
+    Reads a version 1 triple table in one go, as a numpy record array over the bytes, rather than record by record.
+    Returns (vectors, fileixs, chunkixs), where vectors is an N X D float64 array and the others are uint32 arrays.
+    '''
+    triple_table = _get_triple_table_array(triple_table_bytes, vector_type, num_dimensions, num_triples)
+
+    vectors = dumb_vector_array_to_floats(triple_table['vector'], vector_type).reshape(num_triples, num_dimensions)
+    fileixs = np.ascontiguousarray(triple_table['fileix'])
+    chunkixs = np.ascontiguousarray(triple_table['chunkix'])
+
+    return vectors, fileixs, chunkixs
+
+def get_triples_from_triple_table_bytes(triple_table_bytes, vector_type, num_dimensions, num_triples):
+    # reverse of add_triple_table_bytes
+    if not num_triples:
+        return []
+
+    vectors, fileixs, chunkixs = get_arrays_from_triple_table_bytes(triple_table_bytes, vector_type, num_dimensions, num_triples)
+
+    return list(zip(vectors.tolist(), fileixs.tolist(), chunkixs.tolist()))
 
 def get_paths_from_path_table_bytes(path_table_bytes, num_paths):
     # reverse of add_path_table_bytes
@@ -311,7 +669,7 @@ def get_paths_from_path_table_bytes(path_table_bytes, num_paths):
         path_length = int.from_bytes(path_length_bytes, byteorder='little', signed=False)
         pos += 4
         path_bytes = path_table_bytes[pos:pos+path_length]
-        path = path_bytes.decode('utf-8')
+        path = bytes(path_bytes).decode('utf-8')
         pos += path_length
         paths.append(path)
     return paths
@@ -328,14 +686,16 @@ def get_file_pairs_from_file_table_bytes(file_table_bytes, num_files):
         file_length = int.from_bytes(file_length_bytes, byteorder='little', signed=False)
         pos += 4
         file_bytes = file_table_bytes[pos:pos+file_length]
-        file = file_bytes.decode('utf-8')
+        file = bytes(file_bytes).decode('utf-8')
         pos += file_length
         file_pair = (pathix, file)
         file_pairs.append(file_pair)
     return file_pairs
 
 def get_header_from_dumb_index_bytes(dumb_index_bytes):
-    # reverse of add_header_bytes
+    # reverse of add_header_bytes. remainder_bytes is a memoryview, so we don't copy the rest of the file
+    dumb_index_bytes = memoryview(dumb_index_bytes)
+
     magic_number_bytes = dumb_index_bytes[0:4]
     magic_number = int.from_bytes(magic_number_bytes, byteorder='little', signed=False)
     if magic_number != C_MAGIC_NUMBER:
@@ -343,8 +703,8 @@ def get_header_from_dumb_index_bytes(dumb_index_bytes):
     
     version_number_bytes = dumb_index_bytes[4:8]
     version_number = int.from_bytes(version_number_bytes, byteorder='little', signed=False)
-    if version_number != 0x00000001:
-        raise Exception("Version number not supported in dumb index file (expected 1, got " + str(version_number) + ")")
+    if version_number not in (C_VERSION_1, C_VERSION_2):
+        raise Exception("Version number not supported in dumb index file (expected 1 or 2, got " + str(version_number) + ")")
 
     num_dimensions_bytes = dumb_index_bytes[8:12]
     num_dimensions = int.from_bytes(num_dimensions_bytes, byteorder='little', signed=False)
@@ -363,19 +723,99 @@ def get_header_from_dumb_index_bytes(dumb_index_bytes):
     num_triple_table_bytes_bytes = dumb_index_bytes[33:37]
     num_triple_table_bytes = int.from_bytes(num_triple_table_bytes_bytes, byteorder='little', signed=False)
 
-    remainder_bytes = dumb_index_bytes[37:]
+    header_size = C_HEADER_SIZE_V2 if version_number == C_VERSION_2 else C_HEADER_SIZE_V1
+    remainder_bytes = dumb_index_bytes[header_size:]
 
     return magic_number, version_number, num_dimensions, vector_type, \
         num_paths, num_files, num_triples, \
         num_path_table_bytes, num_file_table_bytes, num_triple_table_bytes, \
         remainder_bytes
 
+def get_columnar_dumb_index_from_bytes(dumb_index_bytes):
+    '''
+    Reads a dumb index as columns, without decoding the triples. dumb_index_bytes can be anything supporting the
+    buffer protocol (bytes, bytearray, mmap). "vectors" is an N X D array viewing the stored vectors directly (no 
+    decoding or copying), in the dtype for the vector type. For the float types these are the vectors; for the 
+    integer types they are the scaled integers (use dumb_vector_array_to_floats to get floats back). 
+    
+    For version 2 the vectors are one contiguous block. For version 1 they are a strided view over the triple table.
+    Norms are None if not stored (always for version 1). "dimension_mask" is None if the index wasn't built with one.
+    '''
+    # slicing a memoryview doesn't copy
+    dumb_index_bytes = memoryview(dumb_index_bytes)
+
+    magic_number, version_number, num_dimensions, vector_type, \
+        num_paths, num_files, num_triples, \
+        num_path_table_bytes, num_file_table_bytes, num_triple_table_bytes, \
+        remainder_bytes = get_header_from_dumb_index_bytes(dumb_index_bytes)
+
+    path_table_bytes = remainder_bytes[0:num_path_table_bytes]
+    file_table_bytes = remainder_bytes[num_path_table_bytes:num_path_table_bytes+num_file_table_bytes]
+
+    paths = get_paths_from_path_table_bytes(path_table_bytes, num_paths)
+    file_pairs = get_file_pairs_from_file_table_bytes(file_table_bytes, num_files)
+
+    if version_number == C_VERSION_1:
+        triple_table_bytes_offset = num_path_table_bytes+num_file_table_bytes
+        triple_table_bytes = remainder_bytes[triple_table_bytes_offset:triple_table_bytes_offset+num_triple_table_bytes]
+        triple_table = _get_triple_table_array(triple_table_bytes, vector_type, num_dimensions, num_triples)
+        return {
+            "paths": paths,
+            "file_pairs": file_pairs,
+            "vectors": triple_table['vector'].reshape(num_triples, num_dimensions),
+            "fileixs": triple_table['fileix'],
+            "chunkixs": triple_table['chunkix'],
+            "norms": None,
+            "vector_type": vector_type,
+            "dimension_mask": _get_dimension_mask_from_section_bytes(remainder_bytes[triple_table_bytes_offset+num_triple_table_bytes:])
+        }
+
+    flags = dumb_index_bytes[C_HEADER_SIZE_V1]
+
+    # the columns are views over dumb_index_bytes
+    offset = align(C_HEADER_SIZE_V2 + num_path_table_bytes + num_file_table_bytes, C_ALIGNMENT_V2)
+    dimension_mask = _get_dimension_mask_from_section_bytes(dumb_index_bytes[offset+num_triple_table_bytes:])
+    vectors = np.frombuffer(dumb_index_bytes, dtype=dtype_for_vector_type(vector_type), count=num_triples * num_dimensions, offset=offset)
+    vectors = vectors.reshape(num_triples, num_dimensions)
+    offset += vectors.nbytes
+    fileixs = np.frombuffer(dumb_index_bytes, dtype='<u4', count=num_triples, offset=offset)
+    offset += fileixs.nbytes
+    chunkixs = np.frombuffer(dumb_index_bytes, dtype='<u4', count=num_triples, offset=offset)
+    offset += chunkixs.nbytes
+    norms = None
+    if flags & C_FLAG_NORMS:
+        norms = np.frombuffer(dumb_index_bytes, dtype='<f4', count=num_triples, offset=offset)
+
+    return {
+        "paths": paths,
+        "file_pairs": file_pairs,
+        "vectors": vectors,
+        "fileixs": fileixs,
+        "chunkixs": chunkixs,
+        "norms": norms,
+        "vector_type": vector_type,
+        "dimension_mask": dimension_mask
+    }
+
+def get_triples_from_columnar_dumb_index(columnar_dumb_index):
+    vectors = dumb_vector_array_to_floats(columnar_dumb_index["vectors"], columnar_dumb_index["vector_type"]).tolist()
+    return list(zip(vectors, columnar_dumb_index["fileixs"].tolist(), columnar_dumb_index["chunkixs"].tolist()))
+
 def get_dumb_index_from_bytes(dumb_index_bytes):
     magic_number, version_number, num_dimensions, vector_type, \
         num_paths, num_files, num_triples, \
         num_path_table_bytes, num_file_table_bytes, num_triple_table_bytes, \
         remainder_bytes = get_header_from_dumb_index_bytes(dumb_index_bytes)
-    
+
+    if version_number == C_VERSION_2:
+        columnar_dumb_index = get_columnar_dumb_index_from_bytes(dumb_index_bytes)
+        return {
+            "paths": columnar_dumb_index["paths"],
+            "file_pairs": columnar_dumb_index["file_pairs"],
+            "triples": get_triples_from_columnar_dumb_index(columnar_dumb_index),
+            "dimension_mask": columnar_dumb_index["dimension_mask"]
+        }
+
     path_table_bytes = remainder_bytes[0:num_path_table_bytes]
     file_table_bytes_offset = num_path_table_bytes
     file_table_bytes = remainder_bytes[file_table_bytes_offset:file_table_bytes_offset+num_file_table_bytes]
@@ -385,202 +825,1155 @@ def get_dumb_index_from_bytes(dumb_index_bytes):
     paths = get_paths_from_path_table_bytes(path_table_bytes, num_paths)
     file_pairs = get_file_pairs_from_file_table_bytes(file_table_bytes, num_files)
     triples = get_triples_from_triple_table_bytes(triple_table_bytes, vector_type, num_dimensions, num_triples)
+    dimension_mask = _get_dimension_mask_from_section_bytes(remainder_bytes[triple_table_bytes_offset+num_triple_table_bytes:])
 
     return {
         "paths": paths,
         "file_pairs": file_pairs,
-        "triples": triples
+        "triples": triples,
+        "dimension_mask": dimension_mask
     }
 
-# C_CHUNKIX = "_chunkix_"
-
-def write_chunks_to_s3(boto3_session, s3_bucket, s3_path, s3_file, chunks):
-    s3 = boto3_session.resource('s3')
+# compression for objects in s3. Compressed objects are recognised by their magic number when they are read.
+C_COMPRESSION_ZLIB = "zlib"
+C_COMPRESSION_GZIP = "gzip"
+C_COMPRESSION_LZMA = "lzma"
+
+C_COMPRESSION_MAGIC_NUMBERS = {
+    C_COMPRESSION_GZIP: b"\x1f\x8b",
+    C_COMPRESSION_LZMA: b"\xfd7zXZ\x00",
+    # a zlib stream starts with 0x78 for the default 32K window. Nothing else we write starts with 'x'.
+    C_COMPRESSION_ZLIB: b"\x78",
+}
+
+# Content-Encoding set on compressed s3 objects, for anything else that looks at them
+C_COMPRESSION_CONTENT_ENCODINGS = {
+    C_COMPRESSION_ZLIB: "deflate",
+    C_COMPRESSION_GZIP: "gzip",
+    C_COMPRESSION_LZMA: "xz",
+}
+
+# compressed s3 objects are read and decompressed this many bytes at a time
+C_S3_READ_BLOCK_SIZE = 1024 * 1024
+
+def _get_compressor(compression, compression_level=None):
+    if compression == C_COMPRESSION_ZLIB:
+        return zlib.compressobj(-1 if compression_level is None else compression_level)
+    elif compression == C_COMPRESSION_GZIP:
+        # wbits 16 + 15 makes zlib write a gzip header and trailer
+        return zlib.compressobj(-1 if compression_level is None else compression_level, zlib.DEFLATED, 16 + 15)
+    elif compression == C_COMPRESSION_LZMA:
+        return lzma.LZMACompressor(preset=compression_level)
+    else:
+        raise Exception(f"Unknown compression {compression}")
+
+def get_compression(data_bytes):
+    # the compression of some bytes (the start of them is enough), or None if they aren't compressed
+    for compression, magic_number in C_COMPRESSION_MAGIC_NUMBERS.items():
+        if bytes(data_bytes[0:len(magic_number)]) == magic_number:
+            return compression
+    return None
+
+def _get_decompressor(compression):
+    if compression == C_COMPRESSION_ZLIB:
+        return zlib.decompressobj()
+    elif compression == C_COMPRESSION_GZIP:
+        return zlib.decompressobj(16 + 15)
+    elif compression == C_COMPRESSION_LZMA:
+        return lzma.LZMADecompressor()
+    else:
+        raise Exception(f"Unknown compression {compression}")
+
+def yield_compressed_pieces(pieces, compression, compression_level=None):
+    # compresses an iterable of byte pieces as they go by, without holding them all
+    compressor = _get_compressor(compression, compression_level)
+    for piece in pieces:
+        compressed_piece = compressor.compress(piece)
+        if compressed_piece:
+            yield compressed_piece
+    yield compressor.flush()
+
+def compress_bytes(data_bytes, compression, compression_level=None):
+    return b"".join(yield_compressed_pieces([data_bytes], compression, compression_level))
+
+def decompress_bytes(data_bytes):
+    # decompresses data_bytes if they are compressed, otherwise returns them as they are
+    compression = get_compression(data_bytes)
+    if compression is None:
+        return data_bytes
+    decompressor = _get_decompressor(compression)
+    decompressed_bytes = decompressor.decompress(data_bytes)
+    _check_decompressor_eof(decompressor)
+    return decompressed_bytes
+
+def _check_decompressor_eof(decompressor):
+    # a compressed stream that stops before its end marker has been cut short
+    if not decompressor.eof:
+        raise Exception("Compressed data is truncated")
+
+def _read_s3_body(body, content_length=None, block_size=C_S3_READ_BLOCK_SIZE):
+    '''
+    Reads a get_object body into a bytearray (returned as is, so the data is never copied again at the end). An 
+    uncompressed body is read straight into a buffer of content_length (the response's ContentLength) if it's given.
+    A compressed one is decompressed a block at a time as it downloads, so the whole compressed object is never held
+    alongside the decompressed one, and raises if the stream is truncated.
+    '''
+    blocks = body.iter_chunks(block_size)
+    first_block = next(blocks, b"")
+    compression = get_compression(first_block)
+    if compression is None:
+        if content_length is None:
+            data_bytes = bytearray(first_block)
+            for block in blocks:
+                data_bytes += block
+            return data_bytes
+
+        data_bytes = bytearray(content_length)
+        offset = 0
+        for block in itertools.chain([first_block], blocks):
+            if offset + len(block) > content_length:
+                raise Exception(f"S3 object is longer than its ContentLength of {content_length} bytes")
+            data_bytes[offset:offset + len(block)] = block
+            offset += len(block)
+        if offset != content_length:
+            raise Exception(f"S3 object is truncated ({offset} of {content_length} bytes)")
+        return data_bytes
+
+    decompressor = _get_decompressor(compression)
+    data_bytes = bytearray(decompressor.decompress(first_block))
+    for block in blocks:
+        data_bytes += decompressor.decompress(block)
+    _check_decompressor_eof(decompressor)
+    return data_bytes
+
+# max connections in each shared S3 client's pool (the botocore default is 10)
+C_S3_MAX_POOL_CONNECTIONS = 32
+
+C_S3_CLIENTS = weakref.WeakKeyDictionary()
+C_S3_CLIENTS_LOCK = threading.Lock()
+
+def get_s3_client(boto3_session, max_pool_connections=None):
+    '''
+    Returns the shared S3 client for boto3_session, creating it the first time. boto3 clients are thread safe, and 
+    keeping one per session means its pooled, kept alive connections are reused across calls instead of being set 
+    up again (including TLS) every time. max_pool_connections only has an effect when the client is created.
+    Call close_s3_clients at shutdown.
+    '''
+    with C_S3_CLIENTS_LOCK:
+        s3_client = C_S3_CLIENTS.get(boto3_session)
+        if s3_client is None:
+            config = botocore.config.Config(
+                max_pool_connections=max_pool_connections or C_S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True
+            )
+            s3_client = boto3_session.client('s3', config=config)
+            C_S3_CLIENTS[boto3_session] = s3_client
+        return s3_client
+
+def close_s3_clients(boto3_session=None):
+    # closes the shared S3 client for boto3_session, or all of them
+    with C_S3_CLIENTS_LOCK:
+        boto3_sessions = [boto3_session] if boto3_session is not None else list(C_S3_CLIENTS.keys())
+        for this_boto3_session in boto3_sessions:
+            s3_client = C_S3_CLIENTS.pop(this_boto3_session, None)
+            if s3_client is not None:
+                s3_client.close()
+
+# S3 multipart parts must be at least 5MB (except the last one)
+C_S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# ranged reads from S3 are split into pieces of this size, fetched concurrently
+C_S3_RANGE_SIZE = 8 * 1024 * 1024
+
+# number of concurrent S3 requests for multipart uploads and ranged reads
+C_S3_MAX_WORKERS = 8
+
+# each multipart part is retried this many times, waiting C_S3_RETRY_BACKOFF * 2^attempt seconds in between
+C_S3_PART_RETRIES = 3
+C_S3_RETRY_BACKOFF = 0.5
+
+def _upload_part_to_s3(s3_client, s3_bucket, path, upload_id, part_number, part_bytes, max_retries=C_S3_PART_RETRIES):
+    attempt = 0
+    while True:
+        try:
+            response = s3_client.upload_part(
+                Bucket=s3_bucket, Key=path, UploadId=upload_id, 
+                PartNumber=part_number, Body=part_bytes
+            )
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            if attempt >= max_retries:
+                raise
+            print (f"retrying part {part_number} of {path} after error: {e}")
+            time.sleep(C_S3_RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
 
-    try:
-        # check the extension
-        if not s3_file.endswith(".json"):
-            raise Exception("s3_file must end with .json")
-        
-        # check there are no path separators in the file name
-        if "/" in s3_file:
-            raise Exception("s3_file must not contain any path separators")
+def _write_pieces_to_s3(s3_client, s3_bucket, path, pieces, part_size=C_S3_MULTIPART_PART_SIZE, max_workers=C_S3_MAX_WORKERS, max_retries=C_S3_PART_RETRIES, compression=None, compression_level=None):
+    '''
+    Uploads an iterable of byte pieces to one S3 object. If the whole thing fits in one part it is a plain put, 
+    otherwise a multipart upload with up to max_workers parts uploading concurrently, so at most about 
+    (max_workers + 1) * part_size bytes are held at a time. Failed parts are retried on their own, and if a part 
+    still fails the upload is aborted.
 
-        # for chunkix, chunk in enumerate(chunks):
-        #     chunk[C_CHUNKIX] = chunkix
+    With compression, the pieces are compressed on the way through, and the object's Content-Encoding is set.
 
-        path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+    Returns the ETag of the new object.
+    '''
+    extra_args = {}
+    if compression is not None:
+        pieces = yield_compressed_pieces(pieces, compression, compression_level)
+        extra_args['ContentEncoding'] = C_COMPRESSION_CONTENT_ENCODINGS[compression]
+
+    buffer = bytearray()
+    upload_id = None
+    parts = []
+    pending = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit_part(part_bytes):
+        part_number = len(parts) + len(pending) + 1
+        pending.add(executor.submit(_upload_part_to_s3, s3_client, s3_bucket, path, upload_id, part_number, part_bytes, max_retries))
+
+        # don't hold more parts than there are workers to upload them
+        while len(pending) >= max_workers:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                parts.append(future.result())
 
-        s3_object = s3.Object(s3_bucket, path)
-
-        # REMOVED THIS CHECK, NOT WORTH IT
-        # # check if the object already exists, using ObjectSummary
-
-        # try:
-        #     # an s3 error will be thrown if the object doesn't exist
-        #     s3.ObjectSummary(s3_bucket, path).load()
-        #     print ("chunk already exists in s3")
-        #     return None
-        #     # existing_chunk = read_chunk_from_s3(boto3_session, s3_bucket, s3_path, chunk_id, cache=False)
-        #     # return existing_chunk
-        # except botocore.exceptions.ClientError as e:
-        #     print (e)
-        #     #botocore.errorfactory.NoSuchKey
-        #     if e.response['Error']['Code'] == "404":
-        #         # The object does not exist.
-        #         pass
-        #     else:
-        #         # Something else has gone wrong.
-        #         raise
-
-        # here we know the object doesn't exist, so we can write it
-        chunks_json = json.dumps(chunks)
-        s3_object.put(Body=chunks_json)
+    try:
+        for piece in pieces:
+            buffer += piece
+            while len(buffer) >= part_size:
+                if upload_id is None:
+                    upload_id = s3_client.create_multipart_upload(Bucket=s3_bucket, Key=path, **extra_args)['UploadId']
+                submit_part(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        if upload_id is None:
+            return s3_client.put_object(Bucket=s3_bucket, Key=path, Body=bytes(buffer), **extra_args)['ETag']
+
+        if buffer:
+            submit_part(bytes(buffer))
+
+        for future in concurrent.futures.as_completed(pending):
+            parts.append(future.result())
+        pending.clear()
+
+        parts.sort(key=lambda part: part['PartNumber'])
+        return s3_client.complete_multipart_upload(
+            Bucket=s3_bucket, Key=path, UploadId=upload_id, 
+            MultipartUpload={'Parts': parts}
+        )['ETag']
+    except Exception:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=path, UploadId=upload_id)
+        raise
     finally:
-        s3.meta.client.close()
+        executor.shutdown(wait=True)
 
-    return chunks
+# C_CHUNKIX = "_chunkix_"
 
-def _get_chunks_from_s3_object(s3_object):
+C_CHUNK_CONTAINER_MAGIC_NUMBER = 0xfeedc0de
+C_CHUNK_CONTAINER_VERSION = 0x00000001
+C_CHUNK_CONTAINER_HEADER_SIZE = 12
+C_CHUNK_CONTAINER_EXTENSION = ".chunks"
+
+# chunk fields holding base64 text, which chunk containers store as raw bytes
+C_CHUNK_CONTAINER_BINARY_FIELDS = ("embedding",)
+
+# the first Range request for a chunk from a chunk container fetches this much, which usually covers the offset table
+C_CHUNK_CONTAINER_HEAD_READ_SIZE = 64 * 1024
+# records of the same chunk container less than this far apart are fetched with one Range request, gap and all
+C_CHUNK_CONTAINER_MAX_RANGE_GAP = 256 * 1024
+
+def _get_chunk_record_bytes(chunk, binary_fields):
+    json_chunk = dict(chunk)
+    binary_values = []
+    for field in binary_fields:
+        value = chunk.get(field)
+        if not isinstance(value, str):
+            continue
+        try:
+            value_bytes = base64.b64decode(value, validate=True)
+        except binascii.Error:
+            continue
+        # only store it as bytes if we'll get exactly the same text back
+        if base64.b64encode(value_bytes).decode('utf-8') != value:
+            continue
+        del json_chunk[field]
+        binary_values.append((field, value_bytes))
+
+    record_bytes = bytearray()
+    json_bytes = json.dumps(json_chunk).encode('utf-8')
+    record_bytes += len(json_bytes).to_bytes(4, byteorder='little', signed=False)
+    record_bytes += json_bytes
+    record_bytes += len(binary_values).to_bytes(4, byteorder='little', signed=False)
+    for field, value_bytes in binary_values:
+        field_bytes = field.encode('utf-8')
+        record_bytes += len(field_bytes).to_bytes(4, byteorder='little', signed=False)
+        record_bytes += field_bytes
+        record_bytes += len(value_bytes).to_bytes(4, byteorder='little', signed=False)
+        record_bytes += value_bytes
+    return record_bytes
+
+def _get_chunk_from_record_bytes(record_bytes):
+    # reverse of _get_chunk_record_bytes
+    pos = 0
+    json_length = int.from_bytes(record_bytes[pos:pos+4], byteorder='little', signed=False)
+    pos += 4
+    chunk = json.loads(bytes(record_bytes[pos:pos+json_length]).decode('utf-8'))
+    pos += json_length
+    num_binary_values = int.from_bytes(record_bytes[pos:pos+4], byteorder='little', signed=False)
+    pos += 4
+    for i in range(num_binary_values):
+        field_length = int.from_bytes(record_bytes[pos:pos+4], byteorder='little', signed=False)
+        pos += 4
+        field = bytes(record_bytes[pos:pos+field_length]).decode('utf-8')
+        pos += field_length
+        value_length = int.from_bytes(record_bytes[pos:pos+4], byteorder='little', signed=False)
+        pos += 4
+        chunk[field] = base64.b64encode(record_bytes[pos:pos+value_length]).decode('utf-8')
+        pos += value_length
+    return chunk
+
+def get_chunk_container_bytes(chunks, binary_fields=C_CHUNK_CONTAINER_BINARY_FIELDS):
+    records = [_get_chunk_record_bytes(chunk, binary_fields) for chunk in chunks]
+
+    chunk_container_bytes = bytearray()
+    chunk_container_bytes += C_CHUNK_CONTAINER_MAGIC_NUMBER.to_bytes(4, byteorder='little', signed=False)
+    chunk_container_bytes += C_CHUNK_CONTAINER_VERSION.to_bytes(4, byteorder='little', signed=False)
+    chunk_container_bytes += len(records).to_bytes(4, byteorder='little', signed=False)
+
+    offset = C_CHUNK_CONTAINER_HEADER_SIZE + 8 * (len(records) + 1)
+    for record_bytes in records:
+        chunk_container_bytes += offset.to_bytes(8, byteorder='little', signed=False)
+        offset += len(record_bytes)
+    chunk_container_bytes += offset.to_bytes(8, byteorder='little', signed=False)
+
+    for record_bytes in records:
+        chunk_container_bytes += record_bytes
+
+    return chunk_container_bytes
+
+def is_chunk_container_bytes(chunk_file_bytes):
+    return len(chunk_file_bytes) >= 4 and \
+        int.from_bytes(chunk_file_bytes[0:4], byteorder='little', signed=False) == C_CHUNK_CONTAINER_MAGIC_NUMBER
+
+def _get_num_chunks_from_chunk_container_header(header_bytes):
+    if not is_chunk_container_bytes(header_bytes):
+        raise Exception("This is not a chunk container (magic number not found)")
+    version_number = int.from_bytes(header_bytes[4:8], byteorder='little', signed=False)
+    if version_number != C_CHUNK_CONTAINER_VERSION:
+        raise Exception("Version number not supported in chunk container (expected 1, got " + str(version_number) + ")")
+    return int.from_bytes(header_bytes[8:12], byteorder='little', signed=False)
+
+def get_chunks_from_chunk_container_bytes(chunk_container_bytes):
+    chunk_container_bytes = memoryview(chunk_container_bytes)
+    num_chunks = _get_num_chunks_from_chunk_container_header(chunk_container_bytes)
+    offsets = struct.unpack_from(f'<{num_chunks + 1}Q', chunk_container_bytes, C_CHUNK_CONTAINER_HEADER_SIZE)
+    return [
+        _get_chunk_from_record_bytes(chunk_container_bytes[offsets[chunkix]:offsets[chunkix + 1]])
+        for chunkix in range(num_chunks)
+    ]
+
+def read_chunk_from_chunk_container_file(filename, chunkix):
+    # reads one chunk from a local chunk container, seeking straight to it. Returns None if there's no such chunk.
+    with open(filename, "rb") as f:
+        num_chunks = _get_num_chunks_from_chunk_container_header(f.read(C_CHUNK_CONTAINER_HEADER_SIZE))
+        if chunkix >= num_chunks:
+            return None
+        f.seek(C_CHUNK_CONTAINER_HEADER_SIZE + 8 * chunkix)
+        start, end = struct.unpack('<QQ', f.read(16))
+        f.seek(start)
+        return _get_chunk_from_record_bytes(f.read(end - start))
+
+def _get_chunk_from_s3_chunk_container(s3_client, s3_bucket, path, chunkix):
+    '''
+    Reads one chunk from a chunk container on s3 using Range requests, see _get_chunks_from_s3_chunk_container.
+    Returns (chunk, number of bytes of the record), or (None, 0) if there's no such chunk.
+    '''
+    return _get_chunks_from_s3_chunk_container(s3_client, s3_bucket, path, [chunkix]).get(chunkix, (None, 0))
+
+def _get_chunks_from_s3_chunk_container(s3_client, s3_bucket, path, chunkixs, max_range_gap=C_CHUNK_CONTAINER_MAX_RANGE_GAP):
+    '''
+    Reads some chunks from a chunk container on s3 using Range requests: one for the start of the file (the header and
+    usually the offsets we need), one for the offsets if they weren't in that, and one covering the records of each 
+    run of chunks less than max_range_gap bytes apart (so usually one for all of them) if they weren't either.
+    Returns chunkix -> (chunk, number of bytes of the record) for those of chunkixs the container has.
+    '''
     try:
-        chunks_json = s3_object.get()['Body'].read().decode('utf-8')
+        head_bytes = _get_s3_object_range(s3_client, s3_bucket, path, 0, C_CHUNK_CONTAINER_HEAD_READ_SIZE)
     except botocore.exceptions.ClientError as e:
         print (e)
         #botocore.errorfactory.NoSuchKey
         if e.response['Error']['Code'] == "NoSuchKey":
-            # The object does not exist.
-            return []
+            return {}
         else:
             # Something else has gone wrong.
             raise
-    chunks = json.loads(chunks_json)
+
+    num_chunks = _get_num_chunks_from_chunk_container_header(head_bytes)
+    chunkixs = sorted(set(chunkix for chunkix in chunkixs if chunkix < num_chunks))
+    if not chunkixs:
+        return {}
+
+    # the offsets from the first chunk we want to the end of the last
+    first_offset_pos = C_CHUNK_CONTAINER_HEADER_SIZE + 8 * chunkixs[0]
+    end_offset_pos = C_CHUNK_CONTAINER_HEADER_SIZE + 8 * (chunkixs[-1] + 2)
+    if end_offset_pos <= len(head_bytes):
+        offset_bytes = head_bytes[first_offset_pos:end_offset_pos]
+    else:
+        offset_bytes = _get_s3_object_range(s3_client, s3_bucket, path, first_offset_pos, end_offset_pos)
+    offsets = struct.unpack(f'<{chunkixs[-1] - chunkixs[0] + 2}Q', offset_bytes)
+
+    def get_record_range(chunkix):
+        return offsets[chunkix - chunkixs[0]], offsets[chunkix - chunkixs[0] + 1]
+
+    # group the chunks into runs whose records are close enough to fetch together
+    runs = []
+    for chunkix in chunkixs:
+        start, end = get_record_range(chunkix)
+        if runs and start - runs[-1][1] < max_range_gap:
+            runs[-1][1] = max(runs[-1][1], end)
+            runs[-1][2].append(chunkix)
+        else:
+            runs.append([start, end, [chunkix]])
+
+    chunks = {}
+    for run_start, run_end, run_chunkixs in runs:
+        if run_end <= len(head_bytes):
+            run_bytes = head_bytes[run_start:run_end]
+        else:
+            run_bytes = _get_s3_object_range(s3_client, s3_bucket, path, run_start, run_end)
+        run_bytes = memoryview(run_bytes)
+        for chunkix in run_chunkixs:
+            start, end = get_record_range(chunkix)
+            chunks[chunkix] = (_get_chunk_from_record_bytes(run_bytes[start - run_start:end - run_start]), end - start)
     return chunks
 
-C_CHUNK_CACHE = {}
-C_S3_KEY_CACHE = {}
+# The manifest of a chunk prefix lists every chunk file directly under it, with its key, size, ETag and number of 
+# chunks, so the files can be enumerated with one GET instead of a LIST. It doesn't end in .json, so it is never 
+# mistaken for a chunk file.
+#
+# A manifest can also have an "indexes" section: for each dumb index written to the prefix, the ETag of the index 
+# object and the file_etags it was built from (see write_dumb_index_to_s3), so a later process can rebuild it 
+# incrementally.
+#
+# Manifests are updated with a read-modify-write, written back with a conditional put on the ETag that was read 
+# (If-None-Match for a new one), and the update is retried from the read if another writer got there first. So 
+# recording a file costs a HEAD, a GET and a PUT.
+C_MANIFEST_FILE = "_manifest.chunkmanifest"
+C_MANIFEST_VERSION = 1
+C_MANIFEST_MAX_ATTEMPTS = 5
+
+def _is_chunk_file(s3_file):
+    return s3_file.endswith(".json") or s3_file.endswith(C_CHUNK_CONTAINER_EXTENSION)
+
+def _get_manifest_entry(s3_object, num_chunks=None):
+    # s3_object is a head_object response or a list_objects_v2 entry. num_chunks is None when we don't know it.
+    return {
+        "key": s3_object.get('Key'),
+        "size": s3_object.get('ContentLength', s3_object.get('Size')),
+        "etag": s3_object['ETag'],
+        "num_chunks": num_chunks
+    }
 
-def flush_cache():
-    global C_CHUNK_CACHE
-    C_CHUNK_CACHE = {}
-    global C_S3_KEY_CACHE
-    C_S3_KEY_CACHE = {}
+def _read_manifest_and_etag_from_s3(s3_client, s3_bucket, s3_path):
+    # (manifest, ETag of the manifest object) for s3_path, or (None, None) if there isn't one
+    path = f"{s3_path}/{C_MANIFEST_FILE}" if s3_path else f"{C_MANIFEST_FILE}"
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=path)
+        manifest = json.loads(response['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchKey":
+            return None, None
+        else:
+            # Something else has gone wrong.
+            raise
 
-def _calc_chunk_id(s3_bucket, s3_path, s3_file, chunkix):
-    return f"{s3_bucket}/{s3_path}/{s3_file}/{chunkix}" if s3_path else f"{s3_bucket}/{s3_file}/{chunkix}"
+    if manifest.get("version") != C_MANIFEST_VERSION:
+        raise Exception(f"Unknown manifest version {manifest.get('version')} in {path}")
+    return manifest, response['ETag']
+
+def read_manifest_from_s3(s3_client, s3_bucket, s3_path):
+    # the manifest of s3_path, or None if there isn't one
+    return _read_manifest_and_etag_from_s3(s3_client, s3_bucket, s3_path)[0]
+
+def write_manifest_to_s3(s3_client, s3_bucket, s3_path, manifest, if_match=None, if_none_match=False):
+    # if_match (an ETag) or if_none_match make the put conditional; a failed condition raises a ClientError
+    path = f"{s3_path}/{C_MANIFEST_FILE}" if s3_path else f"{C_MANIFEST_FILE}"
+    conditions = {}
+    if if_match is not None:
+        conditions['IfMatch'] = if_match
+    if if_none_match:
+        conditions['IfNoneMatch'] = '*'
+    s3_client.put_object(Bucket=s3_bucket, Key=path, Body=json.dumps(manifest), **conditions)
+
+def _modify_manifest_on_s3(s3_client, s3_bucket, s3_path, f_modify, seed_from_list=True):
+    '''
+    Reads the manifest of s3_path, calls f_modify on it to change it in place, and writes it back (if it changed) only
+    if no one else has written it since it was read, retrying from the read if they have. If there is no manifest, 
+    it starts from a full LIST of the chunk files (unless seed_from_list is False), so files written before the 
+    manifest existed aren't left out of it. Returns the manifest.
+    '''
+    for _ in range(C_MANIFEST_MAX_ATTEMPTS):
+        manifest, etag = _read_manifest_and_etag_from_s3(s3_client, s3_bucket, s3_path)
+        if manifest is None:
+            files = _list_chunk_files_on_s3(s3_client, s3_bucket, s3_path) if seed_from_list else {}
+            manifest = {"version": C_MANIFEST_VERSION, "files": files}
+            old_manifest_json = None
+        else:
+            old_manifest_json = json.dumps(manifest, sort_keys=True)
+
+        f_modify(manifest)
+        if json.dumps(manifest, sort_keys=True) == old_manifest_json:
+            return manifest
+
+        try:
+            write_manifest_to_s3(s3_client, s3_bucket, s3_path, manifest, if_match=etag, if_none_match=etag is None)
+            return manifest
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+
+    raise Exception(f"Couldn't update the manifest of {s3_path}, it kept being changed by other writers")
+
+def update_manifest_on_s3(s3_client, s3_bucket, s3_path, s3_file, num_chunks):
+    '''
+    Records a chunk file that has just been written in the manifest of s3_path, creating the manifest (from a LIST) 
+    if need be.
+    '''
+    path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+    s3_object = s3_client.head_object(Bucket=s3_bucket, Key=path)
+    s3_object['Key'] = path
+
+    def add_entry(manifest):
+        manifest["files"][s3_file] = _get_manifest_entry(s3_object, num_chunks)
+
+    return _modify_manifest_on_s3(s3_client, s3_bucket, s3_path, add_entry)
+
+def _list_chunk_files_on_s3(s3_client, s3_bucket, s3_path):
+    # manifest entries for the chunk files directly under s3_path, from a LIST
+    prefix = f"{s3_path}/" if s3_path else ""
+    entries = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            s3_file = s3_object['Key'][len(prefix):]
+            if "/" not in s3_file and _is_chunk_file(s3_file):
+                entries[s3_file] = _get_manifest_entry(s3_object)
+    return entries
+
+def sync_manifest_on_s3(s3_client, s3_bucket, s3_path):
+    '''
+    Brings the manifest of s3_path into line with what a LIST says is there, creating it if there isn't one. Entries for
+    files that have gone are dropped, and entries for new or changed files are added (with num_chunks None, as the 
+    LIST doesn't tell us). The manifest is only written back if it has changed. Returns the manifest.
+    '''
+    def sync_entries(manifest):
+        old_entries = manifest["files"]
+        entries = _list_chunk_files_on_s3(s3_client, s3_bucket, s3_path)
+        for s3_file, entry in entries.items():
+            old_entry = old_entries.get(s3_file)
+            if old_entry and old_entry["etag"] == entry["etag"]:
+                entry["num_chunks"] = old_entry["num_chunks"]
+        manifest["files"] = entries
+
+    return _modify_manifest_on_s3(s3_client, s3_bucket, s3_path, sync_entries, seed_from_list=False)
+
+def record_dumb_index_in_manifest_on_s3(s3_client, s3_bucket, s3_path, dumb_index_name, etag, file_etags):
+    # Records in the manifest of s3_path the file_etags a dumb index object (with ETag etag) was built from.
+    def add_index(manifest):
+        manifest.setdefault("indexes", {})[dumb_index_name] = {"etag": etag, "file_etags": file_etags}
+
+    return _modify_manifest_on_s3(s3_client, s3_bucket, s3_path, add_index)
+
+def get_dumb_index_file_etags_from_manifest(manifest, dumb_index_name, etag):
+    # the file_etags recorded for the dumb index object dumb_index_name, or None if they aren't for this version of it
+    index_entry = ((manifest or {}).get("indexes") or {}).get(dumb_index_name)
+    if index_entry is None or index_entry["etag"] != etag:
+        return None
+    return index_entry["file_etags"]
 
-def read_chunk_from_s3(boto3_session, s3_bucket, s3_path, s3_file, chunkix, read_through_cache=False):
-    global C_CHUNK_CACHE
+def write_chunks_to_s3(boto3_session, s3_bucket, s3_path, s3_file, chunks, multipart=False, part_size=C_S3_MULTIPART_PART_SIZE, max_workers=C_S3_MAX_WORKERS, compression=None, compression_level=None, update_manifest=True):
+    # s3_file ending in .json is written as a json list, ending in .chunks is written as a chunk container.
+    # json chunk files can be compressed; chunk containers can't (they couldn't be read a chunk at a time).
+    # The file is then recorded in the manifest of s3_path, unless update_manifest is False.
+    s3_client = get_s3_client(boto3_session)
+
+    # check the extension
+    if not _is_chunk_file(s3_file):
+        raise Exception(f"s3_file must end with .json or {C_CHUNK_CONTAINER_EXTENSION}")
     
-    s3 = boto3_session.resource('s3')
+    # check there are no path separators in the file name
+    if "/" in s3_file:
+        raise Exception("s3_file must not contain any path separators")
+
+    if compression is not None and s3_file.endswith(C_CHUNK_CONTAINER_EXTENSION):
+        raise Exception("chunk containers can't be compressed")
+
+    # for chunkix, chunk in enumerate(chunks):
+    #     chunk[C_CHUNKIX] = chunkix
+
+    path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+
+    # REMOVED THIS CHECK, NOT WORTH IT
+    # # check if the object already exists, using ObjectSummary
+
+    # try:
+    #     # an s3 error will be thrown if the object doesn't exist
+    #     s3.ObjectSummary(s3_bucket, path).load()
+    #     print ("chunk already exists in s3")
+    #     return None
+    #     # existing_chunk = read_chunk_from_s3(boto3_session, s3_bucket, s3_path, chunk_id, cache=False)
+    #     # return existing_chunk
+    # except botocore.exceptions.ClientError as e:
+    #     print (e)
+    #     #botocore.errorfactory.NoSuchKey
+    #     if e.response['Error']['Code'] == "404":
+    #         # The object does not exist.
+    #         pass
+    #     else:
+    #         # Something else has gone wrong.
+    #         raise
+
+    # here we know the object doesn't exist, so we can write it
+    if s3_file.endswith(C_CHUNK_CONTAINER_EXTENSION):
+        chunk_container_bytes = get_chunk_container_bytes(chunks)
+        if multipart:
+            _write_pieces_to_s3(s3_client, s3_bucket, path, [chunk_container_bytes], part_size, max_workers)
+        else:
+            s3_client.put_object(Bucket=s3_bucket, Key=path, Body=bytes(chunk_container_bytes))
+    elif multipart or compression is not None:
+        # encode (and compress) the json a bit at a time and upload it in parallel parts if it is big enough
+        pieces = (piece.encode('utf-8') for piece in json.JSONEncoder().iterencode(chunks))
+        _write_pieces_to_s3(s3_client, s3_bucket, path, pieces, part_size, max_workers, compression=compression, compression_level=compression_level)
+    else:
+        chunks_json = json.dumps(chunks)
+        s3_client.put_object(Bucket=s3_bucket, Key=path, Body=chunks_json)
 
-    try:
-        chunk_id = _calc_chunk_id(s3_bucket, s3_path, s3_file, chunkix)
-        
-        if not read_through_cache:
-            if chunk_id in C_CHUNK_CACHE:
-                return C_CHUNK_CACHE[chunk_id]
+    if update_manifest:
+        update_manifest_on_s3(s3_client, s3_bucket, s3_path, s3_file, len(chunks))
 
-        path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
-        s3_object = s3.Object(s3_bucket, path)
-        chunks = _get_chunks_from_s3_object(s3_object)
-        if chunks:
-            chunkids = []
-            for this_chunkix, chunk in enumerate(chunks):
-                chunk_id = _calc_chunk_id(s3_bucket, s3_path, s3_file, this_chunkix)
-                chunkids.append(chunk_id)
-                C_CHUNK_CACHE[chunk_id] = chunk
-            # we also need to cache the path as s3 key
-            C_S3_KEY_CACHE[path] = chunkids
-
-            if chunk_id in C_CHUNK_CACHE:
-                return C_CHUNK_CACHE[chunk_id]
+    return chunks
+
+def _get_chunks_from_s3(s3_client, s3_bucket, path, disk_cache=None, revalidate=False):
+    # returns (chunks, number of bytes of the (decompressed) file). With a disk_cache, the file comes through that.
+    if disk_cache is not None:
+        chunks_bytes = disk_cache.get_object_bytes(s3_client, s3_bucket, path, revalidate)
+        if chunks_bytes is None:
+            return [], 0
+        chunks_bytes = decompress_bytes(chunks_bytes)
+    else:
+        try:
+            response = s3_client.get_object(Bucket=s3_bucket, Key=path)
+            chunks_bytes = _read_s3_body(response['Body'], response['ContentLength'])
+        except botocore.exceptions.ClientError as e:
+            print (e)
+            #botocore.errorfactory.NoSuchKey
+            if e.response['Error']['Code'] == "NoSuchKey":
+                # The object does not exist.
+                return [], 0
+            else:
+                # Something else has gone wrong.
+                raise
+    if is_chunk_container_bytes(chunks_bytes):
+        chunks = get_chunks_from_chunk_container_bytes(chunks_bytes)
+    else:
+        chunks = json.loads(chunks_bytes.decode('utf-8'))
+    return chunks, len(chunks_bytes)
+
+# default memory budget for a ChunkCache
+C_CHUNK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class ChunkCache:
+    '''
+    An in memory cache of chunk files, keyed by bucket and s3 key. Chunks are always loaded a whole file at a time, 
+    so whole files are what is cached. Each file is charged the size of its json as downloaded, and once the total
+    goes over max_bytes the least recently used files are evicted. A file bigger than max_bytes is never cached.
+
+    hits, misses and evictions count lookups and evicted files. The cache is safe to share between threads.
+    '''
+    def __init__(self, max_bytes=C_CHUNK_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = collections.OrderedDict() # (s3_bucket, path) -> (chunks, num_bytes), oldest first
+        self._lock = threading.Lock()
+
+    def get_chunks(self, s3_bucket, path):
+        # returns the list of chunks in the file, or None if it isn't cached
+        with self._lock:
+            entry = self._files.get((s3_bucket, path))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end((s3_bucket, path))
+            self.hits += 1
+            return entry[0]
+
+    def put_chunks(self, s3_bucket, path, chunks, num_bytes):
+        # caches a whole chunk file, returns False if it is too big to cache
+        with self._lock:
+            old_entry = self._files.pop((s3_bucket, path), None)
+            if old_entry is not None:
+                self.num_bytes -= old_entry[1]
+
+            if num_bytes > self.max_bytes:
+                return False
+
+            while self._files and self.num_bytes + num_bytes > self.max_bytes:
+                _, (_, evicted_num_bytes) = self._files.popitem(last=False)
+                self.num_bytes -= evicted_num_bytes
+                self.evictions += 1
+
+            self._files[(s3_bucket, path)] = (chunks, num_bytes)
+            self.num_bytes += num_bytes
+            return True
+
+    def flush(self):
+        with self._lock:
+            self._files.clear()
+            self.num_bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "num_bytes": self.num_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+# the cache used when no chunk_cache is passed in
+C_CHUNK_CACHE = ChunkCache()
+
+# defaults for a DiskChunkCache
+C_DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+C_DISK_CACHE_TTL = 300
+
+class DiskChunkCache:
+    '''
+    A cache of s3 objects (chunk files) on local disk, that sits under the in memory ChunkCache, so that separate 
+    runs (and separate processes) on a host don't download the same files again. 
+
+    Each object is one file in cache_dir, named by a hash of bucket and key, holding a json line with the bucket, 
+    key and ETag, then the object's bytes. Entries are written to a temporary file and renamed into place, so 
+    several processes can share cache_dir safely. Within ttl seconds of being fetched or validated an entry is used
+    as is; after that it is revalidated with a conditional GET (If-None-Match), which only downloads the object if 
+    it has changed. When the directory is over max_bytes, the least recently used entries are deleted.
+
+    hits, revalidations, misses and evictions are counts for this process only.
+    '''
+    def __init__(self, cache_dir, max_bytes=C_DISK_CACHE_MAX_BYTES, ttl=C_DISK_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_filename(self, s3_bucket, path):
+        entry_name = hashlib.sha256(f"{s3_bucket}/{path}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{entry_name}.cache")
+
+    def _read_entry(self, filename):
+        # returns (meta, object bytes, time last validated), or None if there's no usable entry
+        try:
+            with open(filename, "rb") as f:
+                validated_at = os.fstat(f.fileno()).st_mtime
+                meta = json.loads(f.readline().decode('utf-8'))
+                object_bytes = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta, object_bytes, validated_at
+
+    def _write_entry(self, filename, meta, object_bytes):
+        fd, temp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(meta).encode('utf-8') + b"\n")
+                f.write(object_bytes)
+            os.replace(temp_filename, filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        self._evict()
+
+    def _touch(self, filename, validated_at):
+        # the access time is used for LRU eviction, the modification time is when the entry was last validated
+        try:
+            os.utime(filename, (time.time(), validated_at))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if dir_entry.name.endswith(".cache"):
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, dir_entry.path))
+
+        num_bytes = sum(entry[1] for entry in entries)
+        for _, size, filename in sorted(entries):
+            if num_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            num_bytes -= size
+
+    def get_object_bytes(self, s3_client, s3_bucket, path, revalidate=False):
+        '''
+        Returns the bytes of an s3 object, from disk if we can, otherwise from s3 (and then stored). Returns None if
+        the object doesn't exist. With revalidate, a cached entry is revalidated even if it is within the ttl.
+        '''
+        filename = self._entry_filename(s3_bucket, path)
+        entry = self._read_entry(filename)
+        now = time.time()
+
+        try:
+            if entry is not None:
+                meta, object_bytes, validated_at = entry
+                if not revalidate and now - validated_at < self.ttl:
+                    self.hits += 1
+                    self._touch(filename, validated_at)
+                    return object_bytes
+
+                try:
+                    response = s3_client.get_object(Bucket=s3_bucket, Key=path, IfNoneMatch=meta['etag'])
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] in ("304", "NotModified"):
+                        self.revalidations += 1
+                        self._touch(filename, now)
+                        return object_bytes
+                    raise
             else:
+                response = s3_client.get_object(Bucket=s3_bucket, Key=path)
+        except botocore.exceptions.ClientError as e:
+            print (e)
+            #botocore.errorfactory.NoSuchKey
+            if e.response['Error']['Code'] == "NoSuchKey":
+                # The object does not exist (any more).
+                if entry is not None and os.path.exists(filename):
+                    os.remove(filename)
                 return None
+            else:
+                # Something else has gone wrong.
+                raise
+
+        self.misses += 1
+        object_bytes = response['Body'].read()
+        meta = {"bucket": s3_bucket, "key": path, "etag": response['ETag']}
+        self._write_entry(filename, meta, object_bytes)
+        return object_bytes
+
+    def flush(self):
+        for dir_entry in os.scandir(self.cache_dir):
+            if dir_entry.name.endswith(".cache"):
+                try:
+                    os.remove(dir_entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+def flush_cache():
+    C_CHUNK_CACHE.flush()
+
+def _load_chunks(s3_client, s3_bucket, path, read_through_cache, chunk_cache, disk_cache=None):
+    # all the chunks in a chunk file, from the cache if we can, otherwise from disk_cache or s3 (and then cached)
+    if not read_through_cache:
+        chunks = chunk_cache.get_chunks(s3_bucket, path)
+        if chunks is not None:
+            return chunks
+
+    chunks, num_bytes = _get_chunks_from_s3(s3_client, s3_bucket, path, disk_cache, read_through_cache)
+    if chunks:
+        # don't cache the empty list!
+        chunk_cache.put_chunks(s3_bucket, path, chunks, num_bytes)
+    return chunks
+
+def _load_chunk_from_chunk_container(s3_client, s3_bucket, path, chunkix, read_through_cache, chunk_cache):
+    # one chunk from a chunk container, see _load_chunks_from_chunk_container
+    return _load_chunks_from_chunk_container(s3_client, s3_bucket, path, [chunkix], read_through_cache, chunk_cache).get(chunkix)
+
+def _load_chunks_from_chunk_container(s3_client, s3_bucket, path, chunkixs, read_through_cache, chunk_cache):
+    # chunkix -> chunk for some chunks of a chunk container, from the cache if we can, otherwise from s3 with Range
+    # requests (all the ones we need at once). These chunks are cached on their own, under the s3 key with the 
+    # chunkix on the end.
+    chunks = {}
+    missing_chunkixs = []
+    for chunkix in chunkixs:
+        cached_chunks = None if read_through_cache else chunk_cache.get_chunks(s3_bucket, f"{path}#{chunkix}")
+        if cached_chunks is not None:
+            chunks[chunkix] = cached_chunks[0]
         else:
-            return None # and don't cache the empty list!
-    finally:
-        s3.meta.client.close()
+            missing_chunkixs.append(chunkix)
+
+    if missing_chunkixs:
+        for chunkix, (chunk, num_bytes) in _get_chunks_from_s3_chunk_container(s3_client, s3_bucket, path, missing_chunkixs).items():
+            chunk_cache.put_chunks(s3_bucket, f"{path}#{chunkix}", [chunk], num_bytes)
+            chunks[chunkix] = chunk
+    return chunks
+
+def read_chunk_from_s3(boto3_session, s3_bucket, s3_path, s3_file, chunkix, read_through_cache=False, chunk_cache=None, disk_cache=None):
+    # chunk containers are read a chunk at a time, unless they are going through a disk_cache (which holds whole files)
+    if chunk_cache is None:
+        chunk_cache = C_CHUNK_CACHE
+
+    s3_client = get_s3_client(boto3_session)
 
-def yield_file_pairs_from_s3(boto3_session, s3_bucket, s3_paths):
+    path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+    if s3_file.endswith(C_CHUNK_CONTAINER_EXTENSION) and disk_cache is None:
+        return _load_chunk_from_chunk_container(s3_client, s3_bucket, path, chunkix, read_through_cache, chunk_cache)
+
+    chunks = _load_chunks(s3_client, s3_bucket, path, read_through_cache, chunk_cache, disk_cache)
+
+    if chunkix < len(chunks):
+        return chunks[chunkix]
+    else:
+        return None
+
+def yield_file_entries_from_s3(boto3_session, s3_bucket, s3_paths, use_manifest=True, reconcile=False):
+    '''
+    Yields (pathix, s3_file, manifest entry) for each chunk file directly under each of s3_paths, in key order.
+
+    Each path's manifest is read with one GET. If there isn't one (or use_manifest is False) the path is LISTed 
+    instead. With reconcile, the path is LISTed as well and the manifest is brought up to date with what is there 
+    (see sync_manifest_on_s3), which is also how manifests get created for paths written before there were any.
+    '''
     if not isinstance(s3_paths, list):
         raise Exception("s3_paths must be a list")
 
-    s3 = boto3_session.resource('s3')
-    try:
-        bucket = s3.Bucket(s3_bucket)
-        for pathix, s3_path in enumerate(s3_paths):
-            for s3_object in bucket.objects.filter(Prefix=s3_path):
-                if s3_object.key.endswith(".json"):
-                    s3_file = os.path.basename(s3_object.key)
-                    yield pathix, s3_file
-    finally:
-        s3.meta.client.close()
+    s3_client = get_s3_client(boto3_session)
+    for pathix, s3_path in enumerate(s3_paths):
+        if reconcile:
+            entries = sync_manifest_on_s3(s3_client, s3_bucket, s3_path)["files"]
+        else:
+            manifest = read_manifest_from_s3(s3_client, s3_bucket, s3_path) if use_manifest else None
+            if manifest is not None:
+                entries = manifest["files"]
+            else:
+                entries = _list_chunk_files_on_s3(s3_client, s3_bucket, s3_path)
 
-def yield_chunks_from_s3(boto3_session, s3_bucket, s3_paths, file_pair, read_through_cache=False):
+        for s3_file in sorted(entries):
+            yield pathix, s3_file, entries[s3_file]
+
+def yield_file_pairs_from_s3(boto3_session, s3_bucket, s3_paths, use_manifest=True, reconcile=False):
+    for pathix, s3_file, _ in yield_file_entries_from_s3(boto3_session, s3_bucket, s3_paths, use_manifest, reconcile):
+        yield pathix, s3_file
+
+def yield_chunks_from_s3(boto3_session, s3_bucket, s3_paths, file_pair, read_through_cache=False, chunk_cache=None, disk_cache=None):
     if not isinstance(s3_paths, list):
         s3_paths = [s3_paths]
 
-    global C_CHUNK_CACHE
-    global C_S3_KEY_CACHE
+    if chunk_cache is None:
+        chunk_cache = C_CHUNK_CACHE
 
-    s3 = boto3_session.resource('s3')
+    s3_client = get_s3_client(boto3_session)
 
-    try:
-        pathix, s3_file = file_pair
-        s3_path = s3_paths[pathix]
+    pathix, s3_file = file_pair
+    s3_path = s3_paths[pathix]
+    path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+
+    chunks = _load_chunks(s3_client, s3_bucket, path, read_through_cache, chunk_cache, disk_cache)
+    for chunk in chunks:
+        yield chunk
+
+def print_build_progress(stats):
+    # an f_progress for create_dumb_index that prints the stats
+    elapsed = stats["elapsed"]
+    print (f"create_dumb_index: {stats['files']} files ({stats['reused_files']} unchanged), {stats['chunks']} chunks in {elapsed:.1f}s "
+           f"({stats['files'] / elapsed if elapsed else 0:.1f} files/s, {stats['chunks'] / elapsed if elapsed else 0:.1f} chunks/s)")
+
+def _get_vectors_from_chunks(chunks, f_get_vector_from_chunk):
+    return [f_get_vector_from_chunk(chunk) for chunk in chunks]
+
+def _get_completed_future(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+def _get_file_vectors_from_dumb_index(dumb_index):
+    '''
+    s3 key -> (etag, vectors in chunkix order) for each file of a dumb index that has its file_etags. Files with 
+    missing chunks (or no etag) are left out, as they can't be reused.
+    '''
+    file_etags = dumb_index.get("file_etags")
+    if not file_etags:
+        return {}
+
+    # a filtered index holds filtered vectors, which can't be mixed with new unfiltered ones
+    dimension_mask = dumb_index.get("dimension_mask")
+    if dimension_mask is not None and not all(dimension_mask):
+        return {}
+
+    vectors_by_fileix = collections.defaultdict(dict)
+    for vector, fileix, chunkix in dumb_index["triples"]:
+        vectors_by_fileix[fileix][chunkix] = vector
+
+    file_vectors = {}
+    for fileix, (pathix, s3_file) in enumerate(dumb_index["file_pairs"]):
+        vectors_by_chunkix = vectors_by_fileix.get(fileix, {})
+        if file_etags[fileix] is None or sorted(vectors_by_chunkix) != list(range(len(vectors_by_chunkix))):
+            continue
+        s3_path = dumb_index["paths"][pathix]
         path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+        file_vectors[path] = (file_etags[fileix], [vectors_by_chunkix[chunkix] for chunkix in range(len(vectors_by_chunkix))])
+    return file_vectors
+
+def _yield_file_vectors(boto3_session, s3_bucket, s3_paths, f_get_vector_from_chunk, read_through_cache, chunk_cache, disk_cache, max_workers, max_in_flight, decode_workers, previous_file_vectors, use_manifest, reconcile):
+    '''
+    Yields (file_pair, etag, vectors, reused) for every chunk file under s3_paths, in listing order.
+
+    With one worker for each, files are fetched and decoded one after another on this thread.
+    Up to max_in_flight files are being fetched or decoded at once. Files are fetched by max_workers threads, and as
+    each one arrives its chunks are handed to a pool of decode_workers threads for f_get_vector_from_chunk, so fetching
+    carries on while vectors are decoded. Files whose ETag matches their entry in previous_file_vectors aren't fetched
+    at all; their previous vectors are used.
+    '''
+    if chunk_cache is None:
+        chunk_cache = C_CHUNK_CACHE
 
-        done = False
-
-        if not read_through_cache:
-            if path in C_S3_KEY_CACHE:
-                # the value is a list of fileix, chunkix pairs
-                chunk_ids = C_S3_KEY_CACHE[path]
-                for chunk_id in chunk_ids:
-                    if chunk_id in C_CHUNK_CACHE:
-                        chunk = C_CHUNK_CACHE[chunk_id]
-                        yield chunk
-                done = True
-
-        if not done:
-            s3_object = s3.Object(s3_bucket, path)
-            chunks = _get_chunks_from_s3_object(s3_object)
-            chunk_ids = []
-            for chunkix, chunk in enumerate(chunks):
-                chunk_id = _calc_chunk_id(s3_bucket, s3_path, s3_file, chunkix)
-                chunk_ids.append(chunk_id)
-                C_CHUNK_CACHE[chunk_id] = chunk
-                yield chunk
-            
-            C_S3_KEY_CACHE[path] = chunk_ids
+    s3_client = get_s3_client(boto3_session)
+
+    def get_path(pathix, s3_file):
+        s3_path = s3_paths[pathix]
+        return f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+
+    if max_workers == 1 and decode_workers == 1:
+        for pathix, s3_file, entry in yield_file_entries_from_s3(boto3_session, s3_bucket, s3_paths, use_manifest, reconcile):
+            path = get_path(pathix, s3_file)
+            previous_etag, previous_vectors = previous_file_vectors.get(path, (None, None))
+            if previous_etag is not None and previous_etag == entry["etag"]:
+                yield (pathix, s3_file), entry["etag"], previous_vectors, True
+            else:
+                chunks = _load_chunks(s3_client, s3_bucket, path, read_through_cache, chunk_cache, disk_cache)
+                yield (pathix, s3_file), entry["etag"], _get_vectors_from_chunks(chunks, f_get_vector_from_chunk), False
+        return
+
+    fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers)
+
+    def fetch_file(path):
+        # returns a future for the file's vectors
+        chunks = _load_chunks(s3_client, s3_bucket, path, read_through_cache, chunk_cache, disk_cache)
+        return decode_executor.submit(_get_vectors_from_chunks, chunks, f_get_vector_from_chunk)
+
+    try:
+        # (file_pair, etag, reused, future of a future of vectors), in listing order
+        in_flight = collections.deque()
+        for pathix, s3_file, entry in yield_file_entries_from_s3(boto3_session, s3_bucket, s3_paths, use_manifest, reconcile):
+            if len(in_flight) >= max_in_flight:
+                head_file_pair, head_etag, head_reused, head_future = in_flight.popleft()
+                yield head_file_pair, head_etag, head_future.result().result(), head_reused
+
+            path = get_path(pathix, s3_file)
+            previous_etag, previous_vectors = previous_file_vectors.get(path, (None, None))
+            if previous_etag is not None and previous_etag == entry["etag"]:
+                in_flight.append(((pathix, s3_file), entry["etag"], True, _get_completed_future(_get_completed_future(previous_vectors))))
+            else:
+                in_flight.append(((pathix, s3_file), entry["etag"], False, fetch_executor.submit(fetch_file, path)))
+
+        while in_flight:
+            head_file_pair, head_etag, head_reused, head_future = in_flight.popleft()
+            yield head_file_pair, head_etag, head_future.result().result(), head_reused
     finally:
-        s3.meta.client.close()
+        # if something went wrong, don't wait for fetches we won't use
+        fetch_executor.shutdown(wait=False, cancel_futures=True)
+        decode_executor.shutdown(wait=False, cancel_futures=True)
+
+def create_dumb_index(boto3_session, s3_bucket, s3_paths, f_get_vector_from_chunk, read_through_cache=False, dimension_threshold=0, chunk_cache=None, disk_cache=None, max_workers=1, max_in_flight=None, decode_workers=None, progress_interval=10, f_progress=None, previous_dumb_index=None, use_manifest=True, reconcile=False):
+    '''
+    Builds a dumb index over all the chunk files under s3_paths.
+
+    With max_workers == 1 (the default) chunk files are fetched and decoded one after another on the calling thread.
+    With max_workers > 1 chunk files are fetched concurrently, with at most max_in_flight (default 2 * max_workers) 
+    being fetched or decoded at once, and vectors are decoded by decode_workers threads (default max_workers). The 
+    triples come out in the same fileix, chunkix order whatever the settings.
+
+    If f_progress is given, it is called every progress_interval seconds (and at the end) with a dict of files, chunks,
+    reused files and elapsed seconds so far. Pass print_build_progress to print them.
+
+    Files are enumerated from the paths' manifests (see yield_file_entries_from_s3), and the index has the ETag of each
+    one in file_etags (None if it came from a LIST of a path with no manifest). Given a previous_dumb_index that has 
+    file_etags, files that haven't changed since are not fetched again; their vectors are taken from it. file_etags is
+    not part of the index file format, but write_dumb_index_to_s3 records it in the manifest of the index's path and
+    read_dumb_index_from_s3 puts it back, so previous_dumb_index can come from an earlier run.
+    '''
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    if decode_workers is None:
+        decode_workers = max_workers
+
+    previous_file_vectors = _get_file_vectors_from_dumb_index(previous_dumb_index) if previous_dumb_index else {}
 
-def create_dumb_index(boto3_session, s3_bucket, s3_paths, f_get_vector_from_chunk, read_through_cache=False, dimension_threshold=0):
     s3_file_pairs = []
+    file_etags = []
     triples = []
 
-    for fileix, file_pair in enumerate(yield_file_pairs_from_s3(boto3_session, s3_bucket, s3_paths)):
+    stats = {"files": 0, "chunks": 0, "reused_files": 0, "elapsed": 0.0}
+    start_time = time.monotonic()
+    last_progress_time = start_time
+
+    for fileix, (file_pair, etag, vectors, reused) in enumerate(_yield_file_vectors(
+        boto3_session, s3_bucket, s3_paths, f_get_vector_from_chunk, read_through_cache, chunk_cache, disk_cache,
+        max_workers, max_in_flight, decode_workers, previous_file_vectors, use_manifest, reconcile
+    )):
         s3_file_pairs.append(file_pair)
-        for chunkix, chunk in enumerate(yield_chunks_from_s3(boto3_session, s3_bucket, s3_paths, file_pair, read_through_cache)):
-            triple = (f_get_vector_from_chunk(chunk), fileix, chunkix)
-            triples.append(triple)
+        file_etags.append(etag)
+        for chunkix, vector in enumerate(vectors):
+            triples.append((vector, fileix, chunkix))
+
+        stats["files"] += 1
+        stats["reused_files"] += reused
+        stats["chunks"] += len(vectors)
+        now = time.monotonic()
+        if f_progress and progress_interval and now - last_progress_time >= progress_interval:
+            stats["elapsed"] = now - start_time
+            f_progress(dict(stats))
+            last_progress_time = now
+
+    stats["elapsed"] = time.monotonic() - start_time
+    if f_progress:
+        f_progress(dict(stats))
 
     dimension_mask = None
     if dimension_threshold:
-        dimension_mask = create_dimension_mask(triples, dimension_threshold)
+        # one matrix of the vectors, to work out the mask and then filter all the vectors at once
+        vectors = np.asarray([triple[0] for triple in triples])
+        dimension_mask = create_dimension_mask(vectors, dimension_threshold)
         print (f"dimension_mask: {dimension_mask}")
 
-        filtered_triples = []
-        for triple in triples:
-            filtered_vector = filter_vector_by_mask(triple[0], dimension_mask)
-            filtered_triples.append((
-                filtered_vector,
-                triple[1],
-                triple[2]
-            ))
-
-        triples = filtered_triples
+        filtered_vectors = filter_vectors_by_mask(vectors, dimension_mask).tolist()
+        del vectors
+        triples = [
+            (filtered_vector, triple[1], triple[2])
+            for filtered_vector, triple in zip(filtered_vectors, triples)
+        ]
     else:
         # dimension_mask needs to be all 1s
         num_dimensions = len(triples[0][0])
@@ -590,44 +1983,271 @@ def create_dumb_index(boto3_session, s3_bucket, s3_paths, f_get_vector_from_chun
         "triples": triples,
         "file_pairs": s3_file_pairs,
         "paths": s3_paths,
-        "dimension_mask": dimension_mask
+        "dimension_mask": dimension_mask,
+        "file_etags": file_etags
     }
 
-def write_dumb_index_to_s3(boto3_session, s3_bucket, s3_path, dumb_index_name, dumb_index, vector_type, num_dimensions):
-    s3 = boto3_session.resource('s3')
-    try:
-        dumb_index_bytes = get_dumb_index_bytes(dumb_index, vector_type, num_dimensions)
+def write_dumb_index_to_s3(boto3_session, s3_bucket, s3_path, dumb_index_name, dumb_index, vector_type, num_dimensions, version_number=C_VERSION_1, part_size=C_S3_MULTIPART_PART_SIZE, max_workers=C_S3_MAX_WORKERS, compression=None, compression_level=None, record_file_etags=True, include_norms=True):
+    # a compressed index can only be read whole (with read_dumb_index_from_s3), not with Range requests.
+    # If the index has file_etags (and record_file_etags), they are recorded in the manifest of s3_path, so
+    # read_dumb_index_from_s3 can give them back and the index can be rebuilt incrementally from another process.
+    s3_client = get_s3_client(boto3_session)
 
-        path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
-        s3_object = s3.Object(s3_bucket, path)
-        s3_object.put(Body=dumb_index_bytes)
-    finally:
-        s3.meta.client.close()
+    # stream the index up, never building the whole thing in memory
+    pieces = yield_dumb_index_bytes(dumb_index, vector_type, num_dimensions, version_number, include_norms)
+
+    path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
+    etag = _write_pieces_to_s3(s3_client, s3_bucket, path, pieces, part_size, max_workers, compression=compression, compression_level=compression_level)
 
-def write_dumb_index_to_file(filename, dumb_index, vector_type, num_dimensions):
-    dumb_index_bytes = get_dumb_index_bytes(dumb_index, vector_type, num_dimensions)
+    if record_file_etags and dumb_index.get("file_etags"):
+        record_dumb_index_in_manifest_on_s3(s3_client, s3_bucket, s3_path, dumb_index_name, etag, dumb_index["file_etags"])
+
+def write_dumb_index_to_file(filename, dumb_index, vector_type, num_dimensions, version_number=C_VERSION_1, include_norms=True):
     with open(filename, "wb") as f:
-        f.write(dumb_index_bytes)
+        write_dumb_index_to_fileobj(f, dumb_index, vector_type, num_dimensions, version_number, include_norms)
 
-def read_dumb_index_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name):
-    s3 = boto3_session.resource('s3')
+def read_dumb_index_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name, read_file_etags=True):
+    # with read_file_etags, the file_etags recorded for this version of the index in the manifest of s3_path (see 
+    # write_dumb_index_to_s3) are put back in the index, if there are any
+    s3_client = get_s3_client(boto3_session)
+    path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
     try:
-        path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
-        s3_object = s3.Object(s3_bucket, path)
-        try:
-            dumb_index_bytes = s3_object.get()['Body'].read()
-            dumb_index = get_dumb_index_from_bytes(dumb_index_bytes)
-            return dumb_index
-        except botocore.exceptions.ClientError as e:
-            print (e)
-            #botocore.errorfactory.NoSuchKey
-            if e.response['Error']['Code'] == "NoSuchKey":
-                return None
-            else:
-                # Something else has gone wrong.
-                raise
-    finally:
-        s3.meta.client.close()
+        response = s3_client.get_object(Bucket=s3_bucket, Key=path)
+        dumb_index_bytes = _read_s3_body(response['Body'], response['ContentLength'])
+        dumb_index = get_dumb_index_from_bytes(dumb_index_bytes)
+
+        if read_file_etags:
+            manifest = read_manifest_from_s3(s3_client, s3_bucket, s3_path)
+            file_etags = get_dumb_index_file_etags_from_manifest(manifest, dumb_index_name, response['ETag'])
+            if file_etags is not None and len(file_etags) == len(dumb_index["file_pairs"]):
+                dumb_index["file_etags"] = file_etags
+        return dumb_index
+    except botocore.exceptions.ClientError as e:
+        print (e)
+        #botocore.errorfactory.NoSuchKey
+        if e.response['Error']['Code'] == "NoSuchKey":
+            return None
+        else:
+            # Something else has gone wrong.
+            raise
+
+def _get_s3_object_range(s3_client, s3_bucket, path, start, end):
+    # end is exclusive, as in python slices (the http Range header is inclusive)
+    if end <= start:
+        return b""
+    response = s3_client.get_object(Bucket=s3_bucket, Key=path, Range=f"bytes={start}-{end-1}")
+    return response['Body'].read()
+
+def _get_s3_object_sections(s3_client, s3_bucket, path, sections, range_size=C_S3_RANGE_SIZE, max_workers=C_S3_MAX_WORKERS):
+    '''
+    Fetches a list of (start, end) byte sections of an S3 object. Big sections are split into range_size pieces, and 
+    all the pieces are fetched concurrently with Range requests. Returns one bytearray per section.
+    '''
+    section_bytes_list = [bytearray(end - start) for start, end in sections]
+
+    pieces = []
+    for sectionix, (start, end) in enumerate(sections):
+        for piece_start in range(start, end, range_size):
+            pieces.append((sectionix, piece_start, min(piece_start + range_size, end)))
+
+    def fetch_piece(piece):
+        sectionix, piece_start, piece_end = piece
+        piece_bytes = _get_s3_object_range(s3_client, s3_bucket, path, piece_start, piece_end)
+        section_start = sections[sectionix][0]
+        section_bytes_list[sectionix][piece_start - section_start:piece_end - section_start] = piece_bytes
+
+    if len(pieces) == 1:
+        fetch_piece(pieces[0])
+    elif pieces:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() so that any exception is raised here
+            list(executor.map(fetch_piece, pieces))
+
+    return section_bytes_list
+
+def read_dumb_index_header_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name):
+    '''
+    Fetches just the header of a dumb index on S3 (one small Range request), and works out where each section of
+    the file is. The result is passed to read_dumb_index_tables_from_s3, read_dumb_index_triples_from_s3 and 
+    read_dumb_index_dimension_mask_from_s3.
+    Returns None if the index doesn't exist.
+    '''
+    s3_client = get_s3_client(boto3_session)
+    path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
+    try:
+        # big enough for either version
+        header_bytes = _get_s3_object_range(s3_client, s3_bucket, path, 0, C_HEADER_SIZE_V2)
+    except botocore.exceptions.ClientError as e:
+        print (e)
+        #botocore.errorfactory.NoSuchKey
+        if e.response['Error']['Code'] == "NoSuchKey":
+            return None
+        else:
+            # Something else has gone wrong.
+            raise
+
+    if get_compression(header_bytes) is not None:
+        raise Exception(f"Dumb index {path} is compressed, it can only be read whole (use read_dumb_index_from_s3)")
+
+    dumb_index_header = get_dumb_index_layout_from_header_bytes(header_bytes)
+    dumb_index_header["path"] = path
+    return dumb_index_header
+
+def get_dumb_index_layout_from_header_bytes(header_bytes):
+    # the header of a dumb index (at least C_HEADER_SIZE_V2 bytes of it, or all of the file if it is shorter), 
+    # and where each section of the file is
+    magic_number, version_number, num_dimensions, vector_type, \
+        num_paths, num_files, num_triples, \
+        num_path_table_bytes, num_file_table_bytes, num_triple_table_bytes, \
+        remainder_bytes = get_header_from_dumb_index_bytes(header_bytes)
+
+    if version_number == C_VERSION_2:
+        flags = header_bytes[C_HEADER_SIZE_V1]
+        path_table_offset = C_HEADER_SIZE_V2
+        triple_table_offset = align(path_table_offset + num_path_table_bytes + num_file_table_bytes, C_ALIGNMENT_V2)
+    else:
+        flags = 0
+        path_table_offset = C_HEADER_SIZE_V1
+        triple_table_offset = path_table_offset + num_path_table_bytes + num_file_table_bytes
+
+    return {
+        "version_number": version_number,
+        "num_dimensions": num_dimensions,
+        "vector_type": vector_type,
+        "flags": flags,
+        "num_paths": num_paths,
+        "num_files": num_files,
+        "num_triples": num_triples,
+        "path_table_offset": path_table_offset,
+        "num_path_table_bytes": num_path_table_bytes,
+        "file_table_offset": path_table_offset + num_path_table_bytes,
+        "num_file_table_bytes": num_file_table_bytes,
+        "triple_table_offset": triple_table_offset,
+        "num_triple_table_bytes": num_triple_table_bytes,
+        "dimension_mask_offset": triple_table_offset + num_triple_table_bytes
+    }
+
+def get_vectors_section(dumb_index_header, start, end):
+    # the (start, end) bytes of the file holding the vectors of triples start to end (for version 1, the whole records)
+    vector_bytes_count = dumb_index_header["num_dimensions"] * number_of_bytes_for_vector_type(dumb_index_header["vector_type"])
+    record_bytes_count = vector_bytes_count if dumb_index_header["version_number"] == C_VERSION_2 else vector_bytes_count + 8
+    triple_table_offset = dumb_index_header["triple_table_offset"]
+    return triple_table_offset + start * record_bytes_count, triple_table_offset + end * record_bytes_count
+
+def get_vectors_from_section_bytes(dumb_index_header, section_bytes):
+    '''
+    The vectors in some bytes from get_vectors_section, as an N X D array in the dtype for the vector type (not 
+    decoded), viewing the bytes (strided, for version 1).
+    '''
+    vector_type = dumb_index_header["vector_type"]
+    num_dimensions = dumb_index_header["num_dimensions"]
+    if dumb_index_header["version_number"] == C_VERSION_2:
+        return np.frombuffer(section_bytes, dtype=dtype_for_vector_type(vector_type)).reshape(-1, num_dimensions)
+
+    triple_table_dtype = _triple_table_dtype(vector_type, num_dimensions)
+    triple_table = np.frombuffer(section_bytes, dtype=triple_table_dtype, count=len(section_bytes) // triple_table_dtype.itemsize)
+    return triple_table['vector'].reshape(-1, num_dimensions)
+
+def read_dumb_index_vectors_from_s3(boto3_session, s3_bucket, dumb_index_header, start=0, end=None, range_size=C_S3_RANGE_SIZE, max_workers=C_S3_MAX_WORKERS):
+    # just the vectors of triples start to end of a dumb index on S3, see get_vectors_from_section_bytes
+    end = dumb_index_header["num_triples"] if end is None else min(end, dumb_index_header["num_triples"])
+    if start >= end:
+        return np.zeros((0, dumb_index_header["num_dimensions"]), dtype=dtype_for_vector_type(dumb_index_header["vector_type"]))
+
+    section = get_vectors_section(dumb_index_header, start, end)
+    section_bytes, = _get_s3_object_sections(get_s3_client(boto3_session), s3_bucket, dumb_index_header["path"], [section], range_size, max_workers)
+    return get_vectors_from_section_bytes(dumb_index_header, section_bytes)
+
+def read_dumb_index_tables_from_s3(boto3_session, s3_bucket, dumb_index_header):
+    # returns (paths, file_pairs), fetching the path and file tables (which are adjacent) in one Range request
+    tables_bytes = _get_s3_object_range(
+        get_s3_client(boto3_session), s3_bucket, dumb_index_header["path"], 
+        dumb_index_header["path_table_offset"], 
+        dumb_index_header["file_table_offset"] + dumb_index_header["num_file_table_bytes"]
+    )
+
+    num_path_table_bytes = dumb_index_header["num_path_table_bytes"]
+    paths = get_paths_from_path_table_bytes(tables_bytes[0:num_path_table_bytes], dumb_index_header["num_paths"])
+    file_pairs = get_file_pairs_from_file_table_bytes(tables_bytes[num_path_table_bytes:], dumb_index_header["num_files"])
+
+    return paths, file_pairs
+
+def read_dumb_index_triples_from_s3(boto3_session, s3_bucket, dumb_index_header, start=0, end=None, range_size=C_S3_RANGE_SIZE, max_workers=C_S3_MAX_WORKERS):
+    '''
+    Fetches triples start to end (exclusive, default all of them) of a dumb index on S3, reading only those bytes of 
+    the triple table, with concurrent Range requests for big ranges.
+    '''
+    num_triples = dumb_index_header["num_triples"]
+    end = num_triples if end is None else min(end, num_triples)
+    if start >= end:
+        return []
+
+    vector_type = dumb_index_header["vector_type"]
+    num_dimensions = dumb_index_header["num_dimensions"]
+    triple_table_offset = dumb_index_header["triple_table_offset"]
+    vector_bytes_count = num_dimensions * number_of_bytes_for_vector_type(vector_type)
+
+    if dumb_index_header["version_number"] == C_VERSION_2:
+        fileixs_offset = triple_table_offset + num_triples * vector_bytes_count
+        chunkixs_offset = fileixs_offset + 4 * num_triples
+        sections = [
+            (triple_table_offset + start * vector_bytes_count, triple_table_offset + end * vector_bytes_count),
+            (fileixs_offset + 4 * start, fileixs_offset + 4 * end),
+            (chunkixs_offset + 4 * start, chunkixs_offset + 4 * end),
+        ]
+    else:
+        record_bytes_count = vector_bytes_count + 8
+        sections = [
+            (triple_table_offset + start * record_bytes_count, triple_table_offset + end * record_bytes_count),
+        ]
+
+    section_bytes_list = _get_s3_object_sections(get_s3_client(boto3_session), s3_bucket, dumb_index_header["path"], sections, range_size, max_workers)
+
+    if dumb_index_header["version_number"] == C_VERSION_2:
+        vectors_bytes, fileixs_bytes, chunkixs_bytes = section_bytes_list
+        vectors = bytes_to_vectors(vectors_bytes, vector_type, num_dimensions).tolist()
+        fileixs = np.frombuffer(fileixs_bytes, dtype='<u4').tolist()
+        chunkixs = np.frombuffer(chunkixs_bytes, dtype='<u4').tolist()
+        return list(zip(vectors, fileixs, chunkixs))
+    else:
+        return get_triples_from_triple_table_bytes(section_bytes_list[0], vector_type, num_dimensions, end - start)
+
+def read_dumb_index_dimension_mask_from_s3(boto3_session, s3_bucket, dumb_index_header):
+    # the dimension mask at the end of a dumb index on S3, or None if it hasn't got one
+    try:
+        response = get_s3_client(boto3_session).get_object(
+            Bucket=s3_bucket, Key=dumb_index_header["path"], Range=f"bytes={dumb_index_header['dimension_mask_offset']}-"
+        )
+    except botocore.exceptions.ClientError as e:
+        # the range starts at the end of the file, so there's nothing after the triples
+        if e.response['Error']['Code'] == "InvalidRange":
+            return None
+        else:
+            # Something else has gone wrong.
+            raise
+    return _get_dimension_mask_from_section_bytes(response['Body'].read())
+
+def read_dumb_index_dimension_mask_from_fileobj(f, dumb_index_header):
+    # the dimension mask at the end of a dumb index in an open binary file, or None if it hasn't got one
+    f.seek(dumb_index_header["dimension_mask_offset"])
+    return _get_dimension_mask_from_section_bytes(f.read())
+
+def read_dumb_index_from_s3_by_ranges(boto3_session, s3_bucket, s3_path, dumb_index_name, range_size=C_S3_RANGE_SIZE, max_workers=C_S3_MAX_WORKERS):
+    # like read_dumb_index_from_s3, but the header comes first, then the sections are fetched with concurrent Range requests
+    dumb_index_header = read_dumb_index_header_from_s3(boto3_session, s3_bucket, s3_path, dumb_index_name)
+    if dumb_index_header is None:
+        return None
+
+    paths, file_pairs = read_dumb_index_tables_from_s3(boto3_session, s3_bucket, dumb_index_header)
+    triples = read_dumb_index_triples_from_s3(boto3_session, s3_bucket, dumb_index_header, range_size=range_size, max_workers=max_workers)
+    dimension_mask = read_dumb_index_dimension_mask_from_s3(boto3_session, s3_bucket, dumb_index_header)
+
+    return {
+        "paths": paths,
+        "file_pairs": file_pairs,
+        "triples": triples,
+        "dimension_mask": dimension_mask
+    }
 
 def read_dumb_index_from_file(filename):
     with open(filename, "rb") as f:
@@ -635,95 +2255,305 @@ def read_dumb_index_from_file(filename):
         dumb_index = get_dumb_index_from_bytes(dumb_index_bytes)
         return dumb_index
 
+def read_columnar_dumb_index_from_file(filename, use_mmap=True):
+    '''
+    Opens a dumb index file (version 1 or 2) in columnar form, see get_columnar_dumb_index_from_bytes.
+
+    With use_mmap, the file is memory mapped read only. Only the header and the path and file tables are parsed up 
+    front; the vectors, fileixs, chunkixs and norms are read only array views over the mapping, so they are paged in
+    as they are used, and processes opening the same file share the page cache. The mapping stays open as long as 
+    the returned arrays are referenced.
+    '''
+    with open(filename, "rb") as f:
+        if use_mmap:
+            dumb_index_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            dumb_index_bytes = f.read()
+
+    return get_columnar_dumb_index_from_bytes(dumb_index_bytes)
+
 def dumb_index_exists_on_s3(boto3_session, s3_bucket, s3_path, dumb_index_name):
-    s3 = boto3_session.resource('s3')
+    s3_client = get_s3_client(boto3_session)
+    path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
     try:
-        path = f"{s3_path}/{dumb_index_name}" if s3_path else f"{dumb_index_name}"
-        s3_object = s3.Object(s3_bucket, path)
-        try:
-            s3_object.load()
-        except botocore.exceptions.ClientError as e:
-            print (e)
-            #botocore.errorfactory.NoSuchKey
-            if e.response['Error']['Code'] == "404":
-                return False
-            else:
-                # Something else has gone wrong.
-                raise
+        s3_client.head_object(Bucket=s3_bucket, Key=path)
+    except botocore.exceptions.ClientError as e:
+        print (e)
+        #botocore.errorfactory.NoSuchKey
+        if e.response['Error']['Code'] == "404":
+            return False
         else:
-            return True
-    finally:
-        s3.meta.client.close()
+            # Something else has gone wrong.
+            raise
+    else:
+        return True
 
 def cosine_similarity(a, b):
-    dot_product = sum([a[i] * b[i] for i in range(len(a))])
-    a_magnitude = sum([a[i] * a[i] for i in range(len(a))])
-    b_magnitude = sum([b[i] * b[i] for i in range(len(b))])
-    return dot_product / (a_magnitude * b_magnitude)
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    magnitudes = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(np.dot(a, b) / magnitudes) if magnitudes else 0.0
 
 def dot_product(a, b):
-    return sum([a[i] * b[i] for i in range(len(a))])
+    return float(np.dot(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)))
+
+C_METRIC_DOT = "dot"
+C_METRIC_COSINE = "cosine"
+C_METRIC_L2 = "l2"
+
+class ColumnarTriples(collections.abc.Sequence):
+    '''
+    A read only sequence of triples over a columnar dumb index (see get_columnar_dumb_index_from_bytes). Each triple
+    is decoded when it is asked for.
+    '''
+    def __init__(self, columnar_dumb_index):
+        self.columnar_dumb_index = columnar_dumb_index
+
+    def __len__(self):
+        return len(self.columnar_dumb_index["fileixs"])
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(len(self)))]
+        columnar_dumb_index = self.columnar_dumb_index
+        vector = dumb_vector_array_to_floats(columnar_dumb_index["vectors"][ix], columnar_dumb_index["vector_type"])
+        return (vector.tolist(), int(columnar_dumb_index["fileixs"][ix]), int(columnar_dumb_index["chunkixs"][ix]))
+
+class RankedTriples(collections.abc.Sequence):
+    # the triples of a dumb index in ranked order, without copying them. order holds the indices into triples.
+    def __init__(self, triples, order):
+        self.triples = triples
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self.triples[i] for i in self.order[ix].tolist()]
+        return self.triples[int(self.order[ix])]
+
+def get_dumb_index_triples(dumb_index):
+    # the triples of a dumb index, whether it is a dict of triples or columnar
+    if "triples" in dumb_index:
+        return dumb_index["triples"]
+    return ColumnarTriples(dumb_index)
+
+def get_dumb_index_matrix(dumb_index):
+    # the vectors of a dumb index (a dict of triples or columnar) as an N X D float array
+    if "triples" not in dumb_index:
+        return dumb_vector_array_to_floats(dumb_index["vectors"], dumb_index["vector_type"])
+
+    triples = dumb_index["triples"]
+    if not triples:
+        return np.zeros((0, 0))
+    return np.asarray([triple[0] for triple in triples], dtype=np.float64)
+
+def get_similarities(matrix, vector, metric=C_METRIC_DOT, norms=None):
+    '''
+    Scores every row of matrix (N X D) against vector in one pass, higher being more similar. For C_METRIC_L2 the 
+    score is the negative squared euclidean distance. norms (the magnitudes of the rows) are used for cosine and l2
+    if given, otherwise they are calculated. Rows or queries with no magnitude have a cosine similarity of 0.
+    '''
+    vector = np.asarray(vector, dtype=matrix.dtype)
+    dots = matrix @ vector
+
+    if metric == C_METRIC_DOT:
+        return dots
+
+    if norms is None:
+        norms = np.linalg.norm(matrix, axis=1)
+    norms = np.asarray(norms, dtype=dots.dtype)
+    vector_norm = np.linalg.norm(vector)
+
+    if metric == C_METRIC_COSINE:
+        magnitudes = norms * vector_norm
+        return np.divide(dots, magnitudes, out=np.zeros_like(dots), where=magnitudes != 0)
+    elif metric == C_METRIC_L2:
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+        return 2 * dots - norms * norms - vector_norm * vector_norm
+    else:
+        raise Exception(f"Unknown metric {metric}")
+
+def rank_dumb_index_by_similarity(dumb_index, vector, metric=C_METRIC_DOT, k=None):
+    '''
+    Returns (order, scores) for a dumb index (a dict of triples or columnar) against a query vector: order is the 
+    indices of the triples from most to least similar, and scores their similarities in that order. With k, only the
+    top k are ranked (the rest aren't sorted at all). Stored norms are used when the index has them.
+    '''
+    vector = apply_dimension_mask(dumb_index, vector)
+    matrix = get_dumb_index_matrix(dumb_index)
+    if not len(matrix):
+        return np.zeros(0, dtype=np.intp), np.zeros(0)
+
+    similarities = get_similarities(matrix, vector, metric, dumb_index.get("norms"))
+
+    if k is not None and k < len(similarities):
+        top_k = np.argpartition(-similarities, k)[:k]
+        order = top_k[np.argsort(-similarities[top_k], kind='stable')]
+    else:
+        # stable, so equal scores stay in index order (as sorted() did)
+        order = np.argsort(-similarities, kind='stable')
 
-def sort_dumb_index_by_similarity(dumb_index, vector, assume_normalized_vectors=True):
-    f_cosign_similarity = dot_product if assume_normalized_vectors else cosine_similarity
-    sorted_triples = sorted(dumb_index["triples"], key=lambda triple: f_cosign_similarity(triple[0], vector), reverse=True)
+    return order, similarities[order]
+
+def sort_dumb_index_by_similarity(dumb_index, vector, assume_normalized_vectors=True, metric=None, k=None):
+    '''
+    Ranks a dumb index by similarity to vector. "triples" in the result is a list of the index's triples in ranked 
+    order, and "scores" are their similarities. metric defaults to dot product for normalized vectors, otherwise 
+    cosine similarity. With k only the top k triples are returned. See sort_dumb_index_view_by_similarity to rank
+    a large index without building the list.
+    '''
+    sorted_index = sort_dumb_index_view_by_similarity(dumb_index, vector, assume_normalized_vectors, metric, k)
+    sorted_index["triples"] = sorted_index["triples"][:]
+    return sorted_index
+
+def sort_dumb_index_view_by_similarity(dumb_index, vector, assume_normalized_vectors=True, metric=None, k=None):
+    # sort_dumb_index_by_similarity, but "triples" is a RankedTriples view of the index's triples, not a list
+    if metric is None:
+        metric = C_METRIC_DOT if assume_normalized_vectors else C_METRIC_COSINE
+
+    order, scores = rank_dumb_index_by_similarity(dumb_index, vector, metric, k)
     return {
-        "triples": sorted_triples,
+        "triples": RankedTriples(get_dumb_index_triples(dumb_index), order),
+        "scores": scores,
         "paths": dumb_index["paths"],
-        "file_pairs": dumb_index["file_pairs"]
+        "file_pairs": dumb_index["file_pairs"],
+        "dimension_mask": dumb_index.get("dimension_mask")
     }
 
-def get_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache=False):
-    return list(yield_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache))
+def get_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache=False, max_workers=C_S3_MAX_WORKERS, chunk_cache=None, disk_cache=None):
+    return list(yield_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache, max_workers, chunk_cache, disk_cache))
+
+def yield_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache=False, max_workers=C_S3_MAX_WORKERS, chunk_cache=None, disk_cache=None):
+    '''
+    Yields the chunks for triples offset to offset + amount of the (sorted) dumb index, in order. 
+
+    The triples are grouped by chunk file, and each file that isn't already cached is fetched exactly once, with up
+    to max_workers files fetched concurrently, in the order they are first needed. Chunk containers (without a 
+    disk_cache) only have the chunks we need read, usually with one Range request covering all of them. Each chunk is
+    yielded as soon as its file (and the files of all the chunks before it) have arrived.
+    '''
+    if chunk_cache is None:
+        chunk_cache = C_CHUNK_CACHE
+
+    s3_client = get_s3_client(boto3_session)
 
-def yield_chunks_from_dumb_index(boto3_session, s3_bucket, dumb_index, offset, amount, read_through_cache=False):
-    for i in range(offset, offset + amount):
-        if i >= len(dumb_index["triples"]):
-            break
-        triple = dumb_index["triples"][i]
+    # the (s3 key, chunkix) of each result, in ranked order
+    locations = []
+    for triple in dumb_index["triples"][offset:offset + amount]:
         _, fileix, chunkix = triple
-        s3_file_pair = dumb_index["file_pairs"][fileix]
-        pathix, s3_file = s3_file_pair
+        pathix, s3_file = dumb_index["file_pairs"][fileix]
         s3_path = dumb_index["paths"][pathix]
-        chunk = read_chunk_from_s3(boto3_session, s3_bucket, s3_path, s3_file, chunkix, read_through_cache)
-        yield chunk
+        path = f"{s3_path}/{s3_file}" if s3_path else f"{s3_file}"
+        locations.append((path, chunkix))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # path -> list of chunks, for files we already have
+        cached_files = {}
+        # path -> future, for files we need to fetch
+        futures = {}
+        # path -> the chunkixs we need, for chunk containers, which we read just those chunks of
+        container_chunkixs = {}
+        for path, chunkix in locations:
+            if path.endswith(C_CHUNK_CONTAINER_EXTENSION) and disk_cache is None:
+                container_chunkixs.setdefault(path, []).append(chunkix)
+        # path -> future of chunkix -> chunk, one per chunk container
+        container_futures = {}
+        for path, chunkix in locations:
+            if path in cached_files or path in futures or path in container_futures:
+                continue
+            if path in container_chunkixs:
+                container_futures[path] = executor.submit(
+                    _load_chunks_from_chunk_container, s3_client, s3_bucket, path, container_chunkixs[path], read_through_cache, chunk_cache
+                )
+                continue
+            chunks = None if read_through_cache else chunk_cache.get_chunks(s3_bucket, path)
+            if chunks is not None:
+                cached_files[path] = chunks
+            else:
+                futures[path] = executor.submit(_get_chunks_from_s3, s3_client, s3_bucket, path, disk_cache, read_through_cache)
+
+        for path, chunkix in locations:
+            if path in container_futures:
+                yield container_futures[path].result().get(chunkix)
+                continue
+
+            if path not in cached_files:
+                chunks, num_bytes = futures[path].result()
+                if chunks:
+                    # don't cache the empty list!
+                    chunk_cache.put_chunks(s3_bucket, path, chunks, num_bytes)
+                cached_files[path] = chunks
+
+            chunks = cached_files[path]
+            yield chunks[chunkix] if chunkix < len(chunks) else None
+    finally:
+        # if the caller stops early, don't wait for fetches they won't use
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
-def create_dimension_mask(triples, threshold=0.1):
+# create_dimension_mask reduces the vectors of a columnar index or a list of triples this many at a time
+C_DIMENSION_MASK_BLOCK_SIZE = 16384
+
+def create_dimension_mask(vectors, threshold=0.1, block_size=C_DIMENSION_MASK_BLOCK_SIZE):
     '''
     In this function, we create a mask (a vector containing 0s and 1s) that will be used to filter out dimensions that
-    are not valuable in our vectors. Our vectors are at position 0 in the triples.
+    are not valuable in our vectors. vectors is an N X D array, a columnar dumb index, or a list of triples (with the
+    vectors at position 0).
 
-    We traverse the triples and for each dimension, we calculate the max and min value of that dimension in all the vectors.
-    If the difference between the max and min is less than the threshold, we set the mask value to 0, otherwise we set it to 1.
+    For each dimension we take the max and min value of that dimension over all the vectors (as column reductions over
+    the N X D matrix of vectors, a block of rows at a time unless we were given the array, so no full copy is made). If
+    the difference between the max and min is less than the threshold, we set the mask value to 0, otherwise we set it
+    to 1.
     '''
+    if isinstance(vectors, np.ndarray):
+        blocks = [vectors]
+    elif isinstance(vectors, dict):
+        blocks = (
+            dumb_vector_array_to_floats(vectors["vectors"][start:start + block_size], vectors["vector_type"])
+            for start in range(0, len(vectors["vectors"]), block_size)
+        )
+    else:
+        blocks = (
+            np.asarray([triple[0] for triple in vectors[start:start + block_size]])
+            for start in range(0, len(vectors), block_size)
+        )
+
+    max_values = None
+    min_values = None
+    for block in blocks:
+        if not len(block):
+            continue
+        if max_values is None:
+            max_values, min_values = block.max(axis=0), block.min(axis=0)
+        else:
+            np.maximum(max_values, block.max(axis=0), out=max_values)
+            np.minimum(min_values, block.min(axis=0), out=min_values)
 
-    if not triples:
+    if max_values is None:
         return None
-    
-    num_dimensions = len(triples[0][0])
-
-    max_values = triples[0][0].copy()
-    min_values = triples[0][0].copy()
-
-    for triple in triples[1:]:
-        vector = triple[0]
-        for i in range(num_dimensions):
-            if vector[i] > max_values[i]:
-                max_values[i] = vector[i]
-            if vector[i] < min_values[i]:
-                min_values[i] = vector[i]
-
-    dimension_mask = [
-        0 if max_values[i] - min_values[i] < threshold else 1
-        for i in range(num_dimensions)
-    ]
 
-    return dimension_mask
+    dimension_mask = max_values - min_values >= threshold
+
+    return dimension_mask.astype(int).tolist()
 
 def filter_vector_by_mask(vector, mask):
-    return [
-        vector[i]
-        for i in range(len(vector))
-        if mask[i]
-    ]
\ No newline at end of file
+    # returns a list, see filter_vectors_by_mask
+    return filter_vectors_by_mask(vector, mask).tolist()
+
+def filter_vectors_by_mask(vectors, mask):
+    # filter_vector_by_mask for one vector or an N X D matrix of them at once, dropping the masked dimensions from
+    # the last axis. Returns a numpy array.
+    return np.asarray(vectors)[..., np.asarray(mask, dtype=bool)]
+
+def apply_dimension_mask(dumb_index, vector):
+    '''
+    Projects a query vector onto the dimensions a dumb index kept, if it was built with a dimension mask and the 
+    vector is full length. Anything else (no mask, or a vector that's already projected) is returned as it is.
+    '''
+    dimension_mask = dumb_index.get("dimension_mask")
+    if dimension_mask is None or len(vector) != len(dimension_mask) or all(dimension_mask):
+        return vector
+    return filter_vectors_by_mask(vector, dimension_mask)
\ No newline at end of file